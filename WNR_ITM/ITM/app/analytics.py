@@ -0,0 +1,116 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import time
+import math
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# Analytics processes are started from a clean server process, not forked from the web tier
+START_METHODS = ['forkserver', 'spawn', 'fork']
+# Modules imported once by the fork server, shared by all processes forked from it
+PRELOAD = ['smartcity']
+CHANNELS_PER_WORKER = 4
+
+
+def plan_workers(num_ch, workers=0):
+    """
+    Return number of analytics worker processes for <num_ch> channels.
+    If <workers> is 0 it is sized from the number of usable cores, keeping
+    half of them for the inference and decode threads.
+    """
+    if workers > 0:
+        return workers
+    cores = len(os.sched_getaffinity(0))
+    return max(1, min(math.ceil(num_ch/CHANNELS_PER_WORKER), cores//2))
+
+
+def worker_cpus(worker, workers):
+    """
+    Return the set of cores worker <worker> of <workers> is pinned to.
+    Usable cores are split in contiguous groups, one per worker.
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    group = cores[worker*len(cores)//workers:(worker + 1)*len(cores)//workers]
+    return set(group or [cores[worker % len(cores)]])
+
+
+def start_worker(*args, **kwargs):
+    """
+    Target of analytics worker processes, see smartcity.start_app.
+    GStreamer, OpenVINO and OpenCV are imported by the worker only.
+    """
+    import smartcity
+    smartcity.start_app(*args, **kwargs)
+
+
+def available_devices():
+    """
+    Return inference devices found by OpenVINO
+    """
+    from openvino.inference_engine import IECore
+    return IECore().available_devices
+
+
+def _probe_source(path, results):
+    """
+    Store in <results> whether a frame can be read from source <path>
+    """
+    import cv2
+    cap = cv2.VideoCapture(path)
+    ret, _ = cap.read()
+    results[path] = ret and cap.isOpened()
+    cap.release()
+
+
+def probe_sources(paths, timeout):
+    """
+    Open all sources in <paths> in parallel with OpenCV.
+    Return dict of path to True if a frame was read, False if not, None if not done within <timeout> seconds.
+    """
+    results = {}
+    # Daemon threads, a source that hangs must not block the process on exit
+    threads = {path: threading.Thread(target=_probe_source, args=(path, results), daemon=True)
+               for path in dict.fromkeys(paths)}
+    for th in threads.values():
+        th.start()
+    deadline = time.monotonic() + timeout
+    for th in threads.values():
+        th.join(max(0, deadline - time.monotonic()))
+    return {path: results.get(path) for path in threads}
+
+
+def load_or_tune(*args):
+    """
+    Run autotune.load_or_tune with <args>
+    """
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s :: %(message)s")
+    import autotune
+    return autotune.load_or_tune(*args)
+
+
+def run_isolated(func, *args):
+    """
+    Return result of <func>(*<args>) run in a short lived child process,
+    so modules it imports are not loaded into the calling process.
+    """
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(func, *args).result()
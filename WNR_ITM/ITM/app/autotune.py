@@ -0,0 +1,210 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import logging
+from argparse import ArgumentParser
+import numpy as np
+import cv2
+from openvino.inference_engine import IECore
+
+log = logging.getLogger(__name__)
+
+STREAMS = [1, 2, 4]
+NIREQ = [2, 4, 8]
+BATCH_SIZES = [1, 4]
+# Throughput streams config key per device
+STREAMS_KEYS = {'CPU': 'CPU_THROUGHPUT_STREAMS', 'GPU': 'GPU_THROUGHPUT_STREAMS'}
+
+
+def find_precisions(model_xml):
+    """
+    Return dict of precision to IR path for all precisions of the model <model_xml>,
+    expected in the layout <model dir>/<precision>/<model name>.xml
+    """
+    model_name = os.path.basename(model_xml)
+    model_dir = os.path.dirname(os.path.dirname(os.path.abspath(model_xml)))
+    precisions = {}
+    for precision in sorted(os.listdir(model_dir)):
+        path = os.path.join(model_dir, precision, model_name)
+        if os.path.isfile(path):
+            precisions[precision] = path
+    return precisions
+
+
+def host_key(model_xml, device):
+    """
+    Return cache key of <model_xml> on <device> of this host
+    """
+    cpu = ''
+    try:
+        with open('/proc/cpuinfo') as f:
+            cpu = next((line.split(':', 1)[1].strip() for line in f if line.startswith('model name')), '')
+    except OSError:
+        pass
+    return f'{socket.gethostname()}|{cpu}|{len(os.sched_getaffinity(0))}|{os.path.basename(model_xml)}|{device}'
+
+
+def read_frames(clip, num_frames=32):
+    """
+    Return up to <num_frames> frames of <clip>
+    """
+    cap = cv2.VideoCapture(clip)
+    frames = []
+    while len(frames) < num_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        raise RuntimeError(f'Unable to read frames from `{clip}`')
+    return frames
+
+
+def measure(ie, model_xml, device, streams, nireq, batch_size, frames, duration):
+    """
+    Run asynchronous inference on <frames> for <duration> seconds.
+    Return (throughput in frames per second, median request latency in ms).
+    """
+    net = ie.read_network(model=model_xml)
+    input_name = next(iter(net.input_info))
+    net.batch_size = batch_size
+    _, _, height, width = net.input_info[input_name].input_data.shape
+    config = {STREAMS_KEYS[device]: str(streams)} if device in STREAMS_KEYS else {}
+    exec_net = ie.load_network(net, device, config=config, num_requests=nireq)
+    images = [cv2.resize(frame, (width, height)).transpose((2, 0, 1)) for frame in frames]
+    batches = [np.stack([images[(i + j) % len(images)] for j in range(batch_size)])
+               for i in range(0, len(images), batch_size)]
+    latencies = []
+    num_frames = 0
+    started = [0]*nireq
+    st_time = time.monotonic()
+    for i, request in enumerate(exec_net.requests):
+        started[i] = time.monotonic()
+        request.async_infer({input_name: batches[i % len(batches)]})
+    i = 0
+    while time.monotonic() - st_time < duration:
+        request = exec_net.requests[i]
+        request.wait(-1)
+        now = time.monotonic()
+        latencies.append((now - started[i])*1000)
+        num_frames += batch_size
+        started[i] = now
+        request.async_infer({input_name: batches[num_frames % len(batches)]})
+        i = (i + 1) % nireq
+    for request in exec_net.requests:
+        request.wait(-1)
+    return num_frames/(time.monotonic() - st_time), float(np.median(latencies))
+
+
+def tune(model_xml, device, clip, latency_target=100, duration=2):
+    """
+    Benchmark all candidate configurations of <model_xml> on <device> and return the one
+    with the highest throughput whose latency is within <latency_target> ms,
+    or the one with the lowest latency if none is.
+    """
+    ie = IECore()
+    frames = read_frames(clip)
+    streams_list = STREAMS if device in STREAMS_KEYS else [1]
+    results = []
+    for precision, path in find_precisions(model_xml).items():
+        for streams in streams_list:
+            for nireq in NIREQ:
+                if nireq < streams:
+                    continue
+                for batch_size in BATCH_SIZES:
+                    try:
+                        fps, latency = measure(ie, path, device, streams, nireq, batch_size, frames, duration)
+                    except Exception as err:
+                        log.warning(f'Autotune: {precision} streams={streams} nireq={nireq} '
+                                    f'batch_size={batch_size} failed on {device}: {err}')
+                        continue
+                    log.info(f'Autotune: {device} {precision} streams={streams} nireq={nireq} '
+                             f'batch_size={batch_size} - {fps:.1f} fps, {latency:.1f} ms')
+                    results.append({'model': path, 'precision': precision, 'streams': streams,
+                                    'nireq': nireq, 'batch_size': batch_size,
+                                    'fps': round(fps, 1), 'latency_ms': round(latency, 1)})
+    if not results:
+        raise RuntimeError(f'No configuration of `{model_xml}` could run on {device}')
+    within = [result for result in results if result['latency_ms'] <= latency_target]
+    if within:
+        return max(within, key=lambda result: result['fps'])
+    log.warning(f'Autotune: no configuration meets the latency target of {latency_target} ms on {device}')
+    return min(results, key=lambda result: result['latency_ms'])
+
+
+def load_or_tune(model_xml, devices, clip, cache_path, latency_target=100, duration=2):
+    """
+    Return dict of device to tuned configuration, reusing results cached in <cache_path>
+    for this host and latency target.
+    """
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    tuned = {}
+    for device in devices:
+        key = host_key(model_xml, device)
+        cached = cache.get(key)
+        if cached and cached.get('latency_target') == latency_target and os.path.isfile(cached['model']):
+            log.info(f'Autotune: using cached configuration for {device}')
+        else:
+            st_time = time.monotonic()
+            cached = tune(model_xml, device, clip, latency_target, duration)
+            cached['latency_target'] = latency_target
+            cache[key] = cached
+            log.info(f'Autotune: {device} tuned in {time.monotonic() - st_time:.1f} s')
+        tuned[device] = cached
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    tmp = cache_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=4)
+    os.replace(tmp, cache_path)
+    return tuned
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-m", "--model",
+                        help="Path to model file, all precisions next to it are tried",
+                        required=True, type=str)
+    parser.add_argument("-d", "--devices",
+                        help="Optional. Devices to tune",
+                        required=False, default=['CPU'], nargs='+', type=str)
+    parser.add_argument("-i", "--clip",
+                        help="Sample video clip",
+                        required=True, type=str)
+    parser.add_argument("-latency_target", "--latency_target",
+                        help="Optional. Maximum median inference latency in ms",
+                        required=False, default=100, type=float)
+    parser.add_argument("-cache", "--cache",
+                        help="Optional. File the results are cached in",
+                        required=False, default='/tmp/itm_autotune.json', type=str)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s :: %(message)s")
+    try:
+        print(json.dumps(load_or_tune(args.model, args.devices, args.clip, args.cache,
+                                      args.latency_target), indent=4))
+    except RuntimeError as err:
+        log.error(str(err))
+        sys.exit(-1)
@@ -0,0 +1,334 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import sys
+import time
+import json
+import logging
+from queue import Empty
+from threading import Thread
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+import numpy as np
+import cv2
+from openvino.inference_engine import IECore
+import smartcity
+import analytics
+import autotune
+from channel_status import ChannelStatus
+from startup_timing import rss_mb
+
+log = logging.getLogger(__name__)
+
+
+def replicate_cameras(cameras, num_ch):
+    """
+    Return <num_ch> camera configs, cycling through <cameras>
+    """
+    return [dict(cameras[i % len(cameras)]) for i in range(num_ch)]
+
+
+def drain(reports):
+    """
+    Discard reports forwarded by the workers, nothing is written to InfluxDB
+    """
+    while True:
+        try:
+            _ = reports.get(timeout=1)
+        except Empty:
+            continue
+
+
+def run_analytics(cameras, args, workers, threads=None):
+    """
+    Run analytics on <cameras> with <workers> worker processes and
+    return (measured FPS of each channel, resident memory of all workers in MB)
+    :param threads: Optional. Thread counts overriding the thread plan
+    """
+    num_ch = len(cameras)
+    status = ChannelStatus(num_ch)
+    reports = Queue()
+    Thread(target=drain, args=(reports,), daemon=True).start()
+    # No viewers, frames are never delivered
+    q_data = {key:None for key in range(num_ch)}
+    running = [0]*num_ch
+    processes = []
+    for i in range(workers):
+        cpus = analytics.worker_cpus(i, workers) if args.pin_workers else None
+        processes.append(Process(target=smartcity.start_app,
+                                 args=(cameras, args.vp_model, args.vp_proc, True, True, None,
+                                       q_data, running, None, None, None, None, status),
+                                 kwargs={'worker': i, 'workers': workers, 'reports': reports, 'cpus': cpus,
+                                         'threads': threads}))
+    for process in processes:
+        process.start()
+    time.sleep(args.warmup)
+    start = [s['frames'] for s in status.get()]
+    time.sleep(args.duration)
+    end = [s['frames'] for s in status.get()]
+    rss = sum(rss_mb(process.pid) for process in processes)
+    for process in processes:
+        process.terminate()
+        process.join()
+    return [(e - s)/args.duration for s, e in zip(start, end)], rss
+
+
+def scaling(args):
+    """
+    Measure channels per node as the number of analytics workers increases
+    """
+    with open(args.config_path) as f:
+        cameras = json.load(f)['cameras']
+    rows = []
+    for num_ch in args.channels:
+        for workers in args.workers:
+            if workers > num_ch:
+                continue
+            fps, _ = run_analytics(replicate_cameras(cameras, num_ch), args, workers)
+            sustained = sum(1 for value in fps if value >= args.target_fps)
+            rows.append((workers, num_ch, sum(fps), min(fps), sustained))
+            log.info(f'workers={workers} channels={num_ch} total_fps={sum(fps):.1f} '
+                     f'min_fps={min(fps):.1f} sustained={sustained}')
+    print(f'\n{"workers":>8} {"channels":>9} {"total fps":>10} {"min fps":>8} '
+          f'{"channels >= " + str(args.target_fps) + " fps":>20}')
+    for workers, num_ch, total, lowest, sustained in rows:
+        print(f'{workers:>8} {num_ch:>9} {total:>10.1f} {lowest:>8.1f} {sustained:>20}')
+
+
+def model_instance(args):
+    """
+    Compare one inference instance per channel with instances shared between channels
+    """
+    with open(args.config_path) as f:
+        cameras = json.load(f)['cameras']
+    rows = []
+    for num_ch in args.channels:
+        for mode in ['per_channel', 'shared']:
+            run_cameras = replicate_cameras(cameras, num_ch)
+            for ch_id, cam in enumerate(run_cameras):
+                for key in ['model_instance_id', 'batch_size', 'nireq']:
+                    cam.pop(key, None)
+                if mode == 'per_channel':
+                    cam['model_instance_id'] = f'channel{ch_id}'
+                else:
+                    if args.batch_size:
+                        cam['batch_size'] = args.batch_size
+                    if args.nireq:
+                        cam['nireq'] = args.nireq
+            fps, rss = run_analytics(run_cameras, args, 1)
+            rows.append((mode, num_ch, sum(fps), min(fps), rss))
+            log.info(f'mode={mode} channels={num_ch} total_fps={sum(fps):.1f} rss={rss:.0f} MB')
+    print(f'\n{"mode":>12} {"channels":>9} {"total fps":>10} {"min fps":>8} {"RSS MB":>8}')
+    for mode, num_ch, total, lowest, rss in rows:
+        print(f'{mode:>12} {num_ch:>9} {total:>10.1f} {lowest:>8.1f} {rss:>8.0f}')
+
+
+def threads(args):
+    """
+    Compare total FPS of planned thread budgets with the fixed thread counts
+    """
+    with open(args.config_path) as f:
+        cameras = json.load(f)['cameras']
+    rows = []
+    for num_ch in args.channels:
+        for mode, overrides in [('fixed', smartcity.FIXED_THREADS), ('planned', None)]:
+            fps, _ = run_analytics(replicate_cameras(cameras, num_ch), args, 1, overrides)
+            rows.append((mode, num_ch, sum(fps), min(fps)))
+            log.info(f'mode={mode} channels={num_ch} total_fps={sum(fps):.1f} min_fps={min(fps):.1f}')
+    print(f'\n{"mode":>8} {"channels":>9} {"total fps":>10} {"min fps":>8}')
+    for mode, num_ch, total, lowest in rows:
+        print(f'{mode:>8} {num_ch:>9} {total:>10.1f} {lowest:>8.1f}')
+    print(f'\nThread plan for {args.channels[-1]} channels: {smartcity.plan_threads(args.channels[-1])}')
+
+
+def detect(exec_net, input_name, output_name, frame, size, threshold):
+    """
+    Return detections of <frame> as array of rows (label, confidence, x1, y1, x2, y2),
+    coordinates relative to the frame
+    """
+    image = cv2.resize(frame, size).transpose((2, 0, 1))[np.newaxis]
+    result = exec_net.infer({input_name: image})[output_name].reshape(-1, 7)
+    result = result[(result[:, 0] >= 0) & (result[:, 2] >= threshold)]
+    return result[:, 1:]
+
+
+def matches(detections, reference, iou_threshold=0.5):
+    """
+    Return number of <detections> matching a <reference> detection of the same label,
+    greedily by highest IoU
+    """
+    matched = 0
+    used = set()
+    for det in detections:
+        best, best_iou = None, iou_threshold
+        for i, ref in enumerate(reference):
+            if i in used or ref[0] != det[0]:
+                continue
+            w = min(det[4], ref[4]) - max(det[2], ref[2])
+            h = min(det[5], ref[5]) - max(det[3], ref[3])
+            if w <= 0 or h <= 0:
+                continue
+            inter = w*h
+            iou = inter/((det[4] - det[2])*(det[5] - det[3]) + (ref[4] - ref[2])*(ref[5] - ref[3]) - inter)
+            if iou >= best_iou:
+                best, best_iou = i, iou
+        if best is not None:
+            used.add(best)
+            matched += 1
+    return matched
+
+
+def resolution(args):
+    """
+    Measure detection FPS and agreement with the native network resolution
+    at each inference resolution, on the file sources of the config
+    """
+    with open(args.config_path) as f:
+        cameras = json.load(f)['cameras']
+    clips = list(dict.fromkeys(cam['path'] for cam in cameras
+                               if '://' not in cam['path'] and '/dev/video' not in cam['path']))
+    if not clips:
+        log.error('No file sources in config.')
+        sys.exit(-1)
+    frames = [frame for clip in clips for frame in autotune.read_frames(clip, args.frames)]
+    ie = IECore()
+    rows = []
+    reference = None
+    for size in [None] + [tuple(int(v) for v in res.lower().split('x')) for res in args.resolutions]:
+        net = ie.read_network(model=args.vp_model)
+        input_name = next(iter(net.input_info))
+        if size:
+            net.reshape({input_name: (1, 3, size[1], size[0])})
+        _, _, height, width = net.input_info[input_name].input_data.shape
+        output_name = next(iter(net.outputs))
+        exec_net = ie.load_network(net, args.device)
+        st_time = time.monotonic()
+        detections = [detect(exec_net, input_name, output_name, frame, (width, height), args.threshold)
+                      for frame in frames]
+        fps = len(frames)/(time.monotonic() - st_time)
+        if reference is None:
+            reference = detections
+        matched = sum(matches(det, ref) for det, ref in zip(detections, reference))
+        num_det, num_ref = sum(map(len, detections)), sum(map(len, reference))
+        recall = matched/num_ref if num_ref else 1
+        f1 = 2*matched/(num_det + num_ref) if num_det + num_ref else 1
+        name = f'{width}x{height}' + ('' if size else ' (native)')
+        rows.append((name, fps, num_det, recall, f1))
+        log.info(f'resolution={name} fps={fps:.1f} detections={num_det} recall={recall:.3f} f1={f1:.3f}')
+    print(f'\nDetection on {len(frames)} frames of {len(clips)} clips, {args.device}. '
+          f'Recall and F1 against detections at the native resolution.')
+    print(f'\n{"resolution":>20} {"fps":>8} {"detections":>11} {"recall":>7} {"F1":>6}')
+    for name, fps, num_det, recall, f1 in rows:
+        print(f'{name:>20} {fps:>8.1f} {num_det:>11} {recall:>7.3f} {f1:>6.3f}')
+
+
+def add_common_args(parser):
+    """
+    Add arguments shared by all benchmarks to <parser>
+    """
+    parser.add_argument("-c", "--config_path",
+                        help="Path to camera config file, cameras are replicated up to the channel count",
+                        required=True, type=str)
+    parser.add_argument("-vp_model", "--vp_model",
+                        help="Path to model file",
+                        required=True, type=str)
+    parser.add_argument("-vp_proc", "--vp_proc",
+                        help="Path to model proc file",
+                        required=True, type=str)
+    parser.add_argument("--duration",
+                        help="Optional. Seconds measured per run",
+                        required=False, default=30, type=float)
+    parser.add_argument("--warmup",
+                        help="Optional. Seconds before measuring, to load models and start pipelines",
+                        required=False, default=15, type=float)
+    parser.add_argument("--target_fps",
+                        help="Optional. Per-channel FPS a channel must sustain to be counted",
+                        required=False, default=15, type=float)
+    parser.add_argument("--pin_workers", action="store_true",
+                        help="Optional. Pin each analytics worker to its own group of cores.",
+                        required=False, default=False)
+
+
+def main():
+    """
+    Main Function
+    """
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    scale = subparsers.add_parser('scaling', help='Channels per node as analytics workers increase')
+    add_common_args(scale)
+    scale.add_argument("--channels",
+                       help="Optional. Channel counts to measure",
+                       required=False, default=[4, 8, 16], nargs='+', type=int)
+    scale.add_argument("--workers",
+                       help="Optional. Worker counts to measure",
+                       required=False, default=[1, 2, 4], nargs='+', type=int)
+    instance = subparsers.add_parser('model_instance',
+                                     help='Memory and throughput of shared versus per-channel inference instances')
+    add_common_args(instance)
+    instance.add_argument("--channels",
+                          help="Optional. Channel counts to measure",
+                          required=False, default=[9, 16], nargs='+', type=int)
+    instance.add_argument("--batch_size",
+                          help="Optional. Batch size of the shared instance",
+                          required=False, default=None, type=int)
+    instance.add_argument("--nireq",
+                          help="Optional. Number of inference requests of the shared instance",
+                          required=False, default=None, type=int)
+    budget = subparsers.add_parser('threads', help='Total FPS of planned thread budgets versus fixed thread counts')
+    add_common_args(budget)
+    budget.add_argument("--channels",
+                        help="Optional. Channel counts to measure",
+                        required=False, default=[4, 8, 16], nargs='+', type=int)
+    res = subparsers.add_parser('resolution',
+                                help='Detection FPS and accuracy at each inference resolution')
+    res.add_argument("-c", "--config_path",
+                     help="Path to camera config file, its file sources are used",
+                     required=True, type=str)
+    res.add_argument("-vp_model", "--vp_model",
+                     help="Path to model file",
+                     required=True, type=str)
+    res.add_argument("--resolutions",
+                     help="Optional. Inference resolutions to measure, as WIDTHxHEIGHT",
+                     required=False, default=['192x192', '320x320', '384x384', '512x512'], nargs='+', type=str)
+    res.add_argument("--frames",
+                     help="Optional. Frames read from each clip",
+                     required=False, default=100, type=int)
+    res.add_argument("--device",
+                     help="Optional. Inference device",
+                     required=False, default='CPU', type=str)
+    res.add_argument("--threshold",
+                     help="Optional. Confidence threshold of detections",
+                     required=False, default=0.5, type=float)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s :: %(message)s")
+    if args.command == 'scaling':
+        scaling(args)
+    elif args.command == 'model_instance':
+        model_instance(args)
+    elif args.command == 'threads':
+        threads(args)
+    elif args.command == 'resolution':
+        resolution(args)
+    else:
+        parser.print_help()
+        sys.exit(-1)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from multiprocessing import Array
+
+FIELDS = ['uptime', 'restarts', 'errors', 'fps', 'frames', 'first_frame', 'shed', 'keep', 'latency']
+
+
+class ChannelStatus:
+    """
+    Per-channel pipeline health in shared memory.
+    Written by the analytics process, read by the web process.
+    """
+    def __init__(self, num_ch):
+        self.num_ch = num_ch
+        self._status = Array('d', num_ch*len(FIELDS))
+
+    def update(self, ch_id, **fields):
+        """
+        Set given FIELDS of channel <ch_id>
+        """
+        base = ch_id*len(FIELDS)
+        with self._status.get_lock():
+            for key, value in fields.items():
+                self._status[base + FIELDS.index(key)] = value
+
+    def get(self):
+        """
+        Return status of all channels as a list of dicts
+        """
+        n = len(FIELDS)
+        with self._status.get_lock():
+            flat = self._status[:]
+        return [dict(zip(FIELDS, flat[i*n:(i+1)*n])) for i in range(self.num_ch)]
@@ -0,0 +1,151 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import time
+import json
+import logging
+from threading import Thread, Condition
+
+log = logging.getLogger(__name__)
+
+# Checkpoints are JSON of plain values since version 4, older (pickled) ones are ignored
+CHECKPOINT_VERSION = 4
+# Kept across restarts of the container, unlike /tmp
+CHECKPOINT_PATH = '/var/lib/itm/checkpoints'
+
+
+class Checkpoint:
+    """
+    Periodic on-disk checkpoints of per-channel tracking state and counters.
+    State is serialized in the frame callback (consistent, no locking of the
+    tracker) and written to disk by a background thread. Checkpoints hold
+    plain values only (counters, tracker ids, boxes and last positions) as
+    JSON, loading one never runs code from the file.
+    """
+    def __init__(self, path, interval=5, max_age=30):
+        """
+        :param path: Directory to store checkpoints
+        :param interval: Seconds between checkpoints of a channel
+        :param max_age: Trackers are restored only from checkpoints younger than <max_age> seconds,
+                        older checkpoints restore counters only
+        """
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self._last = {}
+        self._pending = {}
+        self._cond = Condition()
+        self.running = False
+
+    def __getstate__(self):
+        """
+        Pickle configuration only, the condition and writer thread are per process
+        """
+        state = self.__dict__.copy()
+        for key in ['_cond', 'th']:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cond = Condition()
+
+    def _file(self, ch_id):
+        return os.path.join(self.path, f'channel{ch_id}.json')
+
+    def maybe_save(self, ch_id, tracking_system, force=False):
+        """
+        Serialize state of <tracking_system> if the last checkpoint of <ch_id> is older than interval
+        """
+        now = time.monotonic()
+        if not force and now - self._last.get(ch_id, 0) < self.interval:
+            return False
+        self._last[ch_id] = now
+        state = tracking_system.get_state()
+        state['version'] = CHECKPOINT_VERSION
+        state['time'] = time.time()
+        data = json.dumps(state, separators=(',', ':')).encode()
+        with self._cond:
+            self._pending[ch_id] = data
+            self._cond.notify()
+        return True
+
+    def load(self, ch_id, cam_config):
+        """
+        Return checkpointed state of <ch_id>, or None if there is no valid checkpoint
+        for the same camera.
+        """
+        try:
+            with open(self._file(ch_id), 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            log.warning(f'Ignoring unreadable checkpoint of channel {ch_id}: {err}')
+            return None
+        if not isinstance(state, dict) or state.get('version') != CHECKPOINT_VERSION or \
+           state.get('address') != cam_config.get('address') or state.get('path') != cam_config.get('path'):
+            log.info(f'Ignoring checkpoint of channel {ch_id}, camera config changed.')
+            return None
+        if time.time() - state['time'] > self.max_age:
+            state['trackers'] = []
+        return state
+
+    def start(self):
+        """
+        Start Thread, return False if the checkpoint directory can't be created
+        """
+        try:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+        except OSError as err:
+            log.error(f'Failed to create checkpoint directory {self.path}, running without checkpoints: {err}')
+            return False
+        self.th = Thread(target=self.write, args=())
+        self.running = True
+        self.th.daemon = True
+        self.th.start()
+        return True
+
+    def stop(self):
+        """
+        Stop Thread, pending checkpoints are written before returning
+        """
+        with self._cond:
+            self.running = False
+            self._cond.notify()
+        self.th.join()
+
+    def write(self):
+        """
+        Write pending checkpoints to disk atomically
+        """
+        while True:
+            with self._cond:
+                while self.running and not self._pending:
+                    self._cond.wait()
+                pending, self._pending = self._pending, {}
+                running = self.running
+            for ch_id, data in pending.items():
+                tmp = self._file(ch_id) + '.tmp'
+                try:
+                    with open(tmp, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp, self._file(ch_id))
+                except OSError as err:
+                    log.error(f'Failed to write checkpoint of channel {ch_id}: {err}')
+            if not running:
+                break
@@ -0,0 +1,147 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+from threading import Thread
+from multiprocessing import Lock, RawArray
+import numpy as np
+from live_counts import METRICS, read_counts
+
+# (bucket length in seconds, number of buckets)
+RESOLUTIONS = [(1, 3600), (60, 1440)]
+
+
+class CountHistory:
+    """
+    Per-channel count increments in time buckets, kept in shared memory ring buffers:
+    1 s buckets over the last hour and 1 min buckets over the last 24 hours.
+    Written by the analytics process, queried by the web process.
+    """
+    # Buckets returned by a query at most, the step is raised to stay below
+    MAX_BUCKETS = 3600
+
+    def __init__(self, num_ch):
+        self.num_ch = num_ch
+        n = len(METRICS)
+        self._lock = Lock()
+        self._stamps = [RawArray('q', num_ch*slots) for _, slots in RESOLUTIONS]
+        self._values = [RawArray('i', num_ch*slots*n) for _, slots in RESOLUTIONS]
+        self._last = RawArray('q', num_ch*n)
+        self._views = None
+        self.running = False
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_views'] = None
+        state.pop('th', None)
+        return state
+
+    def _get_views(self):
+        """
+        Return numpy views (stamps, values) per resolution and last counts
+        """
+        if self._views is None:
+            n = len(METRICS)
+            stamps = [np.frombuffer(raw, dtype=np.int64).reshape(self.num_ch, slots)
+                      for raw, (_, slots) in zip(self._stamps, RESOLUTIONS)]
+            values = [np.frombuffer(raw, dtype=np.int32).reshape(self.num_ch, slots, n)
+                      for raw, (_, slots) in zip(self._values, RESOLUTIONS)]
+            last = np.frombuffer(self._last, dtype=np.int64).reshape(self.num_ch, n)
+            self._views = (stamps, values, last)
+        return self._views
+
+    def record(self, ch_id, counts, t=None):
+        """
+        Record cumulative <counts> of channel <ch_id> (ordered as METRICS) at time <t>.
+        The increment since the previous call is added to the current buckets.
+        """
+        t = time.time() if t is None else t
+        stamps, values, last = self._get_views()
+        counts = np.asarray(counts, dtype=np.int64)
+        with self._lock:
+            delta = np.clip(counts - last[ch_id], 0, None)
+            last[ch_id] = counts
+            for i, (res, slots) in enumerate(RESOLUTIONS):
+                bucket = int(t // res)
+                slot = bucket % slots
+                if stamps[i][ch_id, slot] != bucket:
+                    stamps[i][ch_id, slot] = bucket
+                    values[i][ch_id, slot] = 0
+                values[i][ch_id, slot] += delta.astype(np.int32)
+
+    def clamp(self, t_from, t_to, now=None):
+        """
+        Return <t_from>, <t_to> limited to the retained window, the last 24 hours up to now
+        """
+        now = time.time() if now is None else now
+        res, slots = RESOLUTIONS[-1]
+        return max(t_from, now - res*slots), min(t_to, now)
+
+    def query(self, ch_id, t_from, t_to, step=None):
+        """
+        Return (step, buckets) for channel <ch_id> between <t_from> and <t_to> (epoch seconds).
+        buckets is a list of [start time, counts...] with counts ordered as METRICS.
+        The range is clamped to the retained window and the finest resolution covering
+        <t_from> is used. <step> is rounded up to it and raised so that at most MAX_BUCKETS
+        buckets are returned, buckets start at multiples of <step>.
+        """
+        now = time.time()
+        t_from, t_to = self.clamp(t_from, t_to, now)
+        stamps, values, _ = self._get_views()
+        for i, (res, slots) in enumerate(RESOLUTIONS):
+            if t_from >= now - res*slots:
+                break
+        step = max(step or res, (t_to - t_from) / (CountHistory.MAX_BUCKETS - 1), res)
+        step = int(-(-min(step, res*slots) // res) * res)
+        group = step // res
+        # Whole steps covering the range, in buckets of the resolution
+        first, last = int(t_from // step) * group, int(t_to // step) * group + group - 1
+        if t_to < t_from:
+            return step, []
+        buckets = np.arange(first, last + 1)
+        idx = buckets % slots
+        with self._lock:
+            valid = stamps[i][ch_id, idx] == buckets
+            vals = np.where(valid[:, None], values[i][ch_id, idx], 0)
+        vals = vals.reshape(-1, group, len(METRICS)).sum(axis=1)
+        starts = (first + np.arange(len(vals))*group) * res
+        return step, [[int(st)] + row.tolist() for st, row in zip(starts, vals)]
+
+    def start(self, influx_client):
+        """
+        Start Thread recording counts held by <influx_client> (tracker.InfluxDB) every second
+        """
+        self.th = Thread(target=self.update, args=(influx_client,))
+        self.running = True
+        self.th.daemon = True
+        self.th.start()
+
+    def stop(self):
+        """
+        Stop Thread
+        """
+        self.running = False
+        self.th.join()
+
+    def update(self, influx_client):
+        """
+        Record counts of the channels held by <influx_client> every second
+        """
+        while self.running:
+            time.sleep(1)
+            t = time.time()
+            for ch_id in influx_client.channels:
+                self.record(ch_id, read_counts(influx_client, ch_id), t)
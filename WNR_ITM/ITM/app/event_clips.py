@@ -0,0 +1,212 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import time
+import logging
+import collections
+from queue import Queue, Empty, Full
+from threading import Thread, Lock
+import cv2
+
+log = logging.getLogger(__name__)
+
+
+class ClipRecorder:
+    """
+    Pre/post-event clips of collisions. Each channel keeps a ring of JPEG frames
+    of the last <pre> seconds, bounded in bytes. On an event the ring and the
+    frames of the following <post> seconds are written as one MJPEG file.
+    Frames are encoded and clips written by background threads, the frame
+    callback only copies a frame at the clip frame rate.
+    """
+    # Raw frames waiting for encoding, frames are skipped while it is full
+    FRAME_QUEUE = 8
+    # Seconds between checks of the encoder thread for stop
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, path, pre=5, post=5, max_bytes=8*1024*1024, fps=5, quality=80):
+        """
+        :param path: Directory to write clips to
+        :param pre: Seconds before the event kept in the ring
+        :param post: Seconds after the event added to the clip
+        :param max_bytes: Bytes of JPEG frames held per channel by the ring, and by the clip being recorded
+        :param fps: Frames per second kept in the ring
+        :param quality: JPEG quality of the frames
+        """
+        self.path = path
+        self.pre = pre
+        self.post = post
+        self.max_bytes = max_bytes
+        self.interval = 1/fps
+        self.quality = quality
+        self._init_state()
+        self.running = False
+
+    def _init_state(self):
+        self._lock = Lock()
+        self._frames = Queue(maxsize=ClipRecorder.FRAME_QUEUE)
+        self._clips = Queue()
+        # Per channel: last frame timestamp, time of the last kept frame, ring and its size, clip being recorded
+        self._last = {}
+        self._kept = {}
+        self._ring = {}
+        self._ring_bytes = {}
+        self._active = {}
+
+    def __getstate__(self):
+        """
+        Pickle configuration only, buffers and threads are per process
+        """
+        state = {key: value for key, value in self.__dict__.items() if not key.startswith('_')}
+        state.pop('th_encode', None)
+        state.pop('th_write', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+    def due(self, ch_id, timestamp):
+        """
+        Return True if the frame of <ch_id> at <timestamp> seconds is to be added to the ring
+        """
+        self._last[ch_id] = timestamp
+        # Timestamps going back (looped file, restarted pipeline) start over
+        if 0 <= timestamp - self._kept.get(ch_id, -self.interval) < self.interval or self._frames.full():
+            return False
+        self._kept[ch_id] = timestamp
+        return True
+
+    def add_frame(self, ch_id, timestamp, mat):
+        """
+        Queue a copy of frame <mat> of <ch_id> for encoding, dropped if the encoder is behind
+        """
+        try:
+            self._frames.put_nowait((ch_id, timestamp, mat.copy()))
+        except Full:
+            pass
+
+    def trigger(self, ch_id):
+        """
+        Start a clip of <ch_id> around its current frame and return its path.
+        An event while a clip of the channel is recorded extends that clip.
+        """
+        timestamp = self._last.get(ch_id)
+        if timestamp is None:
+            return None
+        with self._lock:
+            clip = self._active.get(ch_id)
+            if clip is None:
+                name = time.strftime('%Y%m%d-%H%M%S', time.localtime()) + f'-{int(time.time()*1000) % 1000:03d}'
+                frames = list(self._ring.get(ch_id, []))
+                clip = {'path': os.path.join(self.path, f'channel{ch_id}-{name}.mjpeg'),
+                        'frames': [jpeg for _, jpeg in frames], 'bytes': sum(len(jpeg) for _, jpeg in frames)}
+                self._active[ch_id] = clip
+            clip['end'] = timestamp + self.post
+        return clip['path']
+
+    def reset(self, ch_id):
+        """
+        Drop the ring of <ch_id> and write its clip being recorded, called when the channel is stopped
+        """
+        with self._lock:
+            self._ring.pop(ch_id, None)
+            self._ring_bytes.pop(ch_id, None)
+            self._last.pop(ch_id, None)
+            self._kept.pop(ch_id, None)
+            clip = self._active.pop(ch_id, None)
+        if clip is not None:
+            self._clips.put(clip)
+
+    def start(self):
+        """
+        Start Threads
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self.running = True
+        self.th_encode = Thread(target=self.encode, args=())
+        self.th_encode.daemon = True
+        self.th_encode.start()
+        self.th_write = Thread(target=self.write, args=())
+        self.th_write.daemon = True
+        self.th_write.start()
+
+    def stop(self):
+        """
+        Stop Threads, clips being recorded are written before returning
+        """
+        self.running = False
+        self.th_encode.join()
+        with self._lock:
+            active, self._active = self._active, {}
+        for clip in active.values():
+            self._clips.put(clip)
+        # Written after all clips, ends the writer
+        self._clips.put(None)
+        self.th_write.join()
+
+    def encode(self):
+        """
+        Encode queued frames, add them to the ring and the clips being recorded
+        """
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), self.quality]
+        while self.running:
+            try:
+                ch_id, timestamp, mat = self._frames.get(timeout=ClipRecorder.POLL_INTERVAL)
+            except Empty:
+                continue
+            ok, jpeg = cv2.imencode('.jpg', mat, params)
+            if not ok:
+                continue
+            jpeg = jpeg.tobytes()
+            with self._lock:
+                ring = self._ring.setdefault(ch_id, collections.deque())
+                size = self._ring_bytes.get(ch_id, 0)
+                if ring and timestamp < ring[-1][0]:
+                    ring.clear()
+                    size = 0
+                ring.append((timestamp, jpeg))
+                size += len(jpeg)
+                while ring and (size > self.max_bytes or ring[0][0] < timestamp - self.pre):
+                    size -= len(ring.popleft()[1])
+                self._ring_bytes[ch_id] = size
+                clip = self._active.get(ch_id)
+                if clip is None:
+                    continue
+                if clip['bytes'] + len(jpeg) <= self.max_bytes:
+                    clip['frames'].append(jpeg)
+                    clip['bytes'] += len(jpeg)
+                if timestamp >= clip['end'] or timestamp < clip['end'] - self.post - self.pre:
+                    self._clips.put(self._active.pop(ch_id))
+
+    def write(self):
+        """
+        Write finished clips to disk
+        """
+        while True:
+            clip = self._clips.get()
+            if clip is None:
+                break
+            tmp = clip['path'] + '.tmp'
+            try:
+                with open(tmp, 'wb') as f:
+                    for jpeg in clip['frames']:
+                        f.write(jpeg)
+                os.replace(tmp, clip['path'])
+                log.info(f'Event clip written: {clip["path"]}')
+            except OSError as err:
+                log.error(f'Failed to write event clip {clip["path"]}: {err}')
@@ -0,0 +1,145 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from queue import Empty, Full
+from multiprocessing import Queue, Value
+
+POLICY_LATEST = 'latest'
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICIES = [POLICY_LATEST, POLICY_DROP_OLDEST]
+
+
+class FrameSlot:
+    """
+    Bounded interprocess delivery slot for the frames of one channel.
+    The producer never blocks: when the slot is full the oldest frame is
+    dropped, so memory stays constant however slow the consumer is.
+        latest      - keep only the newest frame (depth 1)
+        drop_oldest - keep the newest <depth> frames
+    """
+    def __init__(self, policy=POLICY_LATEST, depth=1):
+        if policy not in POLICIES:
+            raise ValueError(f'Invalid frame policy `{policy}`. '
+                             f'Possible values are - {" ".join(POLICIES)}')
+        if depth < 1:
+            raise ValueError(f'Invalid frame depth `{depth}`. Depth must be at least 1.')
+        self.policy = policy
+        self.depth = 1 if policy == POLICY_LATEST else depth
+        self._queue = Queue(maxsize=self.depth)
+        self._dropped = Value('L', 0)
+        self._delivered = Value('L', 0)
+        self._viewers = Value('i', 0)
+
+    @property
+    def dropped(self):
+        """
+        Number of frames dropped because the consumer was too slow
+        """
+        return self._dropped.value
+
+    @property
+    def delivered(self):
+        """
+        Number of frames handed over to the consumer
+        """
+        return self._delivered.value
+
+    @property
+    def viewers(self):
+        """
+        Number of consumers attached to the slot
+        """
+        return self._viewers.value
+
+    def attach(self):
+        """
+        Register a consumer, the producer fills the slot only while it has consumers
+        """
+        with self._viewers.get_lock():
+            self._viewers.value += 1
+
+    def detach(self):
+        """
+        Unregister a consumer, pending items are discarded when the last one leaves
+        """
+        with self._viewers.get_lock():
+            self._viewers.value = max(0, self._viewers.value - 1)
+            idle = self._viewers.value == 0
+        if idle:
+            self.clear()
+
+    def put(self, item):
+        """
+        Put <item> in the slot, dropping the oldest item if the slot is full.
+        Never waits, it is called from the frame callback: if the oldest item is
+        still in flight in the feeder thread, <item> is dropped instead.
+        <item> is pickled later by the feeder thread, it must not reference
+        memory released after the call, e.g. a mapped GstBuffer.
+        """
+        try:
+            self._queue.put_nowait(item)
+            return
+        except Full:
+            pass
+        try:
+            _ = self._queue.get_nowait()
+            self._queue.put_nowait(item)
+        except (Empty, Full):
+            pass
+        with self._dropped.get_lock():
+            self._dropped.value += 1
+
+    def get(self, timeout=None):
+        """
+        Get the oldest item from the slot.
+        Raise queue.Empty if nothing arrives within <timeout> seconds.
+        """
+        item = self._queue.get(timeout=timeout)
+        with self._delivered.get_lock():
+            self._delivered.value += 1
+        return item
+
+    def latest(self):
+        """
+        Return the newest pending item without waiting, older ones are discarded.
+        Return None if the slot is empty.
+        """
+        item = None
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except Empty:
+                break
+        if item is not None:
+            with self._delivered.get_lock():
+                self._delivered.value += 1
+        return item
+
+    def empty(self):
+        """
+        Return True if the slot is empty
+        """
+        return self._queue.empty()
+
+    def clear(self):
+        """
+        Discard all pending items
+        """
+        while True:
+            try:
+                _ = self._queue.get_nowait()
+            except Empty:
+                break
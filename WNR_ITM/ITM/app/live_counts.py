@@ -0,0 +1,90 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+from threading import Thread
+from multiprocessing import Array
+
+METRICS = ['people', 'vehicle', 'bicycle', 'near_miss', 'collision']
+
+
+def read_counts(influx_client, ch_id):
+    """
+    Return cumulative counts of channel <ch_id> held by <influx_client> (tracker.InfluxDB),
+    ordered as METRICS
+    """
+    data = influx_client.data[ch_id] or [0, 0, 0]
+    return list(data) + [influx_client.near_miss_count[ch_id],
+                         influx_client.collision_count[ch_id]]
+
+
+class LiveCounts:
+    """
+    Per-channel cumulative counts in shared memory.
+    Written by the analytics process, read by the web process without
+    touching InfluxDB.
+    """
+    def __init__(self, num_ch, interval=1000):
+        """
+        :param num_ch: Number of channels
+        :param interval: Publish interval in milliseconds
+        """
+        self.num_ch = num_ch
+        self.interval = interval
+        self._counts = Array('q', num_ch*len(METRICS))
+        self.running = False
+
+    def update(self, ch_id, counts):
+        """
+        Set counts of channel <ch_id>, ordered as METRICS
+        """
+        base = ch_id*len(METRICS)
+        with self._counts.get_lock():
+            self._counts[base:base+len(METRICS)] = counts
+
+    def get(self):
+        """
+        Return counts of all channels as a list of lists ordered as METRICS
+        """
+        n = len(METRICS)
+        with self._counts.get_lock():
+            flat = self._counts[:]
+        return [flat[i*n:(i+1)*n] for i in range(self.num_ch)]
+
+    def start(self, influx_client):
+        """
+        Start Thread publishing counts held by <influx_client> (tracker.InfluxDB)
+        """
+        self.th = Thread(target=self.publish, args=(influx_client,))
+        self.running = True
+        self.th.daemon = True
+        self.th.start()
+
+    def stop(self):
+        """
+        Stop Thread
+        """
+        self.running = False
+        self.th.join()
+
+    def publish(self, influx_client):
+        """
+        Copy counts of the channels held by <influx_client> to shared memory every <interval> ms
+        """
+        while self.running:
+            time.sleep(self.interval/1000)
+            for ch_id in influx_client.channels:
+                self.update(ch_id, read_counts(influx_client, ch_id))
@@ -0,0 +1,81 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+import cv2
+
+# Crops are grown by this fraction of their size, objects crossing the zone border are fully seen
+CROP_MARGIN = 0.1
+
+
+def to_pixels(polygons, width, height):
+    """
+    Return <polygons> given in coordinates relative to the frame as int32 pixel arrays
+    """
+    return [np.array([[round(x*(width - 1)), round(y*(height - 1))] for x, y in polygon], np.int32)
+            for polygon in polygons]
+
+
+def crop_rects(polygons, width, height):
+    """
+    Return list of (x, y, w, h) pixel rectangles to run inference on: bounding
+    boxes of <polygons> with margin, overlapping boxes merged so no area is inferred twice.
+    """
+    rects = []
+    for polygon in to_pixels(polygons, width, height):
+        x, y, w, h = cv2.boundingRect(polygon)
+        dx, dy = int(w*CROP_MARGIN/2), int(h*CROP_MARGIN/2)
+        rects.append([max(0, x - dx), max(0, y - dy), min(width, x + w + dx), min(height, y + h + dy)])
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                a, b = rects[i], rects[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rects[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [(x1, y1, x2 - x1, y2 - y1) for x1, y1, x2, y2 in rects]
+
+
+class RoiMask:
+    """
+    Region of interest of one camera: raster mask for constant time
+    point-in-zone lookups in the frame callback and the crops inference runs on
+    """
+    def __init__(self, polygons, width, height):
+        """
+        :param polygons: List of polygons, each a list of [x, y] points relative to the frame (0 to 1)
+        """
+        self.polygons = polygons
+        self.width = width
+        self.height = height
+        self.mask = np.zeros((height, width), np.uint8)
+        cv2.fillPoly(self.mask, to_pixels(polygons, width, height), 1)
+        self.crops = crop_rects(polygons, width, height)
+
+    def contains(self, boxes):
+        """
+        Return boolean array, True for each of the (N, 4) x, y, w, h <boxes> whose
+        bottom centre, where the object touches the ground, is in the zone
+        """
+        x = np.clip((boxes[:, 0] + boxes[:, 2]/2).astype(np.int32), 0, self.width - 1)
+        y = np.clip((boxes[:, 1] + boxes[:, 3]).astype(np.int32), 0, self.height - 1)
+        return self.mask[y, x].astype(bool)
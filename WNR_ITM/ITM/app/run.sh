@@ -13,8 +13,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# Set AUTOTUNE=1 to benchmark the precisions of $MODEL_NAME and inference settings on
+# first start, results are cached in /tmp.
+
+# In a StatefulSet the shard index is the ordinal suffix of the pod name
+if [ "${SHARD_COUNT:-1}" -gt 1 ] && [ -z "$SHARD_INDEX" ]; then
+	SHARD_INDEX=${HOSTNAME##*-}
+fi
+
 source /opt/intel/openvino/bin/setupvars.sh && \
 	export MODEL_NAME=$(cat /models.lst | cut -d' ' -f1) && \
-	python3 server.py -c camera_config.json \
+	python3 server.py -c ${CONFIG_PATH:-camera_config.json} \
 	--vp_model /intel/$MODEL_NAME/FP16/$MODEL_NAME.xml \
-	--vp_proc resources/model_proc.json
+	--vp_proc resources/model_proc.json \
+	--shard_index ${SHARD_INDEX:-0} --shard_count ${SHARD_COUNT:-1} \
+	${PEERS:+--peers $PEERS} ${PEER_CA:+--peer_ca $PEER_CA} ${PEER_INSECURE:+--peer_insecure} \
+	${AUTOTUNE:+--autotune}
@@ -0,0 +1,130 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+# Priority of cameras without `priority` in the config
+DEFAULT_PRIORITY = 5
+
+
+class Scheduler:
+    """
+    Frame budget of the channels of one analytics process.
+    All frames are kept until the latency from inference input to the end of the
+    frame callback goes over target. Then the budget of all channels shrinks, and
+    is shared by the channels weighted by priority and activity. Frames over budget
+    are shed before inference, so the inference queue does not grow when the node
+    is saturated.
+    """
+    # Smallest share of frames kept for any channel
+    MIN_KEEP = 0.1
+    # Weights of channels without trackers, with trackers or a viewer, and after a near miss or collision
+    IDLE_WEIGHT = 0.5
+    ACTIVE_WEIGHT = 1
+    BUSY_WEIGHT = 2
+    # Seconds a channel stays busy after a near miss or collision
+    BUSY_TIME = 30
+    # Smoothing of the latency average
+    EMA = 0.2
+    # Frames in flight tracked per channel, more are a sign of lost buffers
+    MAX_IN_FLIGHT = 64
+
+    def __init__(self, capacity, latency_target):
+        """
+        :param capacity: Number of channel slots
+        :param latency_target: Seconds from inference input to the end of the frame callback
+        """
+        self.latency_target = latency_target
+        self.scale = 1.0
+        self.keep = [1.0]*capacity
+        self.credit = [0.0]*capacity
+        self.shed = [0]*capacity
+        self.latency = [0.0]*capacity
+        self.events = [None]*capacity
+        self.busy_until = [0]*capacity
+        self.in_flight = [{} for _ in range(capacity)]
+
+    def admit(self, ch_id, pts=None):
+        """
+        Return True if the frame of <ch_id> with timestamp <pts> is processed, False if it is shed.
+        Kept frames are evenly spaced.
+        """
+        self.credit[ch_id] = min(1.0, self.credit[ch_id]) + self.keep[ch_id]
+        if self.credit[ch_id] < 1:
+            self.shed[ch_id] += 1
+            return False
+        self.credit[ch_id] -= 1
+        if pts is not None:
+            in_flight = self.in_flight[ch_id]
+            if len(in_flight) >= Scheduler.MAX_IN_FLIGHT:
+                in_flight.clear()
+            in_flight[pts] = time.monotonic()
+        return True
+
+    def done(self, ch_id, pts=None):
+        """
+        Record the end of processing of the frame of <ch_id> with timestamp <pts>
+        """
+        start = self.in_flight[ch_id].pop(pts, None)
+        if start is not None:
+            self.latency[ch_id] += Scheduler.EMA*(time.monotonic() - start - self.latency[ch_id])
+
+    def reset(self, ch_id):
+        """
+        Forget state of channel <ch_id>, called when it is stopped
+        """
+        self.keep[ch_id], self.credit[ch_id], self.shed[ch_id] = 1.0, 0.0, 0
+        self.latency[ch_id], self.events[ch_id], self.busy_until[ch_id] = 0.0, None, 0
+        self.in_flight[ch_id].clear()
+
+    def replan(self, activity):
+        """
+        Update share of frames kept for each channel, called periodically.
+        :param activity: Dict of channel id to (priority, number of trackers, near misses + collisions, watched)
+                         of the running channels
+        """
+        if not activity:
+            return
+        now = time.monotonic()
+        latency = sum(self.latency[ch_id] for ch_id in activity)/len(activity)
+        if latency > self.latency_target:
+            if self.scale == 1.0:
+                log.warning(f'Analytics saturated, latency {latency*1000:.0f} ms. Shedding frames.')
+            self.scale = max(Scheduler.MIN_KEEP, self.scale*0.8)
+        elif latency < self.latency_target/2:
+            self.scale = min(1.0, self.scale + 0.05)
+        weights = {}
+        for ch_id, (priority, trackers, events, watched) in activity.items():
+            if self.events[ch_id] is not None and events != self.events[ch_id]:
+                self.busy_until[ch_id] = now + Scheduler.BUSY_TIME
+            self.events[ch_id] = events
+            if now < self.busy_until[ch_id]:
+                weight = Scheduler.BUSY_WEIGHT
+            elif trackers or watched:
+                weight = Scheduler.ACTIVE_WEIGHT
+            else:
+                weight = Scheduler.IDLE_WEIGHT
+            weights[ch_id] = weight*priority/DEFAULT_PRIORITY
+        # Weights only share out the budget of a saturated node, relative to their mean
+        mean = sum(weights.values())/len(weights)
+        for ch_id, weight in weights.items():
+            if self.scale >= 1.0:
+                self.keep[ch_id] = 1.0
+            else:
+                self.keep[ch_id] = min(1.0, max(Scheduler.MIN_KEEP, self.scale*weight/mean))
@@ -21,16 +21,27 @@ import time
 import json
 import logging
 import re
+import zlib
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+from queue import Empty
 from argparse import ArgumentParser
-from multiprocessing import Process, Manager, SimpleQueue, Lock
-from flask import Flask, Response, jsonify, render_template, make_response
-from openvino.inference_engine import IECore
+from multiprocessing import Process, Manager, Queue
+from flask import Flask, Response, jsonify, render_template, make_response, request
 import requests
-import influxdb
-import numpy as np
-import cv2
-import smartcity
+import urllib3
+from urllib.parse import urlsplit, urlunsplit
 import validate_config
+import analytics
+import yolo_labels
+from frame_slot import FrameSlot, POLICIES, POLICY_LATEST
+from live_counts import LiveCounts, METRICS
+from count_history import CountHistory
+from checkpoint import Checkpoint, CHECKPOINT_PATH
+from channel_status import ChannelStatus
+from startup_timing import StartupTimer
 
 app = Flask(__name__)
 log = logging.getLogger(__name__)
@@ -50,43 +61,96 @@ JS_CDN_INTEGRITY = "sha384-RffttofZaGGmE3uVvQmIW/dh1bzuHAJtWkxFyjRkb7eaUWfHo3W3G
 MAP_CSS_CDN = "https://cdn.jsdelivr.net/gh/openlayers/openlayers.github.io@master/en/v6.4.3/css/ol.css"
 
 FPS = 20
+STREAM_TIMEOUT = 40
+SNAPSHOT_INTERVAL = 1000
+SNAPSHOT_LEASE = 10
+SNAPSHOT_SIZE = 320
+LIVE_INTERVAL = 1000
+LIVE_KEEPALIVE = 15
 NUM_CH = 1
 RUNNING = []
-MUTEX = Lock()
+MUTEX = threading.Lock()
 CONFIG_PATH = None
 CONF_DATA, URL_DATA = {}, {}
 Q_DATA = {}
+META_DATA = None
 CURRENT_FRAMES = []
+SNAPSHOTS = {}
+SNAPSHOT_LOCKS = {}
+SNAPSHOT_LEASES = {}
+GRAFANA_SNAPSHOT = False
+LIVE_COUNTS = None
+HISTORY = None
+CHANNEL_STATUS = None
+CONTROL = None
+GRAFANA = None
+MAX_CH = 1
+RELOAD_LOCK = threading.Lock()
+# Partitioning of channels over nodes
+SHARD_INDEX = 0
+SHARD_COUNT = 1
+SHARD_CAMERAS = None
+PEERS = []
+PEER_OWNERS = {}
+PEER_TIMEOUT = 3
+PEER_HEADER = 'X-ITM-Shard'
+# TLS verification of the other nodes: True (system CAs), path of a CA bundle or False (--peer_insecure)
+PEER_VERIFY = True
+LOCAL_CHANNELS = []
+PROBE_TIMEOUT = 10
+# Devices found by OpenVINO, queried once in a child process
+AVAILABLE_DEVICES = None
+STARTUP = StartupTimer()
 
 class GrafanaConnect:
     """
     Class to communicate with grafana server
     """
-    def __init__(self, grafana_url, map_server_url, influxdb_url, user, password):
+    # Dashboards uploaded at the same time
+    PARALLEL_UPLOADS = 4
+    # Readiness probe backoff in seconds and total wait
+    MIN_BACKOFF = 0.1
+    MAX_BACKOFF = 5
+    READY_TIMEOUT = 100
+    HASH_TAG = 'itm-hash-'
+    # Panel type embedding the map and the channel video
+    EMBED_PANEL = 'ryantxu-ajax-panel'
+    # Width of the snapshots embedded in channel dashboards
+    SNAPSHOT_WIDTH = 640
+
+    def __init__(self, grafana_url, map_server_url, influxdb_url, user, password, snapshot=False):
         """
         Init function
+        :param snapshot: Optional. Embed refreshed snapshots in channel dashboards instead of the live stream
         """
+        self.snapshot = snapshot
         self.grafana_url = grafana_url
         self.map_server_url = map_server_url
         self.influxdb_url = influxdb_url
         self.datasource_url = os.path.join(self.grafana_url, 'api/datasources')
         self.dashboard_url = os.path.join(self.grafana_url, 'api/dashboards/db')
         self.datasource_search_url = os.path.join(self.grafana_url, 'api/search')
-        self.auth = requests.auth.HTTPBasicAuth(user, password)
-        self.headers = {
+        self.channel_uids = {}
+        # uid -> (content hash, url) of the dashboards held by grafana
+        self.existing = {}
+        self.templates = {}
+        self.session = requests.Session()
+        self.session.auth = requests.auth.HTTPBasicAuth(user, password)
+        self.session.headers.update({
             'Accept': 'application/json',
             'Content-Type': 'application/json',
             'Cache-Control': 'no-cache'
-        }
+        })
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=GrafanaConnect.PARALLEL_UPLOADS)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def _post(self, url, json_data):
         """
         Post data to grafana server
         """
         try:
-            r = requests.post(url, auth=self.auth,
-                              headers=self.headers,
-                              json=json_data)
+            r = self.session.post(url, json=json_data)
             return r
         except Exception as err:
             log.error(f'Error: {err}')
@@ -97,17 +161,25 @@ class GrafanaConnect:
         Get data from grafana server
         """
         try:
-            r = requests.get(url, auth=self.auth, headers=self.headers, timeout=timeout)
+            r = self.session.get(url, timeout=timeout)
             return r
         except Exception as err:
             return -1
 
+    def _template(self, template_path):
+        """
+        Return content of <template_path>, read once
+        """
+        if template_path not in self.templates:
+            with open(template_path, 'r') as f:
+                self.templates[template_path] = f.read()
+        return self.templates[template_path]
+
     def create_datasource(self, template_path):
         """
         Add/Update datasource
         """
-        with open(template_path, 'r') as f:
-            json_data = json.loads(f.read())
+        json_data = json.loads(self._template(template_path))
         json_data["url"] = self.influxdb_url
         r = self._post(self.datasource_url, json_data=json_data)
         if r == -1:
@@ -127,109 +199,269 @@ class GrafanaConnect:
                 log.warning('Failed to add datasource')
         return res
 
-    def add_dashboard(self, json_data, url=None):
+    def load_existing(self):
         """
-        Add/Update dashboard
+        Read uid, content hash and url of the ITM dashboards held by grafana with one search
         """
-        if url:
-            json_data['dashboard']['panels'][1]['url'] = self.map_server_url + url
-        else:
-            json_data['dashboard']['panels'][1]['url'] = self.map_server_url + '/dashboard'
+        r = self._get(self.datasource_search_url + '?type=dash-db&limit=5000', timeout=10)
+        if r == -1 or r.status_code != 200:
+            log.warning(f'Unable to list dashboards, all dashboards are uploaded. Message: {r}')
+            return
+        for dashboard in r.json():
+            content_hash = next((tag[len(GrafanaConnect.HASH_TAG):] for tag in dashboard.get('tags', [])
+                                 if tag.startswith(GrafanaConnect.HASH_TAG)), None)
+            if content_hash:
+                self.existing[dashboard['uid']] = (content_hash, dashboard['url'])
+
+    @staticmethod
+    def _embed(json_data, url):
+        """
+        Point the ajax (iframe) panel of dashboard <json_data> to <url>, other panels are left as is
+        """
+        for panel in json_data['dashboard']['panels']:
+            if panel.get('type') == GrafanaConnect.EMBED_PANEL:
+                panel['url'] = url
+                panel['method'] = 'iframe'
+                return True
+        log.error(f'Dashboard {json_data["dashboard"].get("title")} has no {GrafanaConnect.EMBED_PANEL} panel')
+        return False
+
+    def add_dashboard(self, json_data, uid='itm-main'):
+        """
+        Add/Update dashboard <uid>. Upload is skipped if grafana holds the same content.
+        Return dict with uid and url of the dashboard, None if the upload failed.
+        """
+        json_data['dashboard']['uid'] = uid
+        content_hash = hashlib.sha1(json.dumps(json_data, sort_keys=True).encode()).hexdigest()[:16]
+        existing = self.existing.get(uid)
+        if existing and existing[0] == content_hash:
+            log.info(f'Dashboard {uid} is up to date')
+            return {'uid': uid, 'url': existing[1]}
+        json_data['dashboard']['tags'] = json_data['dashboard'].get('tags', []) + \
+                                         [GrafanaConnect.HASH_TAG + content_hash]
         r = self._post(self.dashboard_url, json_data=json_data)
+        if r == -1:
+            log.error(f'Error in updating dashboard {uid}, grafana is not reachable.')
+            return None
         try:
             res = r.json()
             log.info(f'Successfully added dashboard {res["id"]}')
-        except:
-            log.error(f'Error in updating dashboard. Message: {r}')
+            self.existing[uid] = (content_hash, res['url'])
+        except (ValueError, KeyError, TypeError):
+            log.error(f'Error in updating dashboard {uid}. Message: {r} {r.text}')
+            return None
         return res
 
-    def add_channel_dashbords(self, template_path, camera_conf):
+    def _delete(self, url):
         """
-        Add/Update dashboards for each channel
+        Delete data from grafana server
         """
-        url_data = {}
-        with open(template_path, 'r') as f:
-            str_data = f.read()
-        for i in range(0, NUM_CH):
-            st = re.sub("channel0", f'channel{i}', str_data)
-            final_data = json.loads(st)
-            final_data['dashboard']['title'] = f'ITM - {camera_conf["cameras"][i]["address"]}'
-            final_data['dashboard']['panels'][2]['url'] = self.map_server_url + f'/camera/{i}'
-            final_data['dashboard']['panels'][2]['method'] = "iframe"
-            res = self.add_dashboard(final_data, f'/camera/{i}')
-            url_data[i] = GRAFANA_EXTERNAL_URL + res['url']
-        return url_data
+        try:
+            r = self.session.delete(url)
+            return r
+        except Exception as err:
+            log.error(f'Error: {err}')
+            return -1
+
+    def add_channel_dashboard(self, template_path, ch_id, cam_conf):
+        """
+        Add/Update dashboard of channel <ch_id>
+        """
+        st = re.sub("channel0", f'channel{ch_id}', self._template(template_path))
+        final_data = json.loads(st)
+        final_data['dashboard']['title'] = f'ITM - {cam_conf["address"]}'
+        if self.snapshot:
+            url = f'/camera/{ch_id}/snapshot.jpg?size={GrafanaConnect.SNAPSHOT_WIDTH}'
+        else:
+            url = f'/camera/{ch_id}'
+        self._embed(final_data, self.map_server_url + url)
+        res = self.add_dashboard(final_data, f'itm-channel{ch_id}')
+        if res is None:
+            return None
+        self.channel_uids[ch_id] = res.get('uid')
+        return GRAFANA_EXTERNAL_URL + res['url']
+
+    def delete_channel_dashboard(self, ch_id):
+        """
+        Delete dashboard of channel <ch_id>
+        """
+        uid = self.channel_uids.pop(ch_id, None)
+        if uid is None:
+            return False
+        self.existing.pop(uid, None)
+        r = self._delete(os.path.join(self.grafana_url, f'api/dashboards/uid/{uid}'))
+        if r == -1 or r.status_code != 200:
+            log.error(f'Error in deleting dashboard of channel {ch_id}. Message: {r}')
+            return False
+        log.info(f'Successfully deleted dashboard of channel {ch_id}')
+        return True
+
+    def add_channel_dashbords(self, template_path, camera_conf, ch_ids):
+        """
+        Add/Update dashboards of channels <ch_ids>, PARALLEL_UPLOADS at a time.
+        Return dict of channel id to dashboard url, channels whose upload failed are left out.
+        """
+        with ThreadPoolExecutor(max_workers=GrafanaConnect.PARALLEL_UPLOADS) as executor:
+            futures = {i: executor.submit(self.add_channel_dashboard, template_path, i, camera_conf["cameras"][i])
+                       for i in ch_ids}
+        urls = {i: future.result() for i, future in futures.items()}
+        return {i: url for i, url in urls.items() if url is not None}
+
+    def wait_ready(self):
+        """
+        Wait for the grafana API with exponential backoff, return False on timeout
+        """
+        delay = GrafanaConnect.MIN_BACKOFF
+        deadline = time.monotonic() + GrafanaConnect.READY_TIMEOUT
+        while time.monotonic() < deadline:
+            test = self._get(self.datasource_url, timeout=3)
+            if test != -1 and test.status_code == 200:
+                return True
+            log.info(f'Connecting grafana: Grafana container not up yet, retrying in {delay:.1f} s...')
+            time.sleep(delay)
+            delay = min(delay*2, GrafanaConnect.MAX_BACKOFF)
+        return False
 
     def init_grafana_server(self, camera_config, datasource_template_path,
                             consolidated_dashboard_template_path,
-                            channel_dashboard_template_path):
+                            channel_dashboard_template_path, ch_ids, main=True):
         """
-        Initialize datasource and dashboards on grafana server
+        Initialize dashboards of channels <ch_ids> on grafana server,
+        with <main> also the datasource and the consolidated dashboard.
+        Return dict of dashboard urls, -1 if the consolidated dashboard can't be added.
         """
-        # test grafana api
-        i = -1
-        while i < 100:
-            i += 1
-            time.sleep(1)
-            test = self._get(self.datasource_url, timeout=3)
-            if test == -1 or test.status_code != 200:
-                log.info('Connecting grafana: Grafana container not up yet, retrying...')
-                continue
-            else:
-                break
-        self.create_datasource(datasource_template_path)
-        with open(consolidated_dashboard_template_path, 'r') as f:
-            json_data = json.loads(f.read())
-        res = self.add_dashboard(json_data)
+        if not self.wait_ready():
+            log.error(f'Grafana is not reachable at {self.grafana_url} after '
+                      f'{GrafanaConnect.READY_TIMEOUT} s. Check that the grafana container is running.')
+            sys.exit(-1)
+        if main:
+            self.create_datasource(datasource_template_path)
+        self.load_existing()
         url_data = self.add_channel_dashbords(channel_dashboard_template_path,
-                                              camera_config)
-        url_data[-1] = GRAFANA_EXTERNAL_URL + res['url']
+                                              camera_config, ch_ids)
+        if main:
+            json_data = json.loads(self._template(consolidated_dashboard_template_path))
+            self._embed(json_data, self.map_server_url + '/dashboard')
+            res = self.add_dashboard(json_data)
+            if res is None:
+                return -1
+            url_data[-1] = GRAFANA_EXTERNAL_URL + res['url']
         return url_data
 
 
-def _stream_channel(cam_id):
+def _acquire_channel(cam_id):
+    """
+    Register a viewer on channel <cam_id>.
+    The analytics process delivers frames only for channels with viewers.
+    """
+    MUTEX.acquire()
+    RUNNING[cam_id] += 1
+    MUTEX.release()
+
+
+def _release_channel(cam_id):
+    """
+    Unregister a viewer from channel <cam_id>.
+    """
+    MUTEX.acquire()
+    RUNNING[cam_id] = max(0, RUNNING[cam_id] - 1)
+    idle = RUNNING[cam_id] == 0
+    MUTEX.release()
+    if idle:
+        Q_DATA[cam_id].clear()
+
+
+def _draw_metadata(frame, meta):
+    """
+    Return a copy of clean <frame> with the overlays described by its metadata <meta>,
+    for views that can't draw them in the browser (Grafana panel, all streams, snapshots).
+    """
+    import cv2
+    frame = frame.copy()
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    text = f"FPS: {meta['fps']}"
+    (text_width, text_height), _ = cv2.getTextSize(text, font, 0.7, 2)
+    cv2.rectangle(frame, (10, 20), (12 + text_width, 18 - text_height), (255, 255, 255), cv2.FILLED)
+    cv2.putText(frame, text, (10, 20), font, 0.7, (0, 0, 0), 1)
+    # Row: [id, x, y, width, height, label, vel_x, vel_y, state, color], see TrackingSystem.get_metadata
+    for obj_id, x, y, width, height, label, _, _, state, color in meta['objects']:
+        bgr = tuple(int(color[i:i+2], 16) for i in (5, 3, 1))
+        cv2.rectangle(frame, (x, y), (x + width, y + height), bgr, 2)
+        texts = [(f'{obj_id} ' if obj_id >= 0 else '') + (yolo_labels.get_label_str(label) if label is not None else '')]
+        if state:
+            texts.append('Collision' if state == 2 else 'Near Miss')
+        for text, pos in zip(texts, [(x + 2, y - 5), (x + 2, y + height + 12)]):
+            (text_width, text_height), _ = cv2.getTextSize(text, font, 0.5, 1)
+            cv2.rectangle(frame, pos, (pos[0] + text_width, pos[1] - text_height), bgr, cv2.FILLED)
+            cv2.putText(frame, text, pos, font, 0.5, (0, 0, 0), 1)
+    return frame
+
+
+def _stream_channel(cam_id, client_overlay=False):
     """
     Generator.
     Yield frames that belongs to <cam_id>.
+    With --client_overlay frames arrive clean with their metadata: overlays are drawn here,
+    unless <client_overlay> is set. Then frames are sent clean and each part carries the
+    metadata of its frame in an X-Frame-Metadata header, for the browser to draw.
     """
     global Q_DATA, RUNNING
-    MUTEX.acquire()
-    RUNNING[cam_id] = True
-    MUTEX.release()
+    # OpenCV is loaded by the web server on first use only
+    import cv2
+    _acquire_channel(cam_id)
     q = Q_DATA[cam_id]
-    max_try = 4000
     try:
         while True:
-            if q.empty() and max_try > 0:
-                MUTEX.acquire()
-                RUNNING[cam_id] = True
-                MUTEX.release()
-                max_try -= 1
-                time.sleep(0.01)
-                continue
-            elif q.empty() and max_try <= 0:
+            try:
+                seq, frame, meta = q.get(timeout=STREAM_TIMEOUT)
+            except Empty:
                 log.error('Unable to recevie frames from pipeline, Unknown error.')
                 break
-            max_try = 4000
-            frame = q.get()
-            CURRENT_FRAMES[cam_id] = frame
+            CURRENT_FRAMES[cam_id] = (frame, meta)
+            headers = f'X-Frame-Sequence: {seq}\r\n'
+            if meta is not None:
+                if client_overlay:
+                    headers += f'X-Frame-Metadata: {json.dumps(meta, separators=(",", ":"))}\r\n'
+                else:
+                    frame = _draw_metadata(frame, meta)
             ret, frame = cv2.imencode('.jpg', frame)
             if not ret:
                 continue
+            jpeg = frame.tobytes()
             time.sleep(1/FPS)
             yield (b' --frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' +
-                   frame.tobytes() + b'\r\n\r\n')
+                   b'Content-Type: image/jpeg\r\n' +
+                   f'{headers}Content-Length: {len(jpeg)}\r\n\r\n'.encode() +
+                   jpeg + b'\r\n\r\n')
     except Exception as err:
         log.error(f'Error: {err}')
     finally:
-        MUTEX.acquire()
-        RUNNING[cam_id] = False
-        MUTEX.release()
         CURRENT_FRAMES[cam_id] = None
-        # empty the queue
-        while not q.empty():
-            _ = q.get()
+        _release_channel(cam_id)
+        log.info(f'Channel {cam_id} stream closed. Frames delivered: {q.delivered}, dropped: {q.dropped}')
+
+
+def _stream_metadata(cam_id):
+    """
+    Generator.
+    Yield tracking metadata of <cam_id> as server-sent events.
+    Event id is the sequence number of the frame the metadata belongs to.
+    Metadata consumers don't register as viewers, no frames are delivered for them.
+    """
+    q = META_DATA[cam_id]
+    q.attach()
+    try:
+        while True:
+            try:
+                meta = q.get(timeout=STREAM_TIMEOUT)
+            except Empty:
+                log.error('Unable to recevie metadata from pipeline, Unknown error.')
+                break
+            yield f'id: {meta["seq"]}\ndata: {json.dumps(meta, separators=(",", ":"))}\n\n'
+    except Exception as err:
+        log.error(f'Error: {err}')
+    finally:
+        q.detach()
 
 
 def _get_all_streams(num_ch):
@@ -238,14 +470,14 @@ def _get_all_streams(num_ch):
     Combine and yield frames from all running video streams.
     """
     global Q_DATA, CURRENT_FRAMES, RUNNING
+    import cv2
+    import numpy as np
     height, width = 320, 640
     num_rows = math.floor(math.sqrt(num_ch+1))
     num_cols = math.ceil(num_ch/num_rows)
     idx = 0
-    MUTEX.acquire()
     for i in range(num_ch):
-        RUNNING[i] = True
-    MUTEX.release()
+        _acquire_channel(i)
     base = np.zeros((height*num_rows, width*num_cols, 3), np.uint8)
     try:
         while True:
@@ -253,12 +485,17 @@ def _get_all_streams(num_ch):
                 if idx >= num_ch:
                     break
                 if CURRENT_FRAMES[idx] is None:
-                    if Q_DATA[idx].empty():
-                        time.sleep(0.01)
+                    try:
+                        _, frame, meta = Q_DATA[idx].get(timeout=0.01)
+                    except Empty:
                         continue
-                    frame = Q_DATA[idx].get()
                 else:
-                    frame = CURRENT_FRAMES[idx]
+                    frame, meta = CURRENT_FRAMES[idx]
+                if meta is not None:
+                    frame = _draw_metadata(frame, meta)
+                if frame.shape[:2] != (height, width):
+                    # Channel with its own output resolution
+                    frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
                 x = int(width * int(idx % num_cols))
                 y = int(height * int(idx / num_cols))
                 base[y : y + height, x : x + width] = frame
@@ -273,12 +510,230 @@ def _get_all_streams(num_ch):
         log.error(f'Error: {err}')
     finally:
         for idx in range(num_ch):
-            if CURRENT_FRAMES[idx] is None:
-                MUTEX.acquire()
-                RUNNING[idx] = False
-                MUTEX.release()
-                while not Q_DATA[idx].empty():
-                    _ = Q_DATA[idx].get()
+            _release_channel(idx)
+
+
+def _expire_lease(cam_id):
+    """
+    Release the snapshot viewer of <cam_id> if no snapshot was requested during SNAPSHOT_LEASE
+    """
+    with SNAPSHOT_LOCKS[cam_id]:
+        if time.monotonic() < SNAPSHOT_LEASES.get(cam_id, 0):
+            timer = threading.Timer(SNAPSHOT_LEASE, _expire_lease, args=(cam_id,))
+            timer.daemon = True
+            timer.start()
+            return
+        SNAPSHOT_LEASES.pop(cam_id, None)
+    _release_channel(cam_id)
+
+
+def _renew_lease(cam_id):
+    """
+    Keep the frames of <cam_id> flowing for SNAPSHOT_LEASE seconds after a snapshot request.
+    Called with SNAPSHOT_LOCKS[cam_id] held.
+    """
+    if cam_id not in SNAPSHOT_LEASES:
+        _acquire_channel(cam_id)
+        timer = threading.Timer(SNAPSHOT_LEASE, _expire_lease, args=(cam_id,))
+        timer.daemon = True
+        timer.start()
+    SNAPSHOT_LEASES[cam_id] = time.monotonic() + SNAPSHOT_LEASE
+
+
+def _get_snapshot(cam_id, width):
+    """
+    Return (etag, jpeg bytes) of the latest frame of <cam_id> downscaled to <width>.
+    The JPEG is re-encoded at most once every SNAPSHOT_INTERVAL ms, requests in
+    between are served from cache. Never waits for the pipeline: a channel nobody
+    is streaming is kept delivering frames for SNAPSHOT_LEASE seconds, the first
+    request only starts delivery.
+    """
+    import cv2
+    key = (cam_id, width)
+    with SNAPSHOT_LOCKS[cam_id]:
+        cached = SNAPSHOTS.get(key)
+        now = time.monotonic()
+        if cached and (now - cached[0])*1000 < SNAPSHOT_INTERVAL:
+            return cached[1], cached[2]
+        _renew_lease(cam_id)
+        frame, meta = CURRENT_FRAMES[cam_id] or (None, None)
+        if frame is None:
+            # Nobody is streaming this channel, take the newest frame delivered so far
+            item = Q_DATA[cam_id].latest()
+            if item is not None:
+                _, frame, meta = item
+        if frame is None:
+            return (cached[1], cached[2]) if cached else (None, None)
+        if meta is not None:
+            frame = _draw_metadata(frame, meta)
+        height, f_width = frame.shape[:2]
+        width = min(width, f_width)
+        if width != f_width:
+            frame = cv2.resize(frame, (width, max(1, int(height*width/f_width))),
+                               interpolation=cv2.INTER_AREA)
+        ret, jpeg = cv2.imencode('.jpg', frame)
+        if not ret:
+            return (cached[1], cached[2]) if cached else (None, None)
+        jpeg = jpeg.tobytes()
+        etag = f'"{cam_id}-{width}-{zlib.crc32(jpeg):08x}"'
+        SNAPSHOTS[key] = (now, etag, jpeg)
+        return etag, jpeg
+
+
+def _stream_live_counts():
+    """
+    Generator.
+    Yield per-channel counts as server-sent events every LIVE_INTERVAL ms.
+    Only channels whose counts changed are sent, with their increments.
+    """
+    last = None
+    last_sent = time.monotonic()
+    while True:
+        counts = LIVE_COUNTS.get()
+        if last is None:
+            changed = {ch_id: {'counts': c, 'delta': c} for ch_id, c in enumerate(counts) if _configured(ch_id)}
+        else:
+            changed = {ch_id: {'counts': c, 'delta': [n - o for n, o in zip(c, last[ch_id])]}
+                       for ch_id, c in enumerate(counts) if c != last[ch_id] and _configured(ch_id)}
+        last = counts
+        if changed:
+            last_sent = time.monotonic()
+            yield f'data: {json.dumps({"metrics": METRICS, "channels": changed}, separators=(",", ":"))}\n\n'
+        elif time.monotonic() - last_sent > LIVE_KEEPALIVE:
+            last_sent = time.monotonic()
+            yield ': keepalive\n\n'
+        time.sleep(LIVE_INTERVAL/1000)
+
+
+def _get_cam_id(cam_id):
+    """
+    Return <cam_id> as int if it is a valid channel id, else None
+    """
+    if not cam_id.isnumeric():
+        return None
+    cam_id = int(cam_id)
+    if cam_id >= NUM_CH or CONF_DATA['cameras'][cam_id] is None:
+        return None
+    return cam_id
+
+
+def _configured(ch_id):
+    """
+    Return True if a camera is configured on channel <ch_id>, reloads can leave unused channels
+    """
+    return ch_id < NUM_CH and CONF_DATA['cameras'][ch_id] is not None
+
+
+def _is_local(ch_id):
+    """
+    Return True if channel <ch_id> is served by this node
+    """
+    if SHARD_CAMERAS is not None:
+        return ch_id in SHARD_CAMERAS
+    return ch_id % SHARD_COUNT == SHARD_INDEX
+
+
+def _worker_of(ch_id):
+    """
+    Return index of the analytics worker serving local channel <ch_id>
+    """
+    return LOCAL_CHANNELS.index(ch_id) % len(CONTROL)
+
+
+def _peer_get(peer, path, headers=None, timeout=PEER_TIMEOUT, stream=False):
+    """
+    GET <path> from node <peer>. The certificate of the node is verified, see PEER_VERIFY.
+    """
+    headers = dict(headers or {})
+    headers[PEER_HEADER] = str(SHARD_INDEX)
+    return requests.get(peer + path, headers=headers, timeout=timeout, stream=stream, verify=PEER_VERIFY)
+
+
+def _strip_credentials(url):
+    """
+    Return <url> without user name and password
+    """
+    parts = urlsplit(url)
+    if parts.username is None and parts.password is None:
+        return url
+    netloc = parts.hostname or ''
+    if ':' in netloc:
+        netloc = f'[{netloc}]'
+    if parts.port is not None:
+        netloc += f':{parts.port}'
+    return urlunsplit(parts._replace(netloc=netloc))
+
+
+def _relay(r):
+    """
+    Generator.
+    Yield the body of peer response <r> as it arrives.
+    """
+    try:
+        yield from r.iter_content(chunk_size=None)
+    except requests.RequestException as err:
+        log.error(f'Error: {err}')
+    finally:
+        r.close()
+
+
+def _proxy(cam_id):
+    """
+    Forward the current request for channel <cam_id> to the node serving it
+    """
+    peer = PEER_OWNERS.get(cam_id)
+    # Requests from other nodes are never forwarded again
+    if peer is None or request.headers.get(PEER_HEADER) is not None:
+        return Response("Channel not available", 503)
+    headers = {key: value for key, value in request.headers.items() if key == 'If-None-Match'}
+    try:
+        r = _peer_get(peer, request.full_path, headers, timeout=(PEER_TIMEOUT, STREAM_TIMEOUT), stream=True)
+    except requests.RequestException as err:
+        log.error(f'Error: Node {peer} serving channel {cam_id} is not reachable. {err}')
+        return Response("Channel not available", 503)
+    response = Response(_relay(r), status=r.status_code, content_type=r.headers.get('Content-Type'))
+    for key in ['ETag', 'Cache-Control']:
+        if key in r.headers:
+            response.headers[key] = r.headers[key]
+    return response
+
+
+def _global_totals():
+    """
+    Return (total counts, total collision count) over the channels of all nodes
+    """
+    counts = LIVE_COUNTS.get()[:NUM_CH]
+    totals = [sum(col) for col in zip(*counts)] or [0]*len(METRICS)
+    return totals[:3], totals[METRICS.index('collision')]
+
+
+def poll_peers(interval):
+    """
+    Collect owned channels, counts and status of the other nodes. Runs in a daemon thread.
+    """
+    while True:
+        for index, peer in enumerate(PEERS):
+            if index == SHARD_INDEX:
+                continue
+            try:
+                shard = _peer_get(peer, '/api/shard').json()
+            except (requests.RequestException, ValueError):
+                continue
+            owned = set()
+            for ch_id, ch_data in shard['channels'].items():
+                ch_id = int(ch_id)
+                if ch_id >= MAX_CH or _is_local(ch_id):
+                    continue
+                owned.add(ch_id)
+                PEER_OWNERS[ch_id] = peer
+                LIVE_COUNTS.update(ch_id, ch_data['counts'])
+                CHANNEL_STATUS.update(ch_id, **ch_data['status'])
+            # Only dashboards of the channels of the peer, and the shared ones from the first node
+            for key, url in shard.get('urls', {}).items():
+                key = int(key)
+                if key in owned or (key == -1 and index == 0):
+                    URL_DATA[key] = _strip_credentials(url)
+        time.sleep(interval)
 
 
 @app.route('/get_all_streams')
@@ -295,27 +750,211 @@ def open_stream(cam_id):
     """
     Route to individual video stream identified by <cam_id>.
     If <cam_id> is 'all' render HTML that shows all video streams.
+    With --client_overlay, query parameter `overlay=client` streams clean frames
+    with their metadata for the browser to draw, overlays are drawn here otherwise.
     Calls _stream_channel(cam_id) function.
     """
     try:
-        if not cam_id.isnumeric():
-            return Response("The URL does not exist", 401)
-        cam_id = int(cam_id)
-        if cam_id >= NUM_CH:
+        cam_id = _get_cam_id(cam_id)
+        if cam_id is None:
             return Response("The URL does not exist", 401)
-        return Response(_stream_channel(cam_id),
+        if not _is_local(cam_id):
+            return _proxy(cam_id)
+        client_overlay = request.args.get('overlay') == 'client'
+        return Response(_stream_channel(cam_id, client_overlay),
                         mimetype='multipart/x-mixed-replace; boundary=frame')
     except Exception as err:
         log.error(f'Error: {err}')
 
 
+@app.route('/camera/<cam_id>/snapshot.jpg')
+def snapshot(cam_id):
+    """
+    Route to a cached, downscaled JPEG of the latest frame of <cam_id>.
+    Optional query parameter `size` is the width of the image in pixels.
+    """
+    try:
+        cam_id = _get_cam_id(cam_id)
+        if cam_id is None:
+            return Response("The URL does not exist", 401)
+        if not _is_local(cam_id):
+            return _proxy(cam_id)
+        size = request.args.get('size', str(SNAPSHOT_SIZE))
+        if not size.isnumeric() or not 16 <= int(size) <= 1920:
+            return Response("Invalid size", 400)
+        etag, jpeg = _get_snapshot(cam_id, int(size))
+        if jpeg is None:
+            # Delivery of the channel was just started, the next request gets a frame
+            return Response("Frame not available", 503, headers={'Retry-After': '1'})
+        max_age = max(1, SNAPSHOT_INTERVAL // 1000)
+        if request.headers.get('If-None-Match') == etag:
+            response = Response(status=304)
+        else:
+            response = Response(jpeg, mimetype='image/jpeg')
+        response.headers['ETag'] = etag
+        response.headers['Cache-Control'] = f'private, max-age={max_age}'
+        return response
+    except Exception as err:
+        log.error(f'Error: {err}')
+
+
+@app.route('/camera/<cam_id>/metadata')
+def open_metadata_stream(cam_id):
+    """
+    Route to tracking metadata stream of <cam_id>, used to draw overlays in the browser.
+    Available only when the server runs with --client_overlay.
+    """
+    try:
+        cam_id = _get_cam_id(cam_id)
+        if cam_id is not None and not _is_local(cam_id):
+            return _proxy(cam_id)
+        if cam_id is None or not META_DATA:
+            return Response("The URL does not exist", 401)
+        return Response(_stream_metadata(cam_id), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+    except Exception as err:
+        log.error(f'Error: {err}')
+
+
+@app.route('/api/live')
+def live_counts():
+    """
+    Route to server-sent events of live per-channel counts.
+    """
+    return Response(_stream_live_counts(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+def _parse_time(value, default, now):
+    """
+    Parse epoch seconds. Negative values are relative to <now>.
+    """
+    if value is None or value == '':
+        return default
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError('time must be a finite number')
+    return now + value if value < 0 else value
+
+
+@app.route('/api/counts')
+def counts():
+    """
+    Route to historical counts from the in-process history store.
+    Query parameters:
+        channel - channel id, all channels if omitted
+        from, to - epoch seconds, negative values are relative to now (default last 5 minutes),
+                   clamped to the retained last 24 hours
+        step - bucket length in seconds (default finest available), raised to return
+               at most CountHistory.MAX_BUCKETS buckets
+    """
+    now = time.time()
+    try:
+        t_from = _parse_time(request.args.get('from'), now - 300, now)
+        t_to = _parse_time(request.args.get('to'), now, now)
+        step = request.args.get('step')
+        step = int(step) if step else None
+        if step is not None and step <= 0:
+            raise ValueError('step must be positive')
+    except ValueError as err:
+        return Response(f"Invalid query: {err}", 400)
+    t_from, t_to = HISTORY.clamp(t_from, t_to, now)
+    channel = request.args.get('channel')
+    if channel is None:
+        channels = [ch_id for ch_id in range(NUM_CH) if _configured(ch_id) and _is_local(ch_id)]
+    else:
+        channel = _get_cam_id(channel)
+        if channel is None:
+            return Response("The URL does not exist", 401)
+        if not _is_local(channel):
+            return _proxy(channel)
+        channels = [channel]
+    result = {'from': t_from, 'to': t_to, 'metrics': METRICS, 'channels': {}}
+    for ch_id in channels:
+        result['step'], buckets = HISTORY.query(ch_id, t_from, t_to, step)
+        result['channels'][ch_id] = {'buckets': buckets,
+                                     'totals': [sum(col) for col in zip(*[b[1:] for b in buckets])] or
+                                               [0]*len(METRICS)}
+    if channel is None and request.headers.get(PEER_HEADER) is None:
+        # Add the channels of the other nodes
+        for index, peer in enumerate(PEERS):
+            if index == SHARD_INDEX:
+                continue
+            try:
+                peer_result = _peer_get(peer, request.full_path).json()
+            except (requests.RequestException, ValueError) as err:
+                log.error(f'Error: Failed to get counts from node {peer}. {err}')
+                continue
+            result.setdefault('step', peer_result.get('step'))
+            result['channels'].update({int(ch_id): ch_data for ch_id, ch_data in peer_result['channels'].items()})
+    return jsonify(result)
+
+
+@app.route('/api/channels')
+def channels():
+    """
+    Route to per-channel pipeline health and frame delivery statistics.
+    """
+    result = []
+    for ch_id, status in enumerate(CHANNEL_STATUS.get()[:NUM_CH]):
+        if not _configured(ch_id):
+            continue
+        status['channel'] = ch_id
+        status['viewers'] = RUNNING[ch_id]
+        if _is_local(ch_id):
+            status['worker'] = _worker_of(ch_id)
+        else:
+            status['peer'] = PEER_OWNERS.get(ch_id)
+        status['frames_delivered'] = Q_DATA[ch_id].delivered
+        status['frames_dropped'] = Q_DATA[ch_id].dropped
+        result.append(status)
+    return jsonify(result)
+
+
+@app.route('/api/shard')
+def shard():
+    """
+    Route to the channels served by this node with their counts and status, polled by the other nodes.
+    """
+    live, status = LIVE_COUNTS.get(), CHANNEL_STATUS.get()
+    result = {'shard_index': SHARD_INDEX,
+              'channels': {ch_id: {'counts': live[ch_id], 'status': status[ch_id]}
+                           for ch_id in LOCAL_CHANNELS if _configured(ch_id)}}
+    if GRAFANA is not None:
+        result['urls'] = {ch_id: _strip_credentials(url) for ch_id, url in URL_DATA.items()
+                          if (ch_id == -1 and SHARD_INDEX == 0) or (_configured(ch_id) and _is_local(ch_id))}
+    return jsonify(result)
+
+
+@app.route('/api/reload', methods=['POST'])
+def reload():
+    """
+    Route to reload the config file without restarting the server.
+    """
+    try:
+        changes = reload_config()
+    except validate_config.ConfigException as err:
+        return Response(f"Configuration not reloaded. {err}", 400)
+    return jsonify(changes)
+
+
+def _public_config():
+    """
+    Return camera details that are safe to share with the browser
+    """
+    return {'cameras': [cam and {key: cam[key] for key in ['address', 'latitude', 'longitude']}
+                        for cam in CONF_DATA['cameras']]}
+
+
 @app.route('/dashboard')
 def dashboard():
     """
     Route to HTML page which shows MapUI. Home Page.
     """
-    conf = CONF_DATA
+    conf = _public_config()
     conf['urls'] = URL_DATA
+    conf['client_overlay'] = bool(META_DATA)
+    conf['snapshot_interval'] = SNAPSHOT_INTERVAL
     response = make_response(render_template('dashboard.html', title='Dashboard',
                              map_js=MAP_JS_CDN, map_cdn_integrity=JS_CDN_INTEGRITY,
                              map_css=MAP_CSS_CDN, config=json.dumps(conf)))
@@ -329,46 +968,222 @@ def add_csp(resp):
     resp.headers['Content-Security-Policy']  =  "frame-ancestors 'none' https://*:32000 ;" \
                                                 "media-src 'none' ; " \
                                                 "object-src 'none' ; " \
-                                                "connect-src 'none' ; " \
+                                                "connect-src 'self' ; " \
                                                 "plugin-src 'none' ; " \
                                                 "frame-src 'none' ; " \
                                                 "img-src 'self' https://openlayers.org http://a.tile.openstreetmap.org http://b.tile.openstreetmap.org http://c.tile.openstreetmap.org ; "
     return resp
 
 
+def probe_sources(paths):
+    """
+    Open all sources in <paths> in parallel.
+    Raise validate_config.ConfigException for the first source that can't be read
+    within PROBE_TIMEOUT seconds.
+    """
+    if not paths:
+        return
+    # OpenCV is never loaded by the web server
+    results = analytics.run_isolated(analytics.probe_sources, paths, PROBE_TIMEOUT)
+    for path, result in results.items():
+        if result is None:
+            raise validate_config.ConfigException(f'Timed out opening source - `{path}`')
+        if not result:
+            raise validate_config.ConfigException(f'Unable to open source - `{path}`')
+
+
+def _camera_key(cam):
+    """
+    Return key identifying camera <cam> across config reloads, its `id` if set, else its source path
+    """
+    return ('id', cam['id']) if 'id' in cam else ('path', cam['path'])
+
+
+def _assign_channels(old_cameras, new_cameras):
+    """
+    Return <new_cameras> placed by channel id, None for unused channels.
+    A camera keeps the channel of the old camera with the same key (cameras sharing a
+    path are matched in order), other cameras take the lowest unused channels.
+    """
+    old_ids = {}
+    for ch_id, cam in enumerate(old_cameras):
+        if cam is not None:
+            old_ids.setdefault(_camera_key(cam), []).append(ch_id)
+    placed, added = {}, []
+    for cam in new_cameras:
+        ids = old_ids.get(_camera_key(cam))
+        if ids:
+            placed[ids.pop(0)] = cam
+        else:
+            added.append(cam)
+    ch_id = 0
+    for cam in added:
+        while ch_id in placed:
+            ch_id += 1
+        placed[ch_id] = cam
+    return [placed.get(ch_id) for ch_id in range(max(placed) + 1 if placed else 0)]
+
+
+def check_config(config_path, old_cameras=None):
+    """
+    Validate config file, sources and devices. With <old_cameras> the cameras are
+    placed by channel id relative to them, see _assign_channels.
+    Return (num_ch, conf_data), raise validate_config.ConfigException if invalid.
+    """
+    num_ch, conf_data, given_devices  = validate_config.read_config(f"{config_path}")
+    if old_cameras is not None:
+        conf_data['cameras'] = _assign_channels(old_cameras, conf_data['cameras'])
+        num_ch = len(conf_data['cameras'])
+    # Sources of other nodes are probed by those nodes
+    probe_sources([cam_detail['path'] for ch_id, cam_detail in enumerate(conf_data['cameras'])
+                   if cam_detail is not None and _is_local(ch_id)])
+    global AVAILABLE_DEVICES
+    if AVAILABLE_DEVICES is None:
+        # OpenVINO is never loaded by the web server
+        AVAILABLE_DEVICES = analytics.run_isolated(analytics.available_devices)
+    for device in given_devices:
+        if device not in AVAILABLE_DEVICES:
+            raise validate_config.ConfigException(f'Device not found - `{device}`. '
+                                                  f'All available devices - {AVAILABLE_DEVICES}.')
+    return num_ch, conf_data
+
+
 def init_all(over_write=False):
     """
     Initialize global variables and
     update datasources and dashboards on grafana server
     """
-    global NUM_CH, CONF_DATA, URL_DATA
+    global NUM_CH, CONF_DATA, URL_DATA, GRAFANA
     try:
-        num_ch, conf_data, given_devices  = validate_config.read_config(f"{CONFIG_PATH}")
+        num_ch, conf_data = check_config(CONFIG_PATH)
     except validate_config.ConfigException as err:
         log.error(str(err))
         sys.exit(-1)
-    for cam_detail in conf_data['cameras']:
-        cap = cv2.VideoCapture(cam_detail['path'])
-        ret, _ = cap.read()
-        if not ret or not cap.isOpened():
-            log.error(f'Unable to open source - `{cam_detail["path"]}`')
-            sys.exit(-1)
-        cap.release()
-    ie = IECore()
-    for device in given_devices:
-        if device not in ie.available_devices:
-            log.error(f'Device not found - `{device}`. '
-                      f'All available devices - {ie.available_devices}.')
-            sys.exit(-1)
+    STARTUP.mark('sources')
     if not over_write or conf_data == CONF_DATA:
         return
     NUM_CH, CONF_DATA = num_ch, conf_data
-    grafana_connect = GrafanaConnect(GRAFANA_URL, MAP_SERVER_URL, INFLUXDB_URL, 'admin', GRAFANA_PASSWORD)
-    URL_DATA = grafana_connect.init_grafana_server(CONF_DATA, 'grafana_templates/datasource_template.json',
-                                                   'grafana_templates/consolidated_dashboard_template.json',
-                                                   'grafana_templates/channel_dashboard_template.json')
+    GRAFANA = GrafanaConnect(GRAFANA_URL, MAP_SERVER_URL, INFLUXDB_URL, 'admin', GRAFANA_PASSWORD,
+                             GRAFANA_SNAPSHOT)
+    # Each node provisions the dashboards of its channels, the first node also the shared ones.
+    # Urls of the other dashboards are polled from their nodes.
+    URL_DATA = GRAFANA.init_grafana_server(CONF_DATA, 'grafana_templates/datasource_template.json',
+                                           'grafana_templates/consolidated_dashboard_template.json',
+                                           'grafana_templates/channel_dashboard_template.json',
+                                           [ch_id for ch_id in range(NUM_CH) if _is_local(ch_id)],
+                                           main=SHARD_INDEX == 0)
     if URL_DATA == -1:
+        log.error('Failed to add the ITM dashboard to grafana.')
         sys.exit(-1)
+    STARTUP.mark('grafana')
+
+
+def reload_config():
+    """
+    Re-read config file and apply the difference to the running analytics:
+    only added, removed or changed channels and their dashboards are touched.
+    Cameras are matched by _camera_key, so a camera keeps its channel and state
+    when others are added, removed or reordered.
+    Return dict of changed channel ids per action, a channel given to another
+    camera is removed and added.
+    Raise validate_config.ConfigException if the new config is invalid.
+    """
+    global NUM_CH, CONF_DATA
+    with RELOAD_LOCK:
+        old_cameras = CONF_DATA['cameras']
+        num_ch, conf_data = check_config(CONFIG_PATH, old_cameras)
+        new_cameras = conf_data['cameras']
+        if num_ch > MAX_CH:
+            raise validate_config.ConfigException(f'Config needs {num_ch} channels, '
+                                                  f'server was started with capacity for {MAX_CH}.')
+        # Removals first, a channel given to another camera is freed before it is added
+        changes = {'remove': [], 'update': [], 'add': []}
+        for ch_id in range(max(len(old_cameras), num_ch)):
+            old_cam = old_cameras[ch_id] if ch_id < len(old_cameras) else None
+            new_cam = new_cameras[ch_id] if ch_id < num_ch else None
+            if old_cam == new_cam:
+                continue
+            if old_cam is not None and new_cam is not None and _camera_key(old_cam) == _camera_key(new_cam):
+                changes['update'].append(ch_id)
+                continue
+            if old_cam is not None:
+                changes['remove'].append(ch_id)
+            if new_cam is not None:
+                changes['add'].append(ch_id)
+        if not any(changes.values()):
+            return changes
+        for action, ch_ids in changes.items():
+            for ch_id in ch_ids:
+                if _is_local(ch_id):
+                    # Each channel is owned by one analytics worker
+                    CONTROL[_worker_of(ch_id)].put((action, ch_id,
+                                                   new_cameras[ch_id] if action != 'remove' else None))
+        template = 'grafana_templates/channel_dashboard_template.json'
+        for ch_id in changes['remove']:
+            if _is_local(ch_id) and GRAFANA is not None:
+                GRAFANA.delete_channel_dashboard(ch_id)
+            URL_DATA.pop(ch_id, None)
+        if GRAFANA is not None:
+            # Updated dashboards are overwritten by uid, unchanged content skips the upload
+            for ch_id in changes['update'] + changes['add']:
+                url = GRAFANA.add_channel_dashboard(template, ch_id, new_cameras[ch_id]) if _is_local(ch_id) else None
+                if url is not None:
+                    URL_DATA[ch_id] = url
+                elif not (_is_local(ch_id) and ch_id in changes['update']):
+                    # A failed update keeps serving the previous dashboard
+                    URL_DATA.pop(ch_id, None)
+        for ch_id in changes['remove']:
+            CURRENT_FRAMES[ch_id] = None
+            Q_DATA[ch_id].clear()
+        NUM_CH, CONF_DATA = num_ch, conf_data
+        log.info(f'Configuration reloaded: {changes}')
+        return changes
+
+
+def watch_config(interval):
+    """
+    Reload config whenever the config file changes. Runs in a daemon thread.
+    """
+    last_mtime = os.stat(CONFIG_PATH).st_mtime
+    while True:
+        time.sleep(interval)
+        try:
+            mtime = os.stat(CONFIG_PATH).st_mtime
+        except OSError:
+            continue
+        if mtime == last_mtime:
+            continue
+        last_mtime = mtime
+        try:
+            reload_config()
+        except validate_config.ConfigException as err:
+            log.error(f'Configuration not reloaded. {err}')
+
+
+def run_autotune(args):
+    """
+    Tune inference settings for the devices of the local cameras.
+    Return dict of device to tuned settings, None if tuning is not possible.
+    """
+    cameras = [cam for ch_id, cam in enumerate(CONF_DATA['cameras']) if _is_local(ch_id)]
+    clip = args.autotune_clip or next((cam['path'] for cam in cameras
+                                       if '://' not in cam['path'] and '/dev/video' not in cam['path']), None)
+    if clip is None:
+        log.warning('Autotune skipped: no sample clip. Use --autotune_clip with live sources.')
+        return None
+    devices = sorted(set(cam['device'] for cam in cameras))
+    try:
+        tuning = analytics.run_isolated(analytics.load_or_tune, args.vp_model, devices, clip,
+                                        args.autotune_cache, args.latency_target)
+    except Exception as err:
+        log.error(f'Autotune failed, using default inference settings. {err}')
+        return None
+    for device, settings in tuning.items():
+        log.info(f'Autotune: {device} - {settings}')
+    # One model is loaded for all channels, the precision tuned for the most used device is taken
+    devices = [cam['device'] for cam in cameras]
+    args.vp_model = tuning[max(set(devices), key=devices.count)]['model']
+    return tuning
 
 
 def check_args(args):
@@ -408,7 +1223,9 @@ def main():
     """
     Main Function
     """
-    global GRAFANA_URL, MAP_SERVER_URL, INFLUXDB_URL, CONFIG_PATH, Q_DATA, RUNNING, CURRENT_FRAMES, GRAFANA_EXTERNAL_URL
+    global GRAFANA_URL, MAP_SERVER_URL, INFLUXDB_URL, CONFIG_PATH, Q_DATA, META_DATA, RUNNING, CURRENT_FRAMES, GRAFANA_EXTERNAL_URL
+    global SNAPSHOT_INTERVAL, SNAPSHOT_LOCKS, GRAFANA_SNAPSHOT, LIVE_INTERVAL, LIVE_COUNTS, HISTORY, CHANNEL_STATUS
+    global MAX_CH, CONTROL, PROBE_TIMEOUT, SHARD_INDEX, SHARD_COUNT, SHARD_CAMERAS, PEERS, PEER_VERIFY, LOCAL_CHANNELS
     parser = ArgumentParser()
     parser.add_argument("-c", "--config_path",
                         help="Path to camera config file",
@@ -446,27 +1263,178 @@ def main():
     parser.add_argument("-database", "--influxdb_database",
                         help="Database name for of influxdb",
                         required=False, default="itm_metadata", type=str)
+    parser.add_argument("-frame_policy", "--frame_policy",
+                        help="Optional. Frame delivery policy for video streams, "
+                             f"one of - {' '.join(POLICIES)}",
+                        required=False, default=POLICY_LATEST, choices=POLICIES, type=str)
+    parser.add_argument("-frame_depth", "--frame_depth",
+                        help="Optional. Number of frames buffered per stream for `drop_oldest` policy",
+                        required=False, default=4, type=int)
+    parser.add_argument("--client_overlay", action="store_true",
+                        help="Optional. Deliver clean frames with their tracking metadata, overlays are "
+                             "drawn in the browser on the dashboard and by the web server on other views.",
+                        required=False, default=False)
+    parser.add_argument("-snapshot_interval", "--snapshot_interval",
+                        help="Optional. Minimum interval in milliseconds between re-encoding snapshots",
+                        required=False, default=SNAPSHOT_INTERVAL, type=int)
+    parser.add_argument("--grafana_snapshot", action="store_true",
+                        help="Optional. Embed snapshots refreshed every snapshot_interval in the Grafana "
+                             "channel dashboards instead of the live stream.",
+                        required=False)
+    parser.add_argument("-live_interval", "--live_interval",
+                        help="Optional. Interval in milliseconds between live count updates pushed to the map",
+                        required=False, default=LIVE_INTERVAL, type=int)
+    parser.add_argument("--keep_database", action="store_true",
+                        help="Optional. Keep existing InfluxDB database instead of recreating it on start.",
+                        required=False, default=False)
+    parser.add_argument("-checkpoint_dir", "--checkpoint_dir",
+                        help="Optional. Directory for tracking state checkpoints",
+                        required=False, default=CHECKPOINT_PATH, type=str)
+    parser.add_argument("-checkpoint_interval", "--checkpoint_interval",
+                        help="Optional. Seconds between checkpoints of each channel, 0 to disable",
+                        required=False, default=5, type=float)
+    parser.add_argument("-trajectory_dir", "--trajectory_dir",
+                        help="Optional. Directory of the archive of completed tracks, not kept if not given",
+                        required=False, default=None, type=str)
+    parser.add_argument("--trajectory_summary", action="store_true",
+                        help="Optional. Write a summary of each archived track to InfluxDB.",
+                        required=False, default=False)
+    parser.add_argument("-clip_dir", "--clip_dir",
+                        help="Optional. Directory of pre/post-event clips of collisions, not kept if not given",
+                        required=False, default=None, type=str)
+    parser.add_argument("-clip_pre", "--clip_pre",
+                        help="Optional. Seconds before a collision kept in its clip",
+                        required=False, default=5, type=float)
+    parser.add_argument("-clip_post", "--clip_post",
+                        help="Optional. Seconds after a collision kept in its clip",
+                        required=False, default=5, type=float)
+    parser.add_argument("-clip_fps", "--clip_fps",
+                        help="Optional. Frames per second kept for clips",
+                        required=False, default=5, type=float)
+    parser.add_argument("-clip_memory", "--clip_memory",
+                        help="Optional. MB of JPEG frames buffered per channel for clips",
+                        required=False, default=8, type=float)
+    parser.add_argument("-max_channels", "--max_channels",
+                        help="Optional. Number of channels that can be served after config reloads",
+                        required=False, default=20, type=int)
+    parser.add_argument("-watch_interval", "--watch_interval",
+                        help="Optional. Seconds between checks of the config file for changes, 0 to disable",
+                        required=False, default=2, type=float)
+    parser.add_argument("-workers", "--workers",
+                        help="Optional. Number of analytics worker processes channels are spread over, "
+                             "0 to size it from the number of cores",
+                        required=False, default=1, type=int)
+    parser.add_argument("--pin_workers", action="store_true",
+                        help="Optional. Pin each analytics worker to its own group of cores.",
+                        required=False, default=False)
+    parser.add_argument("-shard_index", "--shard_index", "--shard-index",
+                        help="Optional. Index of this node when cameras are partitioned over nodes",
+                        required=False, default=0, type=int)
+    parser.add_argument("-shard_count", "--shard_count", "--shard-count",
+                        help="Optional. Number of nodes cameras are partitioned over, "
+                             "camera <i> is served by node <i % shard_count>",
+                        required=False, default=1, type=int)
+    parser.add_argument("-cameras", "--cameras",
+                        help="Optional. Comma separated ids of the cameras served by this node, "
+                             "instead of partitioning by shard index",
+                        required=False, default=None, type=str)
+    parser.add_argument("-peers", "--peers",
+                        help="Optional. Comma separated base urls of all nodes ordered by shard index, "
+                             "e.g. https://localhost:8000,https://localhost:8001",
+                        required=False, default=None, type=str)
+    parser.add_argument("-peer_ca", "--peer_ca",
+                        help="Optional. CA bundle to verify the certificates of the other nodes, "
+                             "system CAs by default",
+                        required=False, default=None, type=str)
+    parser.add_argument("--peer_insecure", action="store_true",
+                        help="Optional. Don't verify the certificates of the other nodes, "
+                             "e.g. nodes sharing the self-signed certificate of the image.",
+                        required=False)
+    parser.add_argument("--autotune", action="store_true",
+                        help="Optional. Benchmark precisions and inference settings before starting "
+                             "and use the fastest within the latency target. Results are cached per host.",
+                        required=False, default=False)
+    parser.add_argument("-latency_target", "--latency_target",
+                        help="Optional. Maximum median inference latency in ms for autotune",
+                        required=False, default=100, type=float)
+    parser.add_argument("-autotune_clip", "--autotune_clip",
+                        help="Optional. Sample clip for autotune, first file source of the config by default",
+                        required=False, default=None, type=str)
+    parser.add_argument("-autotune_cache", "--autotune_cache",
+                        help="Optional. File autotune results are cached in",
+                        required=False, default="/tmp/itm_autotune.json", type=str)
+    parser.add_argument("-probe_timeout", "--probe_timeout",
+                        help="Optional. Seconds to wait for each source to deliver a frame when checking the config",
+                        required=False, default=PROBE_TIMEOUT, type=float)
+    parser.add_argument("-model_cache_dir", "--model_cache_dir",
+                        help="Optional. Directory of the OpenVINO compiled model cache, empty to disable",
+                        required=False, default="/tmp/itm_model_cache", type=str)
+    parser.add_argument("-port", "--port",
+                        help="Optional. Port of the web server",
+                        required=False, default=8000, type=int)
+    parser.add_argument("-shed_latency", "--shed_latency",
+                        help="Optional. Milliseconds from inference input to the end of processing of a frame, "
+                             "over which frames are shed, those of low activity and low priority channels first. "
+                             "All frames are processed while latency is under it. 0 disables shedding (default).",
+                        required=False, default=0, type=float)
+    parser.add_argument("-start_method", "--start_method",
+                        help="Optional. How analytics processes are started. With forkserver and spawn "
+                             "they don't inherit the memory of the web server.",
+                        required=False, default=analytics.START_METHODS[0],
+                        choices=analytics.START_METHODS, type=str)
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO,
                         format="%(asctime)s :: %(message)s")
+    # Before any process or shared object is created
+    multiprocessing.set_start_method(args.start_method)
+    if args.start_method == 'forkserver':
+        multiprocessing.set_forkserver_preload(analytics.PRELOAD)
     check_args(args)
+    PROBE_TIMEOUT = args.probe_timeout
+    if args.model_cache_dir:
+        os.makedirs(args.model_cache_dir, exist_ok=True)
+    if not 0 <= args.shard_index < args.shard_count:
+        log.error(f'Invalid shard index `{args.shard_index}` for {args.shard_count} shards.')
+        sys.exit(-1)
+    SHARD_INDEX, SHARD_COUNT = args.shard_index, args.shard_count
+    if args.cameras is not None:
+        try:
+            SHARD_CAMERAS = [int(ch_id) for ch_id in args.cameras.split(',') if ch_id.strip()]
+        except ValueError:
+            log.error(f'Invalid camera ids `{args.cameras}`.')
+            sys.exit(-1)
+    if args.peers:
+        PEERS = [peer.strip().rstrip('/') for peer in args.peers.split(',')]
+    if args.peer_insecure:
+        log.warning('Certificates of the other nodes are not verified.')
+        PEER_VERIFY = False
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    elif args.peer_ca:
+        PEER_VERIFY = args.peer_ca
+    sharded = SHARD_COUNT > 1 or SHARD_CAMERAS is not None
+    if sharded and not PEERS:
+        log.warning('Cameras of other nodes are not available without --peers.')
+    import influxdb
+    # Analytics processes connect on their own, a connected client can't be passed to them
+    influxdb_conf = {'host': args.influxdb_host, 'port': args.influxdb_port,
+                     'username': args.influxdb_username, 'password': args.influxdb_password,
+                     'database': args.influxdb_database}
     try:
-        client = influxdb.InfluxDBClient(host=args.influxdb_host, port=args.influxdb_port,
-                                         username=args.influxdb_username,
-                                         password=args.influxdb_password,
-                                         database=args.influxdb_database)
+        client = influxdb.InfluxDBClient(**influxdb_conf)
         # test and retry connecting influxdb
         i = -1
         while i<=20:
             i += 1
             try:
-                client.drop_database(args.influxdb_database)
+                client.get_list_database()
                 break
             except:
                 log.info('Retrying...')
                 time.sleep(1)
-        client.drop_database(args.influxdb_database)
+        # The database is shared by all nodes, only the first one recreates it
+        if not args.keep_database and SHARD_INDEX == 0:
+            client.drop_database(args.influxdb_database)
         client.create_database(args.influxdb_database)
     except influxdb.exceptions.InfluxDBClientError as err:
         log.error(f'Can\'t connect to InluxDB. \n{err}')
@@ -478,6 +1446,7 @@ def main():
         log.error(f'Error: Failed to connect to Influxdb container.\nDebug Info: {err}')
         sys.exit(-1)
 
+    STARTUP.mark('influxdb')
     GRAFANA_URL = f'http://{args.grafana_host}:{args.grafana_port}'
     INFLUXDB_URL = f'http://{args.influxdb_host}:{args.influxdb_port}'
     MAP_SERVER_URL = f'https://{HOST_IP}:{SERVER_PORT}'
@@ -486,27 +1455,93 @@ def main():
     log.info("GRAFANA_URL %s " % GRAFANA_URL)
     log.info("GRAFANA_EXTERNAL_URL %s" % GRAFANA_EXTERNAL_URL)
     CONFIG_PATH = args.config_path
+    SNAPSHOT_INTERVAL = args.snapshot_interval
+    GRAFANA_SNAPSHOT = args.grafana_snapshot
+    LIVE_INTERVAL = args.live_interval
 
     init_all(over_write=True)
+    # Per-channel resources are allocated up front for channels added by config reloads
+    MAX_CH = max(NUM_CH, args.max_channels)
     manager = Manager()
-    RUNNING = manager.list([False]*NUM_CH)
-    Q_DATA = {key:SimpleQueue() for key in range(0, NUM_CH)}
-    CURRENT_FRAMES = [None]*NUM_CH
+    RUNNING = manager.list([0]*MAX_CH)
+    try:
+        Q_DATA = {key:FrameSlot(args.frame_policy, args.frame_depth) for key in range(0, MAX_CH)}
+        if args.client_overlay:
+            META_DATA = {key:FrameSlot(args.frame_policy, args.frame_depth) for key in range(0, MAX_CH)}
+    except ValueError as err:
+        log.error(str(err))
+        sys.exit(-1)
+    CURRENT_FRAMES = [None]*MAX_CH
+    SNAPSHOT_LOCKS = {key:threading.Lock() for key in range(0, MAX_CH)}
+    LIVE_COUNTS = LiveCounts(MAX_CH, LIVE_INTERVAL)
+    HISTORY = CountHistory(MAX_CH)
+    CHANNEL_STATUS = ChannelStatus(MAX_CH)
     tracking = args.tracking or args.detect_collision
     collision = args.detect_collision
+    checkpoint = Checkpoint(args.checkpoint_dir, args.checkpoint_interval) if args.checkpoint_interval > 0 else None
+    trajectories = None
+    if args.trajectory_dir:
+        from trajectory import TrajectoryArchive
+        trajectories = TrajectoryArchive(args.trajectory_dir, args.trajectory_summary)
+    clips = None
+    if args.clip_dir:
+        if args.clip_fps <= 0 or args.clip_memory <= 0:
+            log.error('Error: clip_fps and clip_memory must be greater than 0')
+            sys.exit(-1)
+        from event_clips import ClipRecorder
+        clips = ClipRecorder(args.clip_dir, args.clip_pre, args.clip_post, int(args.clip_memory*1024*1024),
+                             args.clip_fps)
+    LOCAL_CHANNELS = [ch_id for ch_id in range(MAX_CH) if _is_local(ch_id)]
+    num_local = len([ch_id for ch_id in LOCAL_CHANNELS if ch_id < NUM_CH])
+    workers = analytics.plan_workers(max(1, num_local), args.workers)
+    tuning = run_autotune(args) if args.autotune else None
+    if args.autotune:
+        STARTUP.mark('autotune')
+    CONTROL = [Queue() for _ in range(workers)]
+    app_args = (CONF_DATA['cameras'], args.vp_model, args.vp_proc, tracking, collision, influxdb_conf, Q_DATA,
+                RUNNING, META_DATA, LIVE_COUNTS, HISTORY, checkpoint, CHANNEL_STATUS)
+    processes = []
     try:
-        # Start smart city analytics in separate process
-        process = Process(target=smartcity.start_app, args=(CONF_DATA['cameras'],
-                          args.vp_model, args.vp_proc, tracking,
-                          collision, client, Q_DATA, RUNNING))
-        process.start()
-        for c in CONF_DATA['cameras']:
-            _ = c.pop("path")
-            _ = c.pop("device")
-            _ = c.pop("analytics")
-        app.run(host=SERVER_HOST, port=8000, threaded=True, ssl_context=('itm.pem', 'itm-key.pem')) #Ignore bandit issue - [B104:hardcoded_bind_all_interfaces]
+        # Start smart city analytics in separate process(es)
+        if workers == 1 and not sharded:
+            cpus = analytics.worker_cpus(0, 1) if args.pin_workers else None
+            processes.append(Process(target=analytics.start_worker, args=app_args + (CONTROL[0],),
+                                     kwargs={'cpus': cpus, 'threads': CONF_DATA.get('threads'),
+                                             'tuning': tuning, 'model_cache_dir': args.model_cache_dir,
+                                             'shed_latency': args.shed_latency, 'trajectories': trajectories,
+                                             'clips': clips}))
+        else:
+            # Workers forward their counts, a single aggregator writes InfluxDB
+            from tracker import InfluxDB
+            reports = Queue()
+            aggregator = InfluxDB(client, MAX_CH)
+            if sharded:
+                # Totals over all nodes are written by the first node only
+                aggregator.write_totals = SHARD_INDEX == 0
+                aggregator.totals_source = _global_totals
+            aggregator.start(reports)
+            for i in range(workers):
+                cpus = analytics.worker_cpus(i, workers) if args.pin_workers else None
+                processes.append(Process(target=analytics.start_worker, args=app_args + (CONTROL[i],),
+                                         kwargs={'worker': i, 'workers': workers, 'reports': reports,
+                                                 'cpus': cpus, 'channels': LOCAL_CHANNELS,
+                                                 'threads': CONF_DATA.get('threads'), 'tuning': tuning,
+                                                 'model_cache_dir': args.model_cache_dir,
+                                                 'shed_latency': args.shed_latency,
+                                                 'trajectories': trajectories, 'clips': clips}))
+            log.info(f'Channels {LOCAL_CHANNELS[:num_local]} spread over {workers} analytics workers')
+        for process in processes:
+            process.start()
+        STARTUP.mark('analytics start')
+        STARTUP.report('Server')
+        if args.watch_interval > 0:
+            threading.Thread(target=watch_config, args=(args.watch_interval,), daemon=True).start()
+        if sharded and PEERS:
+            threading.Thread(target=poll_peers, args=(LIVE_INTERVAL/1000,), daemon=True).start()
+        app.run(host=SERVER_HOST, port=args.port, threaded=True, ssl_context=('itm.pem', 'itm-key.pem')) #Ignore bandit issue - [B104:hardcoded_bind_all_interfaces]
     except KeyboardInterrupt:
-        process.terminate()
+        for process in processes:
+            process.terminate()
 
 
 if __name__=='__main__':
@@ -0,0 +1,145 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import sys
+import time
+import logging
+import subprocess
+from urllib.parse import urlsplit
+from argparse import ArgumentParser
+import requests
+import urllib3
+
+log = logging.getLogger(__name__)
+
+
+def start_nodes(num_nodes, base_port, server_args):
+    """
+    Start <num_nodes> server.py processes on localhost sharing the cameras, return the processes and their urls
+    """
+    peers = [f'https://localhost:{base_port + i}' for i in range(num_nodes)]
+    processes = []
+    for i in range(num_nodes):
+        cmd = [sys.executable, 'server.py', '--shard_count', str(num_nodes), '--shard_index', str(i),
+               '--port', str(base_port + i), '--peers', ','.join(peers), '--peer_insecure'] + server_args
+        log.info(f'Starting node {i}: {" ".join(cmd)}')
+        processes.append(subprocess.Popen(cmd))
+    return processes, peers
+
+
+def get(url, timeout=5):
+    """
+    GET <url> from a node, the nodes serve the self-signed certificate of the image
+    """
+    return requests.get(url, timeout=timeout, verify=False) #Ignore bandit issue - [B501:request_with_no_cert_validation]
+
+
+def wait_nodes(peers, processes, timeout):
+    """
+    Wait until every node answers /api/shard, return False on timeout or if a node exits
+    """
+    deadline = time.monotonic() + timeout
+    pending = list(peers)
+    while pending and time.monotonic() < deadline:
+        if any(process.poll() is not None for process in processes):
+            log.error('A node exited during startup.')
+            return False
+        for peer in list(pending):
+            try:
+                if get(peer + '/api/shard').status_code == 200:
+                    pending.remove(peer)
+            except requests.RequestException:
+                pass
+        time.sleep(1)
+    if pending:
+        log.error(f'Nodes not ready after {timeout} s: {pending}')
+    return not pending
+
+
+def check_nodes(peers):
+    """
+    Check that the nodes partition the cameras and serve all of them to clients, return list of failures
+    """
+    failures = []
+    owners = {}
+    for index, peer in enumerate(peers):
+        shard = get(peer + '/api/shard').json()
+        for ch_id in shard['channels']:
+            owners.setdefault(int(ch_id), []).append(index)
+        for key, url in shard.get('urls', {}).items():
+            if '@' in urlsplit(url).netloc:
+                failures.append(f'Node {index} shares dashboard url of channel {key} with credentials')
+    for ch_id, nodes in sorted(owners.items()):
+        if nodes != [ch_id % len(peers)]:
+            failures.append(f'Channel {ch_id} is served by nodes {nodes}, expected node {ch_id % len(peers)}')
+    for index, peer in enumerate(peers):
+        listed = sorted(status['channel'] for status in get(peer + '/api/channels').json())
+        if listed != sorted(owners):
+            failures.append(f'Node {index} lists channels {listed}, expected {sorted(owners)}')
+        counted = sorted(int(ch_id) for ch_id in get(peer + '/api/counts').json()['channels'])
+        if counted != sorted(owners):
+            failures.append(f'Node {index} counts channels {counted}, expected {sorted(owners)}')
+        for ch_id in owners:
+            # Remote snapshots are proxied to the owner, 503 only means no frame yet
+            status = get(f'{peer}/camera/{ch_id}/snapshot.jpg', timeout=10).status_code
+            if status not in [200, 503]:
+                failures.append(f'Node {index} answers {status} for the snapshot of channel {ch_id}')
+    return failures
+
+
+def main():
+    """
+    Main Function
+    """
+    parser = ArgumentParser(description='Run several ITM nodes on this host and check they share the cameras. '
+                                        'Arguments not listed here are passed to server.py.')
+    parser.add_argument("-n", "--nodes",
+                        help="Optional. Number of nodes",
+                        required=False, default=2, type=int)
+    parser.add_argument("-base_port", "--base_port",
+                        help="Optional. Port of the first node, node <i> listens on base_port + i",
+                        required=False, default=8000, type=int)
+    parser.add_argument("-startup_timeout", "--startup_timeout",
+                        help="Optional. Seconds to wait for the nodes to start",
+                        required=False, default=300, type=int)
+    parser.add_argument("-settle", "--settle",
+                        help="Optional. Seconds the nodes poll each other before the checks",
+                        required=False, default=10, type=int)
+    args, server_args = parser.parse_known_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s :: %(message)s")
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    processes, peers = start_nodes(args.nodes, args.base_port, server_args)
+    try:
+        if not wait_nodes(peers, processes, args.startup_timeout):
+            sys.exit(-1)
+        time.sleep(args.settle)
+        failures = check_nodes(peers)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+    for failure in failures:
+        log.error(failure)
+    if failures:
+        sys.exit(-1)
+    log.info(f'{args.nodes} nodes share the cameras correctly.')
+
+
+if __name__=='__main__':
+    main()
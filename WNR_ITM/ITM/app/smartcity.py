@@ -14,21 +14,28 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import os
 import sys
 import time
 import json
 import math
 import logging
-from queue import Queue
+from queue import Queue, Empty
 from argparse import ArgumentParser
 from gstgva import VideoFrame, util
+import numpy as np
 import cv2
 import influxdb
 import gi
-from gi.repository import Gst
+from gi.repository import Gst, GLib
 import yolo_labels
+import validate_config
+import analytics
 from utils import Point, Rect
-from tracker import SingleTracker, TrackingManager, TrackingSystem, InfluxDB
+from roi import RoiMask
+from scheduler import Scheduler, DEFAULT_PRIORITY
+from startup_timing import StartupTimer, since_start
+from tracker import SingleTracker, TrackingManager, TrackingSystem, InfluxDB, get_text_size
 
 gi.require_version('GObject', '2.0')
 gi.require_version('Gst', '1.0')
@@ -37,6 +44,30 @@ log = logging.getLogger(__name__)
 tracking_system = []
 TRACKING = True
 COLLISION = True
+CHECKPOINT = None
+# Recorder of collision clips, None if no clips are kept
+CLIPS = None
+# Frame budget of the channels, None if all frames are processed
+SCHEDULER = None
+MODEL_CACHE_DIR = None
+# Region of interest of each channel, rebuilt when its config changes
+ROI_MASKS = {}
+# Columns of the detections array of a frame, see extract_detections
+DET_X, DET_Y, DET_W, DET_H, DET_CONFIDENCE, DET_LABEL = range(6)
+# Label id of the model, analytics type enabling it and tracker label it maps to
+MODEL_LABELS = [(0, 'vehicle', yolo_labels.LABEL_CAR),
+                (1, 'pedestrian', yolo_labels.LABEL_PERSON),
+                (2, 'bike', yolo_labels.LABEL_BICYCLE)]
+# Lookup tables of model label id to tracker label, -1 if dropped, per analytics string
+LABEL_TABLES = {}
+# Size of the frames tracked and delivered to viewers, unless set by `output_resolution` of the camera
+OUTPUT_RESOLUTION = [640, 320]
+# Jitter buffer of network cameras in ms, unless set by `rtsp_latency` of the camera
+RTSP_LATENCY = 200
+# Decoded frames queued before inference on live sources, older frames are dropped
+LIVE_QUEUE_SIZE = 1
+# Thread counts used before thread budgeting, 0 keeps the element default
+FIXED_THREADS = {'decode': 0, 'convert': 4, 'scale': 4, 'inference': 0, 'streams': 0}
 
 
 class FpsManager:
@@ -47,6 +78,10 @@ class FpsManager:
         self.num_ch = num_ch
         self.st_time = [0]*num_ch
         self.frame_counts = [0]*num_ch
+        # Seconds from container start to the first processed frame
+        self.first_frame = [0]*num_ch
+        # Seconds from capture to the end of analytics of live sources, moving average
+        self.latency = [0.0]*num_ch
 
     def update_ch(self, ch_id):
         """
@@ -55,115 +90,369 @@ class FpsManager:
         """
         if self.st_time[ch_id] == 0:
             self.st_time[ch_id] = time.monotonic()
+            self.first_frame[ch_id] = since_start()
+            log.info(f'Channel {ch_id} first frame processed {self.first_frame[ch_id]:.2f} s after container start')
 
         self.frame_counts[ch_id] += 1
         t = time.monotonic()
         fps = round(self.frame_counts[ch_id]/(t - self.st_time[ch_id]), 2)
         return fps
 
+    def reset(self, ch_id):
+        """
+        Reset counters of channel <ch_id>
+        """
+        self.st_time[ch_id] = 0
+        self.frame_counts[ch_id] = 0
+        self.first_frame[ch_id] = 0
+        self.latency[ch_id] = 0.0
+
+    def update_latency(self, ch_id, latency):
+        """
+        Add capture to analytics <latency> of one frame of channel <ch_id> to its average
+        """
+        self.latency[ch_id] += 0.1*(latency - self.latency[ch_id])
+
+    def get_fps(self, ch_id):
+        """
+        Return average FPS for channel <ch_id> without counting a frame
+        """
+        if self.st_time[ch_id] == 0:
+            return 0
+        return round(self.frame_counts[ch_id]/(time.monotonic() - self.st_time[ch_id]), 2)
+
+
+def draw_fps(mat, fps):
+    """
+    Draw FPS box on top-left corner of the frame
+    """
+    scale, thickness, font = 0.7, 2, cv2.FONT_HERSHEY_SIMPLEX
+    text = f'FPS: {fps}'
+    (text_width, text_height) = get_text_size(text, font, scale, thickness)
+    offset_x, offset_y = 10, 20
+    box_coords = ((offset_x, offset_y), (offset_x + text_width + 2, offset_y - text_height - 2))
+    cv2.rectangle(mat, box_coords[0], box_coords[1], (255, 255, 255), cv2.FILLED)
+    cv2.putText(mat, text, (offset_x, offset_y), font, scale, (0, 0, 0), 1)
+
+
+def draw_detections(mat, detections):
+    """
+    Draw raw detections on frame, used when tracking is disabled
+    """
+    scale, thickness, font = 0.7, 2, cv2.FONT_HERSHEY_SIMPLEX
+    for rect, label in detections:
+        cv2.rectangle(mat, (int(rect.x), int(rect.y)),
+                      (int(rect.x + rect.width), int(rect.y + rect.height)),
+                      (0, 255, 255), 2)
+        text = yolo_labels.get_label_str(label)
+        (text_width, text_height) = get_text_size(text, font, scale, thickness)
+        box_coords = ((rect.x, rect.y), (rect.x + text_width + 2, rect.y - text_height - 2))
+        cv2.rectangle(mat, box_coords[0], box_coords[1], (0, 255, 255), cv2.FILLED)
+        cv2.putText(mat, text, (rect.x, rect.y), font, scale, (0, 0, 0), 1)
 
-def frame_callback(frame: VideoFrame, conf_data, fps_manager, ch_id, q_data, running):
+
+def detection_metadata(detections):
+    """
+    Return compact metadata rows of raw detections, used when tracking is disabled.
+    Row layout is the same as TrackingSystem.get_metadata().
+    """
+    return [[-1, int(rect.x), int(rect.y), int(rect.width), int(rect.height), label, 0, 0, 0, '#ffff00']
+            for rect, label in detections]
+
+
+def roi_mask(ch_id, conf, width, height):
+    """
+    Return RoiMask of channel <ch_id> for frames of <width>x<height>, None if the camera has no `roi`
+    """
+    if 'roi' not in conf:
+        return None
+    mask = ROI_MASKS.get(ch_id)
+    if mask is None or mask.polygons is not conf['roi'] or (mask.width, mask.height) != (width, height):
+        mask = RoiMask(conf['roi'], width, height)
+        ROI_MASKS[ch_id] = mask
+    return mask
+
+
+def label_table(analytics):
+    """
+    Return lookup table of model label id to tracker label for the <analytics> of a camera,
+    -1 for labels that are not analysed
     """
-    Frame callback function. Draw bounding boxes, track and detects collision.
+    table = LABEL_TABLES.get(analytics)
+    if table is None:
+        table = np.full(len(MODEL_LABELS), -1, np.int32)
+        for model_label, name, label in MODEL_LABELS:
+            if name in analytics:
+                table[model_label] = label
+        LABEL_TABLES[analytics] = table
+    return table
+
+
+def extract_detections(frame):
+    """
+    Return detections of <frame> as (N, 6) array, columns DET_X to DET_LABEL.
+    Box and detection tensor of each region are read once.
+    """
+    rows = []
+    for region in frame.regions():
+        detection = region.detection()
+        if detection is None:
+            continue
+        meta = region.meta()
+        rows.append((meta.x, meta.y, meta.w, meta.h, detection.confidence(), detection.label_id()))
+    return np.array(rows, np.float32).reshape(-1, 6)
+
+
+def filter_detections(detections, analytics, mask=None, threshold=0.5):
+    """
+    Return (boxes, tracker labels) of <detections> above <threshold> with a label
+    in <analytics>, inside RoiMask <mask> if given
+    """
+    table = label_table(analytics)
+    model_labels = detections[:, DET_LABEL].astype(np.int32)
+    valid = (detections[:, DET_CONFIDENCE] >= threshold) & (model_labels >= 0) & (model_labels < len(table))
+    labels = np.full(len(detections), -1, np.int32)
+    labels[valid] = table[model_labels[valid]]
+    keep = labels >= 0
+    if mask is not None:
+        keep &= mask.contains(detections[:, DET_X:DET_H + 1])
+    return detections[keep, DET_X:DET_H + 1].astype(np.int32), labels[keep]
+
+
+def frame_callback(frame: VideoFrame, conf_data, fps_manager, ch_id, q_data, running, meta_data=None,
+                   timestamp=None):
+    """
+    Frame callback function. Track and detect collision on every frame,
+    draw bounding boxes only when the channel has an active viewer.
+    If <meta_data> is given, frames are delivered clean together with their overlays
+    as metadata, drawn by the client or the web server. Metadata alone is published to
+    <meta_data> for its own consumers, so they don't cause frames to be delivered.
     :param frame: VideoFrame object
     :param conf_data: Configuration from configuration file
     :param fps_manager: Object of FpsManager class, to calculate FPS
     :param ch_id: Channel ID
-    :param q_data: Interprocess dictionary, where keys are channel ids and values are multiprocess queues (SimpleQueue)
-    :param running: Interprocess list. Indicator for populating queues
+    :param q_data: Interprocess dictionary, where keys are channel ids and values are bounded frame slots (FrameSlot)
+                   of (sequence number, frame, metadata or None) items
+    :param running: Interprocess list. Number of frame viewers per channel, frames are delivered only if non-zero
+    :param meta_data: Optional. Interprocess dictionary, where keys are channel ids and values are metadata slots (FrameSlot)
+    :param timestamp: Optional. Time of the frame in seconds, kinematics of the trackers are computed from it
     """
     fps = fps_manager.update_ch(ch_id)
-    scale, thickness, font = 0.7, 2, cv2.FONT_HERSHEY_SIMPLEX
-    first_results = []
+    seq = fps_manager.frame_counts[ch_id]
+    try:
+        # Interprocess lookups, read once per frame
+        watched = running[ch_id]
+        meta_watched = meta_data is not None and meta_data[ch_id].viewers > 0
+    except FileNotFoundError:
+        sys.exit()
     width = frame.video_info().width
     height = frame.video_info().height
-    with frame.data() as mat:
-        text = f'FPS: {fps}'
-        (text_width, text_height) = cv2.getTextSize(text, font, scale, thickness)[0]
-        offset_x, offset_y = 10, 20
-        box_coords = ((offset_x, offset_y), (offset_x + text_width + 2, offset_y - text_height - 2))
-        cv2.rectangle(mat, box_coords[0], box_coords[1], (255, 255, 255), cv2.FILLED)
-        cv2.putText(mat, text, (offset_x, offset_y), font, scale, (0, 0, 0), 1)
-        for roi in frame.regions():
-            if roi.confidence() < 0.5:
-                continue
-            rect = roi.rect()
-            label = roi.label_id()
-            if label == 1 and 'pedestrian' in conf_data[ch_id]['analytics']:
-                label = yolo_labels.LABEL_PERSON
-                color = yolo_labels.COLOR_PERSON
-            elif label == 0 and 'vehicle' in conf_data[ch_id]['analytics']:
-                label = yolo_labels.LABEL_CAR
-                color = yolo_labels.COLOR_CAR
-            elif label == 2 and 'bike' in conf_data[ch_id]['analytics']:
-                label = yolo_labels.LABEL_BICYCLE
-                color = yolo_labels.COLOR_BIKE
-            else:
-                continue
-
-            if TRACKING:
-                first_results.append((Rect(rect.x, rect.y, rect.w, rect.h), label))
-            else:
-                cv2.rectangle(mat, (int(rect.x), int(rect.y)),
-                              (int(rect.x + rect.w), int(rect.y + rect.h)),
-                              (0, 255, 255), 2)
-                text = yolo_labels.get_label_str(label)
-                (text_width, text_height) = cv2.getTextSize(text, font, scale, thickness)[0]
-                box_coords = ((rect.x, rect.y), (rect.x + text_width + 2, rect.y - text_height - 2))
-                cv2.rectangle(mat, box_coords[0], box_coords[1], (0, 255, 255), cv2.FILLED)
-                cv2.putText(mat, text, (rect.x, rect.y), font, scale, (0, 0, 0), 1)
+    mask = roi_mask(ch_id, conf_data[ch_id], width, height)
+    boxes, labels = filter_detections(extract_detections(frame), conf_data[ch_id]['analytics'], mask)
+    if CLIPS is not None:
+        clip_time = time.monotonic() if timestamp is None else timestamp
+        if CLIPS.due(ch_id, clip_time):
+            # Clean frame, before overlays are drawn for viewers
+            with frame.data() as mat:
+                CLIPS.add_frame(ch_id, clip_time, mat)
+    # Only detections passing the filters become tracker inputs
+    first_results = [(Rect(x, y, w, h), label) for (x, y, w, h), label in zip(boxes.tolist(), labels.tolist())]
+
+    if TRACKING:
+        if not tracking_system[ch_id].is_initialized:
+            tracking_system[ch_id].init_tracker_system(width, height, first_results, len(conf_data))
+        tracking_system[ch_id].update_tracking_system(first_results)
+        tracking_success = tracking_system[ch_id].start_tracking(timestamp)
+        if not tracking_success:
+            log.error('Tracking failed')
+            sys.exit(-1)
+        if (tracking_system[ch_id].manager.tracker_vec) != 0:
+            if COLLISION and ('vehicle' in conf_data[ch_id]['analytics'] or 'bike' in conf_data[ch_id]['analytics']):
+                tracking_system[ch_id].detect_collision()
+        if CHECKPOINT is not None:
+            CHECKPOINT.maybe_save(ch_id, tracking_system[ch_id])
 
+    if not watched and not meta_watched:
+        time.sleep(0.005)
+        return
+    if meta_data is not None:
+        objects = tracking_system[ch_id].get_metadata() if TRACKING else detection_metadata(first_results)
+        meta = {'seq': seq, 'w': width, 'h': height, 'fps': fps, 'objects': objects}
+        try:
+            if meta_watched:
+                meta_data[ch_id].put(meta)
+            if watched:
+                with frame.data() as mat:
+                    # Items are pickled later by the queue feeder thread, after the buffer is unmapped
+                    q_data[ch_id].put((seq, mat.copy(), meta))
+        except FileNotFoundError:
+            sys.exit()
+        return
+    with frame.data() as mat:
+        draw_fps(mat, fps)
         if TRACKING:
-            if not tracking_system[ch_id].is_initialized:
-                tracking_system[ch_id].init_tracker_system(width, height, first_results, len(conf_data))
-            tracking_system[ch_id].update_tracking_system(first_results)
-            tracking_success = tracking_system[ch_id].start_tracking(mat)
-            if not tracking_success:
-                log.error('Tracking failed')
-                sys.exit(-1)
-            if (tracking_system[ch_id].manager.tracker_vec) != 0:
-                if COLLISION and ('vehicle' in conf_data[ch_id]['analytics'] or 'bike' in conf_data[ch_id]['analytics']):
-                    tracking_system[ch_id].detect_collision()
-                tracking_system[ch_id].draw_tracking_results(mat)
+            tracking_system[ch_id].draw_tracking_results(mat)
+        else:
+            draw_detections(mat, first_results)
         try:
-            if running[ch_id]:
-                q_data[ch_id].put(mat)
-            else:
-                time.sleep(0.005)
+            # Items are pickled later by the queue feeder thread, after the buffer is unmapped
+            q_data[ch_id].put((seq, mat.copy(), None))
         except FileNotFoundError:
             sys.exit()
 
 
-def pad_probe_callback(pad, info, conf_data, fps_manager, ch_id, q_data, running):
+def inference_probe_callback(pad, info, conf_data, ch_id):
+    """
+    Shed frames of channel <ch_id> over its budget before inference.
+    Attach the inference crops of the channel to kept frames, gvadetect runs only on them.
+    Crops have confidence 0 so the frame callback never takes them for detections.
+    """
+    with util.GST_PAD_PROBE_INFO_BUFFER(info) as buffer:
+        if SCHEDULER is not None and not SCHEDULER.admit(ch_id, buffer.pts):
+            return Gst.PadProbeReturn.DROP
+        if 'roi' not in conf_data[ch_id]:
+            return Gst.PadProbeReturn.OK
+        frame = VideoFrame(buffer, caps=pad.get_current_caps())
+        video_info = frame.video_info()
+        mask = roi_mask(ch_id, conf_data[ch_id], video_info.width, video_info.height)
+        if mask is not None:
+            for x, y, w, h in mask.crops:
+                frame.add_region(x, y, w, h, 'roi', 0.0)
+    return Gst.PadProbeReturn.OK
+
+
+def pad_probe_callback(pad, info, conf_data, fps_manager, ch_id, q_data, running, meta_data):
     """
     Set callback
     """
     with util.GST_PAD_PROBE_INFO_BUFFER(info) as buffer:
         caps = pad.get_current_caps()
         frame = VideoFrame(buffer, caps=caps)
-        frame_callback(frame, conf_data, fps_manager, ch_id, q_data, running)
+        # Frames dropped upstream leave gaps in the PTS, not in the kinematics
+        timestamp = buffer.pts/Gst.SECOND if buffer.pts != Gst.CLOCK_TIME_NONE else None
+        frame_callback(frame, conf_data, fps_manager, ch_id, q_data, running, meta_data, timestamp)
+        if SCHEDULER is not None:
+            SCHEDULER.done(ch_id, buffer.pts)
+        if timestamp is not None and is_live(conf_data[ch_id]):
+            # Buffers of live sources are stamped with the running time of their capture
+            element = pad.get_parent_element()
+            clock = element.get_clock()
+            if clock is not None:
+                running_time = clock.get_time() - element.get_base_time()
+                fps_manager.update_latency(ch_id, (running_time - buffer.pts)/Gst.SECOND)
     return Gst.PadProbeReturn.OK
 
 
-def create_launch_string(conf_data, vp_model, vp_proc, show_output):
+def is_live(conf):
+    """
+    Return True if camera <conf> is a live source, a network or V4L2 camera
+    """
+    return '://' in conf['path'] or '/dev/video' in conf['path']
+
+
+def plan_threads(num_ch, overrides=None, cores=None):
+    """
+    Divide <cores> between decode, colour conversion, scaling and inference of
+    <num_ch> channels, all cores usable by this process if None. Inference gets
+    half of the cores, the rest is shared by the per-channel elements.
+    Values given in <overrides> take precedence, 0 keeps the element default.
+    """
+    cores = cores or len(os.sched_getaffinity(0))
+    inference = max(1, cores//2)
+    per_channel = max(1, (cores - inference)//max(1, num_ch))
+    plan = {'decode': max(1, per_channel//2),
+            'convert': min(4, max(1, per_channel//4)),
+            'scale': min(4, max(1, per_channel//4)),
+            'inference': inference,
+            'streams': max(1, min(num_ch, inference//2))}
+    plan.update(overrides or {})
+    return plan
+
+
+def inference_properties(conf, threads):
+    """
+    Return gvadetect properties of one channel. Channels with the same model
+    instance id share one loaded network and its inference requests.
+    """
+    properties = f"model-instance-id={validate_config.model_instance_id(conf)} "
+    if 'inference_resolution' in conf:
+        # Detections are relative to the frame, they need no mapping back to the output resolution
+        width, height = conf['inference_resolution']
+        properties += f"reshape=true reshape-width={width} reshape-height={height} "
+    if 'roi' in conf:
+        # Inference on the crops attached by inference_probe_callback instead of the full frame
+        properties += "inference-region=roi-list "
+    if 'batch_size' in conf:
+        properties += f"batch-size={conf['batch_size']} "
+    if 'nireq' in conf:
+        properties += f"nireq={conf['nireq']} "
+    ie_config = []
+    if conf['device'] == 'CPU':
+        if threads['inference']:
+            ie_config.append(f"CPU_THREADS_NUM={threads['inference']}")
+        if threads['streams']:
+            ie_config.append(f"CPU_THROUGHPUT_STREAMS={threads['streams']}")
+    if MODEL_CACHE_DIR:
+        # Compiled networks are cached on disk, later (re)starts skip compilation
+        ie_config.append(f"CACHE_DIR={MODEL_CACHE_DIR}")
+    if ie_config:
+        properties += f"ie-config={','.join(ie_config)} "
+    return properties
+
+
+def create_channel_chain(conf, ch_id, vp_model, vp_proc, threads=None):
+    """
+    Create source to gvadetect part of the pipeline of one channel.
+    <threads> is the thread plan (see plan_threads), FIXED_THREADS if None.
+    Decoder threads are set on the decoder created by decodebin, see ChannelPipeline.
+    Frames are scaled to the output resolution of the camera, gvadetect scales them
+    again to the network input, reshaped to `inference_resolution` if set.
+    Live sources keep only the newest decoded frames, so a stalled link or a busy
+    inference device does not build up delay. The jitter buffer and transport of
+    network cameras are set on the source created by urisourcebin, see ChannelPipeline.
+    """
+    threads = threads or FIXED_THREADS
+    convert = f" n-threads={threads['convert']}" if threads['convert'] else ""
+    scale = f" n-threads={threads['scale']}" if threads['scale'] else ""
+    width, height = conf.get('output_resolution', OUTPUT_RESOLUTION)
+    if '/dev/video' in conf['path']:
+        source = "v4l2src device"
+    elif '://' in conf['path']:
+        source = f"urisourcebin name={'source'+str(ch_id)} buffer-size=4096 uri"
+    else:
+        source = "filesrc location"
+    live = f"! queue leaky=downstream max-size-buffers={LIVE_QUEUE_SIZE} max-size-bytes=0 max-size-time=0 " \
+        if is_live(conf) else ""
+    return f"{source}=\"{conf['path']}\" ! decodebin {live}! videoconvert{convert} ! videoscale{scale} " \
+           f"! video/x-raw,format=BGR,width={width},height={height} " \
+           f"! gvadetect name={'gvadetect'+str(ch_id)} model=\"{vp_model}\" model_proc=\"{vp_proc}\" device={conf['device']} " \
+           f"{inference_properties(conf, threads)}"
+
+
+def create_channel_launch_string(conf, ch_id, vp_model, vp_proc, threads=None):
+    """
+    Create gstreamer pipeline of one channel
+    """
+    return create_channel_chain(conf, ch_id, vp_model, vp_proc, threads) + "! fakesink sync=false"
+
+
+def create_launch_string(conf_data, vp_model, vp_proc, show_output, threads=None, ch_ids=None):
     """
-    Create gstreamer pipeline
+    Create gstreamer pipeline of all channels.
+    <ch_ids> are the channel ids of the configs in <conf_data>, elements are named by them
+    (see set_callbacks). Positions in <conf_data> are used if None.
+    Without <threads> the thread plan is made for the number of channels.
     """
-    width, height = 640, 320
+    width, height = OUTPUT_RESOLUTION
     num_ch = len(conf_data)
+    threads = threads or plan_threads(num_ch)
+    ch_ids = ch_ids or range(num_ch)
     pipeline = ''
-    for i, conf in enumerate(conf_data):
-        if '/dev/video' in conf['path']:
-            source = "v4l2src device"
-        elif '://' in conf['path']:
-            source = "urisourcebin buffer-size=4096 uri"
-        else:
-            source = "filesrc location"
-
-        pipeline += f"{source}=\"{conf['path']}\" ! decodebin ! videoconvert n-threads=4 ! videoscale n-threads=4 " \
-                    f"! video/x-raw,format=BGR,width={width},height={height} " \
-                    f"! gvadetect name={'gvadetect'+str(i)} model=\"{vp_model}\" model_proc=\"{vp_proc}\" device={conf['device']} "
+    for i, (ch_id, conf) in enumerate(zip(ch_ids, conf_data)):
+        pipeline += create_channel_chain(conf, ch_id, vp_model, vp_proc, threads)
         if show_output:
+            # Mixer tiles have the default output resolution
+            pipeline += f"! videoscale ! video/x-raw,width={width},height={height} "
             pipeline += f"! queue  leaky=downstream max-size-buffers=4294967295 max-size-bytes=4294967295 " \
                         f" max-size-time=100000000000 name={'queue'+str(i)} ! m.sink_{i} "
     if show_output:
@@ -185,53 +474,458 @@ def create_launch_string(conf_data, vp_model, vp_proc, show_output):
     return pipeline
 
 
-def set_callbacks(pipeline, conf_data, q_data, running):
+def set_callbacks(pipeline, conf_data, fps_manager, ch_ids, q_data, running, meta_data=None):
     """
-    Set callback for each channel
+    Set callback for each channel in <ch_ids>
     """
-    num_ch = len(conf_data)
-    fps_manager = FpsManager(num_ch)
-    for ch_id in range(num_ch):
+    for ch_id in ch_ids:
         gvadetect = pipeline.get_by_name('gvadetect'+str(ch_id))
         pad = gvadetect.get_static_pad('src')
-        pad.add_probe(Gst.PadProbeType.BUFFER, pad_probe_callback, conf_data, fps_manager, ch_id, q_data, running)
+        pad.add_probe(Gst.PadProbeType.BUFFER, pad_probe_callback, conf_data, fps_manager, ch_id, q_data, running, meta_data)
+        if SCHEDULER is not None or (conf_data[ch_id] and 'roi' in conf_data[ch_id]):
+            gvadetect.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, inference_probe_callback,
+                                                       conf_data, ch_id)
+
+
+class ChannelPipeline:
+    """
+    GStreamer pipeline of one or more channels with its own bus watch.
+    On error only this pipeline is torn down and restarted, with exponential backoff.
+    On EOS it is restarted immediately, looping file sources.
+    """
+    MIN_BACKOFF = 1
+    MAX_BACKOFF = 30
+    # Backoff is reset once the pipeline has been up for this many seconds
+    STABLE_TIME = 60
+
+    def __init__(self, ch_ids, launch_string, conf_data, fps_manager, q_data, running, meta_data=None,
+                 decode_threads=0):
+        self.ch_ids = ch_ids
+        self.launch_string = launch_string
+        self.decode_threads = decode_threads
+        self.callback_args = (conf_data, fps_manager, ch_ids, q_data, running, meta_data)
+        self.pipeline = None
+        self.bus = None
+        self.start_time = None
+        self.restarts = 0
+        self.errors = 0
+        self.backoff = ChannelPipeline.MIN_BACKOFF
+        self.active = True
+
+    def uptime(self):
+        """
+        Return seconds since the pipeline was last started, 0 if it is not running
+        """
+        if self.start_time is None:
+            return 0
+        return time.monotonic() - self.start_time
+
+    def start(self):
+        """
+        Create and start the pipeline. Used as one-shot GLib timeout callback.
+        """
+        if not self.active:
+            return False
+        try:
+            self.pipeline = Gst.parse_launch(self.launch_string)
+            set_callbacks(self.pipeline, *self.callback_args)
+            conf_data = self.callback_args[0]
+            if self.decode_threads or any('://' in conf_data[ch_id]['path'] for ch_id in self.ch_ids):
+                self.pipeline.connect('deep-element-added', self.on_element_added)
+            self.bus = self.pipeline.get_bus()
+            self.bus.add_signal_watch()
+            self.bus.connect('message', self.on_message)
+            if self.pipeline.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+                raise RuntimeError('Unable to set the pipeline to the playing state')
+            self.start_time = time.monotonic()
+            log.info(f'Pipeline of channel(s) {self.ch_ids} started..')
+        except Exception as err:
+            log.error(f'Error: Failed to start pipeline of channel(s) {self.ch_ids}: {err}')
+            self.errors += 1
+            self.restart(self.next_backoff())
+        return False
+
+    def stop(self):
+        """
+        Stop and release the pipeline
+        """
+        if self.bus is not None:
+            self.bus.remove_signal_watch()
+            self.bus = None
+        if self.pipeline is not None:
+            self.pipeline.set_state(Gst.State.NULL)
+            self.pipeline = None
+        self.start_time = None
+        if CHECKPOINT is not None:
+            for ch_id in self.ch_ids:
+                CHECKPOINT.maybe_save(ch_id, tracking_system[ch_id], force=True)
+
+    def close(self):
+        """
+        Stop the pipeline for good, pending restarts are cancelled
+        """
+        self.active = False
+        self.stop()
+
+    def restart(self, delay):
+        """
+        Stop the pipeline and start it again after <delay> seconds
+        """
+        self.stop()
+        self.restarts += 1
+        GLib.timeout_add(int(delay*1000), self.start)
+
+    def next_backoff(self):
+        """
+        Return current backoff and double it for the next failure
+        """
+        delay = self.backoff
+        self.backoff = min(self.backoff*2, ChannelPipeline.MAX_BACKOFF)
+        return delay
+
+    def on_element_added(self, pipeline, sub_bin, element):
+        """
+        Limit threads of the decoder selected by decodebin and
+        set jitter buffer and transport of the RTSP source of a network camera
+        """
+        factory = element.get_factory()
+        if factory is None:
+            return
+        name = factory.get_name()
+        if self.decode_threads and name.startswith('avdec_') and element.find_property('max-threads') is not None:
+            element.set_property('max-threads', self.decode_threads)
+        elif name == 'rtspsrc' and sub_bin.get_name().startswith('source'):
+            conf = self.callback_args[0][int(sub_bin.get_name()[len('source'):])]
+            # Late packets are dropped instead of delaying the whole stream after a link hiccup
+            element.set_property('latency', conf.get('rtsp_latency', RTSP_LATENCY))
+            element.set_property('drop-on-latency', True)
+            if 'rtsp_transport' in conf:
+                Gst.util_set_object_arg(element, 'protocols', conf['rtsp_transport'])
+
+    def on_message(self, bus, msg):
+        """
+        Bus watch, called from the main loop
+        """
+        if msg.type == Gst.MessageType.EOS:
+            log.info(f'Pipeline of channel(s) {self.ch_ids} completed. Loop again...')
+            self.restart(0)
+        elif msg.type == Gst.MessageType.ERROR:
+            err, debug = msg.parse_error()
+            log.error(f'Error in channel(s) {self.ch_ids}: {err}\nAdditional debug info: {debug}')
+            self.errors += 1
+            if self.uptime() > ChannelPipeline.STABLE_TIME:
+                self.backoff = ChannelPipeline.MIN_BACKOFF
+            delay = self.next_backoff()
+            log.info(f'Restarting channel(s) {self.ch_ids} in {delay} s')
+            self.restart(delay)
+        return True
+
+
+class ChannelController:
+    """
+    Owns the pipelines of all channels and applies configuration changes
+    received from the web process without touching other channels.
+    """
+    # Keys of the camera config that require the pipeline to be rebuilt
+    PIPELINE_KEYS = ['path', 'device', 'analytics', 'model_instance_id', 'batch_size', 'nireq', 'roi',
+                     'inference_resolution', 'output_resolution', 'rtsp_transport', 'rtsp_latency']
+    # Keys of the camera config that change the image, live trackers are dropped when they change
+    SCENE_KEYS = ['path', 'output_resolution']
+
+    def __init__(self, conf_data, vp_model, vp_proc, client, q_data, running, meta_data=None,
+                 channel_status=None, threads=None, tuning=None, cores=None):
+        """
+        :param conf_data: List of camera configs indexed by channel id, None for unused channels
+        :param threads: Optional. Thread counts overriding the thread plan
+        :param cores: Optional. Number of cores the thread plan divides, all usable cores if None
+        :param tuning: Optional. Autotuned inference settings per device, used unless set in camera config
+        """
+        self.conf_data = conf_data
+        self.vp_model = vp_model
+        self.vp_proc = vp_proc
+        self.client = client
+        self.q_data = q_data
+        self.running = running
+        self.meta_data = meta_data
+        self.channel_status = channel_status
+        self.threads = threads
+        self.tuning = tuning or {}
+        self.cores = cores
+        self.fps_manager = FpsManager(len(conf_data))
+        self.pipelines = {}
+
+    def start_channel(self, ch_id):
+        """
+        Create and start the pipeline of channel <ch_id>
+        """
+        threads = self.plan_threads()
+        gst_launch_string = create_channel_launch_string(self.tuned_conf(self.conf_data[ch_id]), ch_id,
+                                                         self.vp_model, self.vp_proc, threads)
+        log.info(f'\nPipleine of channel {ch_id}::\n\n{gst_launch_string}\n\n')
+        self.pipelines[ch_id] = ChannelPipeline([ch_id], gst_launch_string, self.conf_data, self.fps_manager,
+                                                self.q_data, self.running, self.meta_data, threads['decode'])
+        self.pipelines[ch_id].start()
+
+    def tuned_conf(self, conf):
+        """
+        Return camera config <conf> completed with the autotuned settings of its device
+        """
+        settings = self.tuning.get(conf['device'])
+        if not settings:
+            return conf
+        tuned = {'batch_size': settings['batch_size'], 'nireq': settings['nireq']}
+        tuned.update(conf)
+        return tuned
+
+    def plan_threads(self):
+        """
+        Return thread plan for the channels currently configured
+        """
+        overrides = dict(self.threads or {})
+        if 'CPU' in self.tuning:
+            overrides.setdefault('streams', self.tuning['CPU']['streams'])
+        return plan_threads(sum(1 for conf in self.conf_data if conf is not None), overrides, self.cores)
+
+    def start_all(self, show_output=False):
+        """
+        Start pipelines of all configured channels.
+        With <show_output> all channels share one pipeline mixing their output.
+        """
+        ch_ids = [i for i, conf in enumerate(self.conf_data) if conf is not None]
+        if show_output:
+            conf_data = [self.tuned_conf(self.conf_data[i]) for i in ch_ids]
+            threads = self.plan_threads()
+            gst_launch_string = create_launch_string(conf_data, self.vp_model, self.vp_proc, show_output, threads,
+                                                      ch_ids)
+            log.info(f'\nPipleine::\n\n{gst_launch_string}\n\n')
+            self.pipelines[-1] = ChannelPipeline(ch_ids, gst_launch_string, self.conf_data, self.fps_manager,
+                                                 self.q_data, self.running, self.meta_data, threads['decode'])
+            self.pipelines[-1].start()
+            return
+        for ch_id in ch_ids:
+            self.start_channel(ch_id)
+
+    def stop_channel(self, ch_id, reset=True):
+        """
+        Stop the pipeline of channel <ch_id>, with <reset> also reset its counters
+        """
+        ch_pipeline = self.pipelines.pop(ch_id, None)
+        if ch_pipeline is not None:
+            ch_pipeline.close()
+        if not reset:
+            return
+        self.client.data[ch_id] = 0
+        self.client.near_miss_count[ch_id] = 0
+        self.client.collision_count[ch_id] = 0
+        self.client.pipeline_status.pop(ch_id, None)
+        if self.channel_status is not None:
+            self.channel_status.update(ch_id, uptime=0, restarts=0, errors=0, fps=0, frames=0, first_frame=0,
+                                       shed=0, keep=0, latency=0)
+        self.fps_manager.reset(ch_id)
+        if SCHEDULER is not None:
+            SCHEDULER.reset(ch_id)
+        if CLIPS is not None:
+            CLIPS.reset(ch_id)
+
+    def apply(self, action, ch_id, conf):
+        """
+        Apply a configuration change: action is one of `add`, `update` or `remove`
+        """
+        if -1 in self.pipelines:
+            log.warning('Configuration changes are not applied while showing output.')
+            return
+        if action == 'update':
+            # Same camera (see reload_config in server.py), counters and tracking state are kept
+            old_conf, self.conf_data[ch_id] = self.conf_data[ch_id], conf
+            rebuild = any(conf.get(key) != old_conf.get(key) for key in ChannelController.PIPELINE_KEYS)
+            if rebuild:
+                self.stop_channel(ch_id, reset=False)
+            if tracking_system[ch_id] is not None:
+                tracking_system[ch_id].cam_config = conf
+                # Scene keys are pipeline keys, trackers are cleared while the pipeline is stopped
+                if any(conf.get(key) != old_conf.get(key) for key in ChannelController.SCENE_KEYS):
+                    tracking_system[ch_id].clear_trackers()
+            if rebuild:
+                self.start_channel(ch_id)
+            log.info(f'Channel {ch_id} configuration updated.')
+            return
+        if action == 'remove':
+            self.stop_channel(ch_id)
+            self.conf_data[ch_id] = None
+            tracking_system[ch_id] = None
+            log.info(f'Channel {ch_id} removed.')
+        if action == 'add':
+            self.conf_data[ch_id] = conf
+            tracking_system[ch_id] = TrackingSystem(ch_id, self.client, conf)
+            self.start_channel(ch_id)
+            log.info(f'Channel {ch_id} added.')
+
+    def poll_control(self, control):
+        """
+        Apply pending configuration changes. Used as periodic GLib timeout callback.
+        """
+        while True:
+            try:
+                action, ch_id, conf = control.get_nowait()
+            except Empty:
+                break
+            try:
+                self.apply(action, ch_id, conf)
+            except Exception as err:
+                log.error(f'Error: Failed to {action} channel {ch_id}: {err}')
+        return True
+
+    def report_status(self):
+        """
+        Report uptime and restart counts of each channel. Used as periodic GLib timeout callback.
+        """
+        for ch_pipeline in list(self.pipelines.values()):
+            for ch_id in ch_pipeline.ch_ids:
+                status = {'uptime': round(ch_pipeline.uptime(), 1), 'restarts': ch_pipeline.restarts,
+                          'errors': ch_pipeline.errors, 'shed': SCHEDULER.shed[ch_id] if SCHEDULER else 0,
+                          'keep': SCHEDULER.keep[ch_id] if SCHEDULER else 1,
+                          'latency': round(self.fps_manager.latency[ch_id]*1000, 1)}
+                # Frame delivery to viewers, dropped frames mean a viewer is slower than the pipeline
+                self.client.pipeline_status[ch_id] = dict(status, delivered=self.q_data[ch_id].delivered,
+                                                          dropped=self.q_data[ch_id].dropped)
+                if self.channel_status is not None:
+                    self.channel_status.update(ch_id, fps=self.fps_manager.get_fps(ch_id),
+                                               frames=self.fps_manager.frame_counts[ch_id],
+                                               first_frame=self.fps_manager.first_frame[ch_id], **status)
+        return True
+
+    def schedule(self):
+        """
+        Update frame budgets from the activity of the running channels. Used as periodic GLib timeout callback.
+        """
+        activity = {}
+        for ch_pipeline in list(self.pipelines.values()):
+            for ch_id in ch_pipeline.ch_ids:
+                conf = self.conf_data[ch_id]
+                system = tracking_system[ch_id]
+                if conf is None or system is None:
+                    continue
+                try:
+                    watched = self.running[ch_id] > 0
+                except FileNotFoundError:
+                    watched = False
+                activity[ch_id] = (conf.get('priority', DEFAULT_PRIORITY), len(system.manager.tracker_vec),
+                                   system.near_miss + system.collision_count, watched)
+        SCHEDULER.replan(activity)
+        return True
+
+    def stop_all(self):
+        """
+        Stop all pipelines
+        """
+        for ch_pipeline in self.pipelines.values():
+            ch_pipeline.close()
+        self.pipelines = {}
 
 
 def start_app(config_data, vp_model, vp_proc, is_tracking, is_collsion,
-              client, q_data, running, show_output=False):
+              client, q_data, running, meta_data=None, live_counts=None, history=None, checkpoint=None,
+              channel_status=None, control=None, show_output=False, worker=0, workers=1, reports=None,
+              cpus=None, channels=None, threads=None, tuning=None, model_cache_dir=None, shed_latency=0,
+              trajectories=None, clips=None):
     """
     Main function to start smart city.
+    Each channel runs in its own pipeline, unless <show_output> is set.
+    Channel slots are allocated for all keys of <q_data>, so channels can be
+    added later through <control> up to that capacity.
+    In sharded mode this is analytics worker <worker> of <workers>: it runs every
+    <workers>-th of the local channels and forwards its counts to <reports>
+    instead of writing to InfluxDB. Channel ids stay global.
+    <client> is an InfluxDB client or a dict of its connection parameters, processes started
+    with spawn or forkserver can't receive a connected client.
+    :param cpus: Optional. Set of cores to pin this process to
+    :param channels: Optional. Ids of the channels served by this node, all channels if None
+    :param threads: Optional. Thread counts overriding the thread plan, `threads` section of the config
+    :param tuning: Optional. Autotuned inference settings per device (see autotune.load_or_tune)
+    :param model_cache_dir: Optional. Directory of the OpenVINO compiled model cache
+    :param shed_latency: Optional. Milliseconds from inference input to the end of the frame callback
+                         over which frames are shed, 0 processes all frames
+    :param trajectories: Optional. TrajectoryArchive completed tracks are added to
+    :param clips: Optional. ClipRecorder keeping clips of collisions
     """
-    global TRACKING, COLLISION
+    global TRACKING, COLLISION, CHECKPOINT, MODEL_CACHE_DIR, SCHEDULER, CLIPS
     logging.basicConfig(level=logging.INFO,
                         format="%(asctime)s :: %(message)s")
     TRACKING, COLLISION = is_tracking, is_collsion
+    MODEL_CACHE_DIR = model_cache_dir
+    SCHEDULER = Scheduler(max(len(config_data), len(q_data)), shed_latency/1000) if shed_latency else None
+    timer = StartupTimer()
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+        log.info(f'Analytics worker {worker} pinned to cores {sorted(cpus)}')
     num_ch = len(config_data)
-    client = InfluxDB(client, num_ch)
+    capacity = max(num_ch, len(q_data))
+    own_channels = list(range(capacity) if channels is None else channels)[worker::workers]
+    conf_data = [conf if i in own_channels else None
+                 for i, conf in enumerate(list(config_data) + [None]*(capacity - num_ch))]
+    if isinstance(client, dict):
+        client = influxdb.InfluxDBClient(**client)
+    client = InfluxDB(client, capacity, reports, worker)
+    client.channels = own_channels
     client.start()
-    for i in range(num_ch):
-        tracking_system.append(TrackingSystem(i, client, config_data[i]))
+    if live_counts is not None:
+        live_counts.start(client)
+    if history is not None:
+        history.start(client)
+    for i in range(capacity):
+        tracking_system.append(TrackingSystem(i, client, conf_data[i]) if conf_data[i] else None)
+    timer.mark('tracking')
+    if checkpoint is not None and TRACKING:
+        st_time = time.monotonic()
+        for i, conf in enumerate(conf_data):
+            state = checkpoint.load(i, conf) if conf else None
+            if state:
+                try:
+                    tracking_system[i].set_state(state)
+                except (KeyError, TypeError, ValueError) as err:
+                    log.warning(f'Ignoring invalid checkpoint of channel {i}: {err}')
+                    tracking_system[i] = TrackingSystem(i, client, conf)
+        log.info(f'Checkpoints restored in {time.monotonic() - st_time:.3f} s')
+        if checkpoint.start():
+            CHECKPOINT = checkpoint
+        timer.mark('checkpoints')
+    if trajectories is not None and TRACKING:
+        SingleTracker.PATH_INTERVAL = trajectories.SAMPLE_INTERVAL
+        TrackingManager.archive = trajectories
+        trajectories.start()
+    if clips is not None and COLLISION:
+        TrackingSystem.clips = clips
+        clips.start()
+        CLIPS = clips
     Gst.init(sys.argv)
-    gst_launch_string = create_launch_string(config_data, vp_model,
-                                             vp_proc, show_output)
-    log.info(f'\nPipleine::\n\n{gst_launch_string}\n\n')
-    while True:
-        try:
-            pipeline = Gst.parse_launch(gst_launch_string)
-            set_callbacks(pipeline, config_data, q_data, running)
-            log.info('Pipeline started..')
-            pipeline.set_state(Gst.State.PLAYING)
-            bus = pipeline.get_bus()
-            msg = bus.timed_pop_filtered(
-                Gst.CLOCK_TIME_NONE, Gst.MessageType.ERROR | Gst.MessageType.EOS)
-            if msg.type != Gst.MessageType.EOS:
-                err, debug = msg.parse_error()
-                log.error(f'Error: {err}\nAdditional debug info: {debug}')
-            pipeline.set_state(Gst.State.NULL)
-            log.info('Pipeline completed. Loop again...')
-        except KeyboardInterrupt:
-            break
-    pipeline.set_state(Gst.State.NULL)
+    timer.mark('gstreamer')
+    # Unpinned workers share the cores of the host, each plans threads for its share only
+    cores = len(cpus) if cpus else len(analytics.worker_cpus(worker, workers))
+    controller = ChannelController(conf_data, vp_model, vp_proc, client, q_data, running,
+                                   meta_data, channel_status, threads, tuning, cores)
+    log.info(f'Thread plan: {controller.plan_threads()}')
+    controller.start_all(show_output)
+    timer.mark('pipelines')
+    timer.report(f'Analytics worker {worker}')
+    GLib.timeout_add_seconds(1, controller.report_status)
+    if SCHEDULER is not None:
+        GLib.timeout_add_seconds(1, controller.schedule)
+    if control is not None:
+        GLib.timeout_add(200, controller.poll_control, control)
+    loop = GLib.MainLoop()
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        loop.quit()
+    controller.stop_all()
+    if live_counts is not None:
+        live_counts.stop()
+    if history is not None:
+        history.stop()
+    if CHECKPOINT is not None:
+        CHECKPOINT.stop()
+    if TrackingManager.archive is not None:
+        TrackingManager.archive.stop()
+    if CLIPS is not None:
+        CLIPS.stop()
     client.stop()
-
-
@@ -0,0 +1,76 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def since_start(pid=1):
+    """
+    Return seconds since process <pid> started. In a container pid 1 started with the container.
+    """
+    try:
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        with open(f'/proc/{pid}/stat') as f:
+            # Fields after the command name, starttime is field 22 of the file
+            fields = f.read().rsplit(')', 1)[1].split()
+        return uptime - int(fields[19])/os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def rss_mb(pid='self'):
+    """
+    Return resident memory of process <pid> in MB, 0 if unknown
+    """
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    return 0
+
+
+class StartupTimer:
+    """
+    Duration of each startup phase, logged as one breakdown
+    """
+    def __init__(self):
+        # Time from process start to the timer, interpreter start and imports
+        self.phases = [('imports', since_start(os.getpid()))]
+        self.last = time.monotonic()
+
+    def mark(self, phase):
+        """
+        End phase <phase>, which started at the previous mark
+        """
+        now = time.monotonic()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self, title):
+        """
+        Log the breakdown of all phases so far
+        """
+        breakdown = ', '.join(f'{phase} {duration:.2f} s' for phase, duration in self.phases)
+        log.info(f'{title} startup: {breakdown} - {since_start():.2f} s since container start, '
+                 f'RSS {rss_mb():.0f} MB')
@@ -0,0 +1,66 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trajectory import TrajectoryArchive, encode_segment, decode_segment, query  # noqa: E402
+
+# 2022-06-01 23:59:00 UTC
+BEFORE_MIDNIGHT = 1654127940.0
+
+
+class TestTrajectory(unittest.TestCase):
+    """
+    Round trip of segments and queries of the on-disk archive
+    """
+    def test_round_trip(self):
+        times = [BEFORE_MIDNIGHT, BEFORE_MIDNIGHT + 0.2, BEFORE_MIDNIGHT + 0.4]
+        _, tracks = decode_segment(encode_segment(3, [(7, 2, times, [10, 11.5, 13], [20, 19.25, 18])]))
+        self.assertEqual(tracks[0]['id'], 7)
+        self.assertEqual(tracks[0]['label'], 2)
+        np.testing.assert_allclose(tracks[0]['time'], times, atol=1e-3)
+        np.testing.assert_allclose(tracks[0]['x'], [10, 11.5, 13])
+        np.testing.assert_allclose(tracks[0]['y'], [20, 19.25, 18])
+
+    def test_long_gap(self):
+        # Gaps over 65 s overflowed the 16 bit time deltas of version 1 segments
+        times = [BEFORE_MIDNIGHT, BEFORE_MIDNIGHT + 70, BEFORE_MIDNIGHT + 3600.5]
+        ch_id, tracks = decode_segment(encode_segment(1, [(1, None, times, [0, 1, 2], [0, 1, 2])]))
+        self.assertEqual(ch_id, 1)
+        self.assertIsNone(tracks[0]['label'])
+        np.testing.assert_allclose(tracks[0]['time'], times, atol=1e-3)
+
+    def test_query_across_midnight(self):
+        times = [BEFORE_MIDNIGHT, BEFORE_MIDNIGHT + 30, BEFORE_MIDNIGHT + 120]
+        with tempfile.TemporaryDirectory() as path:
+            TrajectoryArchive(path).write_batch([(0, (5, 0, times, [0, 1, 2], [0, 1, 2]))])
+            # The segment starts the day before the window
+            after = query(path, BEFORE_MIDNIGHT + 90, BEFORE_MIDNIGHT + 200)
+            self.assertEqual([track['id'] for _, track in after], [5])
+            # Listed in the index of both days, returned once
+            both = query(path, BEFORE_MIDNIGHT - 10, BEFORE_MIDNIGHT + 200)
+            self.assertEqual([track['id'] for _, track in both], [5])
+            self.assertEqual(query(path, BEFORE_MIDNIGHT + 200, BEFORE_MIDNIGHT + 300), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
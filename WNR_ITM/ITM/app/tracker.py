@@ -17,17 +17,44 @@ limitations under the License.
 
 import time
 import math
+import functools
 import collections
+from queue import Empty
 from threading import Thread
 import cv2
 import yolo_labels
 from utils import Point, Rect
 
 
+# Digits of Hershey fonts have the same width, texts are measured with all digits as 0
+DIGITS_TO_ZERO = str.maketrans('123456789', '000000000')
+
+
+@functools.lru_cache(maxsize=256)
+def _text_size(template, font, scale, thickness):
+    return cv2.getTextSize(template, font, scale, thickness)[0]
+
+
+def get_text_size(text, font=cv2.FONT_HERSHEY_SIMPLEX, scale=0.5, thickness=1):
+    """
+    Return (width, height) of <text>. Cached per layout of the text, so tracker ids
+    and FPS values changing on every frame share one entry.
+    """
+    return _text_size(text.translate(DIGITS_TO_ZERO), font, scale, thickness)
+
+
 class SingleTracker:
 
     # If detecting to many false collisions, try decreasing ACC_FACTOR
     ACC_FACTOR = 1000
+    # Frame rate thresholds were tuned at, velocities are drawn as displacement per such frame
+    REFERENCE_FPS = 30
+    # Seconds between samples treated as a discontinuity (looped file, restarted pipeline)
+    MAX_GAP = 2
+    # Seconds between samples of the full path kept for the trajectory archive, 0 keeps no path
+    PATH_INTERVAL = 0
+    # Samples of the longest path kept, older samples are dropped
+    MAX_PATH = 3000
 
     def __init__(self, id, rect, color, label, influx_client=None):
         self.id = id
@@ -36,6 +63,15 @@ class SingleTracker:
         self.label = label
         self.c_q = collections.deque(maxlen=5)
         self.avg_pos = collections.deque(maxlen=50)
+        # Timestamps in seconds of the samples in c_q, avg_pos and the velocity queues
+        self.t_q = collections.deque(maxlen=5)
+        self.avg_t = collections.deque(maxlen=50)
+        self.v_t_q = collections.deque(maxlen=50)
+        # Averaged positions and their timestamps over the life of the tracker, see PATH_INTERVAL
+        self.path = collections.deque(maxlen=SingleTracker.MAX_PATH)
+        self.path_t = collections.deque(maxlen=SingleTracker.MAX_PATH)
+        self.last_time = None
+        self.last_seen = None
         self.center = self.rect.center()
         self.vel, self.acc = Point(0, 0), Point(0, 0)
         self.vel_x, self.vel_y = 0, 0
@@ -50,23 +86,94 @@ class SingleTracker:
         self.collision = 0
         self.rect_width = 0
         self.influx_client = influx_client
+        self._label_text = None
+        self._label_text_for = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['influx_client'] = None
+        return state
+
+    # Sample queues saved by get_state(), positions are stored as [x, y]
+    POINT_QUEUES = ['c_q', 'avg_pos']
+    VALUE_QUEUES = ['t_q', 'avg_t', 'v_t_q', 'path_t', 'v_x_q', 'v_y_q', 'v_q', 'a_x_q', 'a_y_q', 'a_q']
+
+    def get_state(self):
+        """
+        Return the tracker as plain values (id, box, last positions, velocities), used for checkpoints
+        """
+        state = {'id': int(self.id),
+                 'rect': [float(self.rect.x), float(self.rect.y), float(self.rect.width), float(self.rect.height)],
+                 'color': [int(c) for c in self.color],
+                 'label': None if self.label is None else int(self.label),
+                 'last_time': self.last_time,
+                 'last_seen': self.last_seen,
+                 'vel': [float(self.vel_x), float(self.vel_y)],
+                 'acc': [float(self.acc_x), float(self.acc_y)],
+                 'path': [[float(x), float(y)] for x, y in self.path],
+                 'no_update_counter': self.no_update_counter,
+                 'near_miss': bool(self.near_miss),
+                 'collision': bool(self.collision),
+                 'rect_width': self.rect_width}
+        for name in SingleTracker.POINT_QUEUES:
+            state[name] = [[float(pt.x), float(pt.y)] for pt in getattr(self, name)]
+        for name in SingleTracker.VALUE_QUEUES:
+            state[name] = [float(value) for value in getattr(self, name)]
+        return state
+
+    @staticmethod
+    def from_state(state, influx_client=None):
+        """
+        Return tracker restored from values saved by get_state()
+        """
+        tracker = SingleTracker(state['id'], Rect(*state['rect']), tuple(state['color']), state['label'],
+                                influx_client)
+        tracker.last_time, tracker.last_seen = state['last_time'], state['last_seen']
+        tracker.path.extend(tuple(pt) for pt in state['path'])
+        for name in SingleTracker.POINT_QUEUES:
+            getattr(tracker, name).extend(Point(x, y) for x, y in state[name])
+        for name in SingleTracker.VALUE_QUEUES:
+            getattr(tracker, name).extend(state[name])
+        tracker.center = tracker.rect.center()
+        tracker._set_vel(Point(*state['vel']))
+        tracker._set_acc(Point(*state['acc']))
+        tracker.no_update_counter = state['no_update_counter']
+        tracker.near_miss = state['near_miss']
+        tracker.collision = state['collision']
+        tracker.rect_width = state['rect_width']
+        return tracker
+
+    def label_text(self):
+        """
+        Return "<id> <label>" string drawn on the frame, rebuilt only when the label changes.
+        """
+        if self._label_text is None or self._label_text_for != self.label:
+            self._label_text = str(self.id) + " " + yolo_labels.get_label_str(self.label)
+            self._label_text_for = self.label
+        return self._label_text
 
     def _set_vel(self, vel):
-        self.vel = vel
-        self.vel_x = self.vel.x - self.center.x
-        self.vel_y = self.vel.y - self.center.y
+        """
+        Set velocity <vel> in pixels per second
+        """
+        self.vel_x, self.vel_y = vel.x, vel.y
         self.mod_vel = math.sqrt(self.vel_x**2 + self.vel_y**2)
+        # Position one reference frame ahead, drawn as velocity arrow
+        self.vel = self.center + vel/SingleTracker.REFERENCE_FPS
 
-    def _save_last_vel(self, vel_x, vel_y, mod_vel):
+    def _save_last_vel(self, vel_x, vel_y, mod_vel, timestamp):
         self.v_x_q.appendleft(vel_x)
         self.v_y_q.appendleft(vel_y)
         self.v_q.appendleft(mod_vel)
+        self.v_t_q.appendleft(timestamp)
 
     def _set_acc(self, acc):
-        self.acc = acc
-        self.acc_x = self.acc.x - self.center.x
-        self.acc_y = self.acc.y - self.center.y
+        """
+        Set acceleration <acc>, change of the ACC_FACTOR scaled velocity per second
+        """
+        self.acc_x, self.acc_y = acc.x, acc.y
         self.mod_acc = math.sqrt(self.acc_x**2 + self.acc_y**2)
+        self.acc = self.center + acc/SingleTracker.REFERENCE_FPS**2
 
     def _save_last_acc(self, acc_x, acc_y, mod_acc):
         self.a_x_q.appendleft(acc_x)
@@ -85,46 +192,46 @@ class SingleTracker:
                 avg += self.c_q[i]
             avg /= full
             self.avg_pos.appendleft(avg)
+            self.avg_t.appendleft(sum(self.t_q)/full)
+            if SingleTracker.PATH_INTERVAL and \
+               (not self.path_t or self.avg_t[0] - self.path_t[-1] >= SingleTracker.PATH_INTERVAL):
+                self.path.append((avg.x, avg.y))
+                self.path_t.append(self.avg_t[0])
 
     def cal_vel(self):
         """
-        Calculate velocity as an average of last n_frames frames (dX, dY).
+        Calculate velocity in pixels per second over the last n_frames averaged positions (dX/dt, dY/dt).
         """
         full = 5
-        delta_x, delta_y = 0, 0
         limit = min(full, len(self.avg_pos) -1)
-        if limit > 1:
-            for i in range(0, limit):
-                delta_x += self.avg_pos[i].x - self.avg_pos[i+1].x
-                delta_y += self.avg_pos[i].y - self.avg_pos[i+1].y
-            delta_x /= limit
-            delta_y /= limit
-            avg_vel = Point(delta_x, delta_y)
-            self._set_vel(self.center + avg_vel)
-            self._save_last_vel(self.vel_x, self.vel_y, self.mod_vel)
+        duration = self.avg_t[0] - self.avg_t[limit] if limit > 1 else 0
+        if duration > 0:
+            delta_x = self.avg_pos[0].x - self.avg_pos[limit].x
+            delta_y = self.avg_pos[0].y - self.avg_pos[limit].y
+            self._set_vel(Point(delta_x/duration, delta_y/duration))
+            self._save_last_vel(self.vel_x, self.vel_y, self.mod_vel, self.avg_t[0])
         else:
-            self._set_vel(self.center)
+            self._set_vel(Point(0, 0))
 
     def cal_acc(self):
         """
-        Calculate acceleration as an average of last n_frames frames (dX, dY).
+        Calculate acceleration per second over the last n_frames velocities.
+        Velocities are scaled by ACC_FACTOR over the distance from the top of the frame,
+        objects far from the camera move fewer pixels.
         """
         full = 5
-        delta_x, delta_y = 0, 0
         limit = min(full, len(self.v_q) -1)
-        if limit > 1:
+        duration = self.v_t_q[0] - self.v_t_q[limit] if limit > 1 else 0
+        if duration > 0:
+            delta_x, delta_y = 0, 0
             for i in range(0, limit):
-                delta_x += (self.v_x_q[i]+1)*SingleTracker.ACC_FACTOR/(self.avg_pos[i].y+10) - \
-                           (self.v_x_q[i+1]+1)*SingleTracker.ACC_FACTOR/(self.avg_pos[i].y+10)
-                delta_y += (self.v_y_q[i]+1)*SingleTracker.ACC_FACTOR/(self.avg_pos[i].y+10) - \
-                           (self.v_y_q[i+1]+1)*SingleTracker.ACC_FACTOR/(self.avg_pos[i].y+10)
-            delta_x /= limit
-            delta_y /= limit
-            acc = Point(delta_x, delta_y)
-            self._set_acc(self.center + acc)
+                scale = SingleTracker.ACC_FACTOR/(self.avg_pos[i].y+10)
+                delta_x += (self.v_x_q[i] - self.v_x_q[i+1])*scale
+                delta_y += (self.v_y_q[i] - self.v_y_q[i+1])*scale
+            self._set_acc(Point(delta_x/duration, delta_y/duration))
             self._save_last_acc(self.acc_x, self.acc_y, self.mod_acc)
         else:
-            self._set_acc(self.center)
+            self._set_acc(Point(0, 0))
 
     def is_target_in_frame(self, f_width, f_height):
         """
@@ -136,32 +243,53 @@ class SingleTracker:
         is_y_inside = (curr_y >= 0) and (curr_y < f_height)
         return (is_x_inside and is_y_inside)
 
-    def mark_for_deletion(self):
+    def mark_for_deletion(self, timestamp):
         """
         Mark trackers to delete.
         """
         frames = 10
-        min_vel = 0.01*self.rect.area()
-        if self.no_update_counter >= frames and self.mod_vel < min_vel:
+        min_vel = 0.01*self.rect.area()*SingleTracker.REFERENCE_FPS
+        if timestamp - self.last_seen >= frames/SingleTracker.REFERENCE_FPS and self.mod_vel < min_vel:
             self.to_delete = True
         return True
 
-    def do_single_tracking(self):
+    def rebase(self, timestamp):
         """
-        Track 'one' target specified by SingleTracker.rect in a frame.
+        Shift stored timestamps so the last sample is one reference frame before <timestamp>
         """
-        if not self.update:
-            self.center = Point(self.vel.x, self.vel.y)
-            self.rect.x += self.vel_x
-            self.rect.y += self.vel_y
+        shift = timestamp - 1/SingleTracker.REFERENCE_FPS - self.last_time
+        for queue in [self.t_q, self.avg_t, self.v_t_q, self.path_t]:
+            for i in range(len(queue)):
+                queue[i] += shift
+        self.last_time += shift
+        self.last_seen += shift
+
+    def do_single_tracking(self, timestamp):
+        """
+        Track 'one' target specified by SingleTracker.rect in a frame taken at <timestamp> seconds.
+        Positions not updated by a detection are predicted from the velocity and the
+        time since the previous frame, so dropped frames don't change the kinematics.
+        """
+        if self.last_time is None:
+            self.last_time = self.last_seen = timestamp - 1/SingleTracker.REFERENCE_FPS
+        elif not 0 < timestamp - self.last_time <= SingleTracker.MAX_GAP:
+            self.rebase(timestamp)
+        elapsed = timestamp - self.last_time
+        self.last_time = timestamp
+        if self.update:
+            self.last_seen = timestamp
+        else:
+            self.rect.x += self.vel_x*elapsed
+            self.rect.y += self.vel_y*elapsed
         self.update = False
         self.center = self.rect.center()
         self.c_q.appendleft(self.center)
+        self.t_q.appendleft(timestamp)
         self.cal_avg_pos()
         self.cal_vel()
         self.cal_acc()
         self.no_update_counter += 1
-        self.mark_for_deletion()
+        self.mark_for_deletion(timestamp)
         return True
 
 
@@ -170,6 +298,8 @@ class TrackingManager:
     total_vehicle_count = 0
     total_bicycle_count = 0
     total_people_count = 0
+    # Trajectory archive deleted trackers are added to, None if trajectories are not kept
+    archive = None
 
     def __init__(self, channel_id=None, influx_client=None):
         self.channel_id = channel_id
@@ -264,8 +394,30 @@ class TrackingManager:
             return False
         else:
             tr = self.tracker_vec.pop(result_idx)
+        if TrackingManager.archive is not None and tr.last_time is not None:
+            self.archive_tracker(tr)
         return True
 
+    def archive_tracker(self, tracker):
+        """
+        Add path of deleted <tracker> to the trajectory archive, summarised to InfluxDB if enabled
+        """
+        # Sample timestamps are frame timestamps, the last one is the current frame
+        offset = time.time() - tracker.last_time
+        times = [t + offset for t in tracker.path_t]
+        xs = [x for x, _ in tracker.path]
+        ys = [y for _, y in tracker.path]
+        if not TrackingManager.archive.add(self.channel_id, tracker.id, tracker.label, times, xs, ys):
+            return
+        if TrackingManager.archive.summary and self.influx_client:
+            distance = sum(math.hypot(xs[i] - xs[i-1], ys[i] - ys[i-1]) for i in range(1, len(xs)))
+            self.influx_client.trajectories.append(
+                (self.channel_id, {'id': tracker.id,
+                                   'label': yolo_labels.get_label_str(tracker.label) if tracker.label is not None else '',
+                                   'duration': float(times[-1] - times[0]), 'distance': float(distance),
+                                   'start_x': float(xs[0]), 'start_y': float(ys[0]),
+                                   'end_x': float(xs[-1]), 'end_y': float(ys[-1])}))
+
     def get_total_counts(self):
         """
         Return total counts
@@ -277,9 +429,17 @@ class TrackingManager:
 
 class InfluxDB:
     """
-    Class to push data to InfluxDB periodically
+    Class to push data to InfluxDB periodically.
+    In sharded mode each analytics worker forwards its data to <aggregator>
+    instead, and a single aggregating instance merges the reports and writes them.
     """
-    def __init__(self, influxdb, num_ch):
+    def __init__(self, influxdb, num_ch, aggregator=None, worker=0):
+        """
+        :param influxdb: InfluxDBClient object, unused if <aggregator> is given
+        :param num_ch: Number of channels
+        :param aggregator: Optional. Interprocess queue to forward data to instead of writing it
+        :param worker: Worker id used in forwarded reports
+        """
         self.influxdb = influxdb
         self.data = [0]*num_ch
         self.total_counts = []
@@ -287,17 +447,33 @@ class InfluxDB:
         self.near_miss_count = [0]*num_ch
         self.collision_count = [0]*num_ch
         self.collision_events = []
+        # (channel id, fields) summaries of archived tracks
+        self.trajectories = []
+        self.pipeline_status = {}
         self.num_ch = num_ch
+        # Channels whose data is held by this instance
+        self.channels = list(range(num_ch))
+        self.aggregator = aggregator
+        self.worker = worker
+        self.worker_totals = {}
+        # Totals are written only by one instance when channels are partitioned over nodes,
+        # optionally from a callable returning (total_counts, total_collision_count)
+        self.write_totals = True
+        self.totals_source = None
         self.running = False
 
-    def start(self):
+    def start(self, reports=None):
         """
-        Start Thread
+        Start Thread. If <reports> queue is given, also merge reports forwarded by workers.
         """
         self.th = Thread(target=self.update_db, args=())
         self.running = True
         self.th.daemon = True
         self.th.start()
+        if reports is not None:
+            self.th_reports = Thread(target=self.receive, args=(reports,))
+            self.th_reports.daemon = True
+            self.th_reports.start()
 
     def stop(self):
         """
@@ -306,12 +482,56 @@ class InfluxDB:
         self.running = False
         self.th.join()
 
+    def report(self):
+        """
+        Return data of own channels to be forwarded to the aggregator
+        """
+        events, self.collision_events = self.collision_events, []
+        trajectories, self.trajectories = self.trajectories, []
+        return {'worker': self.worker,
+                'channels': {ch_id: (self.data[ch_id], self.near_miss_count[ch_id], self.collision_count[ch_id])
+                             for ch_id in self.channels},
+                'total_counts': list(self.total_counts),
+                'pipeline_status': dict(self.pipeline_status),
+                'events': events,
+                'trajectories': trajectories}
+
+    def merge(self, report):
+        """
+        Merge <report> of a worker. Totals are the sum of the totals of all workers.
+        """
+        for ch_id, (data, near_miss, collision) in report['channels'].items():
+            self.data[ch_id] = data
+            self.near_miss_count[ch_id] = near_miss
+            self.collision_count[ch_id] = collision
+            self.pipeline_status.pop(ch_id, None)
+        self.pipeline_status.update(report['pipeline_status'])
+        self.collision_events.extend(report['events'])
+        self.trajectories.extend(report['trajectories'])
+        if report['total_counts']:
+            self.worker_totals[report['worker']] = report['total_counts']
+            self.total_counts = [sum(counts) for counts in zip(*self.worker_totals.values())]
+
+    def receive(self, reports):
+        """
+        Merge reports forwarded by workers
+        """
+        while self.running:
+            try:
+                report = reports.get(timeout=1)
+            except Empty:
+                continue
+            self.merge(report)
+
     def update_db(self):
         """
         Push data InfluxDB in every 1 second
         """
         while self.running:
             time.sleep(1)
+            if self.aggregator is not None:
+                self.aggregator.put(self.report())
+                continue
             json_body = []
             for ch_id, ch_data in enumerate(self.data):
                 if ch_data != 0:
@@ -325,22 +545,40 @@ class InfluxDB:
                                       'fields': {f'channel{ch_id}near miss': self.near_miss_count[ch_id],
                                                  f'channel{ch_id}collision': self.collision_count[ch_id]}
                                     })
-            if self.total_counts:
+            if self.totals_source is not None:
+                self.total_counts, self.total_collision_count = self.totals_source()
+            else:
+                self.total_collision_count = sum(self.collision_count)
+            if self.write_totals and self.total_counts:
                 json_body.append({'measurement': 'total_count',
                                   'fields': {'total_people_count': self.total_counts[0],
                                              'total_car_count': self.total_counts[1],
                                              'total_bicycle_count': self.total_counts[2]}
                                 })
-            self.total_collision_count = sum(self.collision_count)
-            if self.total_collision_count:
+            if self.write_totals and self.total_collision_count:
                 json_body.append({'measurement': 'total_count',
                                   'fields': {'total_collision_count': self.total_collision_count}
                                 })
+            for ch_id, status in list(self.pipeline_status.items()):
+                json_body.append({'measurement': 'pipeline_status',
+                                  'fields': {f'channel{ch_id}uptime': float(status['uptime']),
+                                             f'channel{ch_id}restarts': status['restarts'],
+                                             f'channel{ch_id}errors': status['errors'],
+                                             f'channel{ch_id}shed': status.get('shed', 0),
+                                             f'channel{ch_id}latency': float(status.get('latency', 0)),
+                                             f'channel{ch_id}frames_delivered': status.get('delivered', 0),
+                                             f'channel{ch_id}frames_dropped': status.get('dropped', 0)}
+                                })
             while self.collision_events:
                 event = self.collision_events.pop(0)
                 json_body.append({'measurement': "collisions_event",
                                   'fields': {f'details': event}
                                 })
+            while self.trajectories:
+                ch_id, fields = self.trajectories.pop(0)
+                json_body.append({'measurement': f'channel{ch_id}trajectory',
+                                  'fields': fields
+                                })
             if json_body:
                 self.influxdb.write_points(json_body)
 
@@ -348,6 +586,11 @@ class InfluxDB:
 class TrackingSystem:
 
     total_collision_count = 0
+    # Change of acceleration marking a near miss, per second squared (tuned as 4 and 3 per frame squared)
+    NEAR_MISS_ACC_X = 4*SingleTracker.REFERENCE_FPS**2
+    NEAR_MISS_ACC_Y = 3*SingleTracker.REFERENCE_FPS**2
+    # ClipRecorder saving a clip of each collision, None if no clips are kept
+    clips = None
 
     def __init__(self, channel_id=None, influx_client=None, cam_config=[]):
         self.channel_id = channel_id
@@ -381,7 +624,8 @@ class TrackingSystem:
         self.is_initialized = True
         self.frame_width, self.frame_height = frame_width, frame_height
         self.init_target = init_target
-        index, label, color = 0, None, None
+        # Ids continue after those of trackers dropped by clear_trackers()
+        index, label, color = self.manager.id_list, None, None
         for target in self.init_target:
             label = target[1]
             color = yolo_labels.get_label_color(label)
@@ -396,6 +640,18 @@ class TrackingSystem:
             index += 1
         return True
 
+    def clear_trackers(self):
+        """
+        Drop all live trackers, used when the image of the camera changes.
+        Counters and tracker ids are kept, tracking restarts on the next frame.
+        """
+        for tracker in list(self.manager.tracker_vec):
+            self.manager.delete_tracker(tracker.id)
+        self.collision_couples = []
+        self.n_obj1, self.n_obj2 = 0, 0
+        self.is_initialized = False
+        return True
+
     def update_tracking_system(self, updated_results):
         """
         Insert new multiple SingleTracker objects to the manager.tracker_vec.
@@ -417,18 +673,19 @@ class TrackingSystem:
                     return False
         return True
 
-    def start_tracking(self, mat):
+    def start_tracking(self, timestamp=None):
         """
         Track all targets.
         You don't need to give target id for tracking.
         This function will track all targets.
+        :param timestamp: Optional. Time of the frame in seconds, e.g. its PTS. Monotonic clock if None.
         """
-        if mat is None:
-            return False
+        if timestamp is None:
+            timestamp = time.monotonic()
         thread_pool = []
         for ptr in self.manager.tracker_vec:
             thread = Thread(target=ptr.do_single_tracking,
-                            args=())
+                            args=(timestamp,))
             thread_pool.append(thread)
             thread.start()
         for thread in thread_pool:
@@ -465,9 +722,9 @@ class TrackingSystem:
                     st = (int(tracker.avg_pos[i].x), int(tracker.avg_pos[i].y))
                     end = (int(tracker.avg_pos[i-1].x), int(tracker.avg_pos[i-1].y))
                     cv2.line(mat, st, end, tracker.color, 1)
-            text = str(tracker.id) + " " + yolo_labels.get_label_str(tracker.label)
+            text = tracker.label_text()
             pos = (int(tracker.rect.x + 2), int(tracker.rect.y - 5))
-            (text_width, text_height), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+            (text_width, text_height) = get_text_size(text)
             cv2.rectangle(mat, (int(pos[0]), int(pos[1])),
                           (int(pos[0] + text_width), int(pos[1] - text_height)),
                           tracker.color, cv2.FILLED)
@@ -475,13 +732,84 @@ class TrackingSystem:
             if tracker.collision or tracker.near_miss:
                 pos = (int(tracker.rect.x + 2), int(tracker.rect.y + tracker.rect.height + 12))
                 text = "Collision" if tracker.collision else "Near Miss"
-                (text_width, text_height), _ = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+                (text_width, text_height) = get_text_size(text)
                 cv2.rectangle(mat, (pos[0], pos[1]),
                               (int(pos[0] + text_width), int(pos[1] - text_height)),
                               tracker.color, cv2.FILLED)
                 cv2.putText(mat, text, pos, cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 2)
         return True
 
+    def get_state(self):
+        """
+        Return tracking state and counters of the channel as plain values, used for checkpoints.
+        """
+        return {'address': self.cam_config.get('address'),
+                'path': self.cam_config.get('path'),
+                'frame_width': None if self.frame_width is None else int(self.frame_width),
+                'frame_height': None if self.frame_height is None else int(self.frame_height),
+                'is_initialized': self.is_initialized,
+                'total_frames': int(self.total_frames),
+                'near_miss': int(self.near_miss),
+                'collision_count': int(self.collision_count),
+                'collision_couples': list(self.collision_couples),
+                'near_miss_pair': [int(self.n_obj1), int(self.n_obj2)],
+                'id_list': int(self.manager.id_list),
+                'counts': [int(self.manager.people_count), int(self.manager.vehicle_count),
+                           int(self.manager.bicycle_count)],
+                'trackers': [tracker.get_state() for tracker in self.manager.tracker_vec]}
+
+    def set_state(self, state):
+        """
+        Restore tracking state and counters saved by get_state().
+        """
+        trackers = [SingleTracker.from_state(tracker, self.influx_client) for tracker in state['trackers']]
+        self.frame_width, self.frame_height = state['frame_width'], state['frame_height']
+        self.is_initialized = state['is_initialized'] and self.frame_width is not None
+        self.total_frames = state['total_frames']
+        self.near_miss = state['near_miss']
+        self.collision_count = state['collision_count']
+        self.collision_couples = state['collision_couples']
+        self.n_obj1, self.n_obj2 = state['near_miss_pair']
+        self.manager.id_list = state['id_list']
+        people, vehicles, bicycles = state['counts']
+        self.manager.people_count = people
+        self.manager.vehicle_count = vehicles
+        self.manager.bicycle_count = bicycles
+        TrackingManager.total_people_count += people
+        TrackingManager.total_vehicle_count += vehicles
+        TrackingManager.total_bicycle_count += bicycles
+        TrackingSystem.total_collision_count += self.collision_count
+        self.manager.tracker_vec = trackers
+        if self.influx_client:
+            if people or vehicles or bicycles:
+                self.influx_client.data[self.channel_id] = list(state['counts'])
+                self.influx_client.total_counts = self.manager.get_total_counts()
+            self.influx_client.near_miss_count[self.channel_id] = self.near_miss
+            self.influx_client.collision_count[self.channel_id] = self.collision_count
+            self.influx_client.total_collision_count = TrackingSystem.total_collision_count
+        return True
+
+    def get_metadata(self):
+        """
+        Return tracking results as compact rows, used to draw overlays on the client side.
+        Row: [id, x, y, width, height, label, vel_x, vel_y, state, color]
+        state is 0 - normal, 1 - near miss, 2 - collision. color is '#rrggbb'.
+        Velocity is in pixels per reference frame (SingleTracker.REFERENCE_FPS).
+        """
+        rows = []
+        for tracker in self.manager.tracker_vec:
+            if len(tracker.c_q) == 5:
+                vel_x = round(tracker.vel_x/SingleTracker.REFERENCE_FPS, 2)
+                vel_y = round(tracker.vel_y/SingleTracker.REFERENCE_FPS, 2)
+            else:
+                vel_x, vel_y = 0, 0
+            state = 2 if tracker.collision else 1 if tracker.near_miss else 0
+            b, g, r = tracker.color
+            rows.append([tracker.id, int(tracker.rect.x), int(tracker.rect.y),
+                         int(tracker.rect.width), int(tracker.rect.height),
+                         tracker.label, vel_x, vel_y, state, '#%02x%02x%02x' % (r, g, b)])
+        return rows
+
     def detect_collision(self):
         """
         Detect collision and near miss between all trackers
@@ -534,7 +862,7 @@ class TrackingSystem:
             threshold_x = abs(sign_x*abs(tracker.acc_x) - (avg_acc_x))
             threshold_y = abs(sign_y*abs(tracker.acc_y) - (avg_acc_y))
 
-            if threshold_x > 4 or threshold_y >= 3:
+            if threshold_x > TrackingSystem.NEAR_MISS_ACC_X or threshold_y >= TrackingSystem.NEAR_MISS_ACC_Y:
                 if self.influx_client is not None and not tracker.near_miss:
                     pass
                 tracker.near_miss =  True
@@ -552,10 +880,14 @@ class TrackingSystem:
                         if other_tracker.near_miss and not couple in self.collision_couples:
                             self.collision_count += 1
                             TrackingSystem.total_collision_count += 1
+                            event = f'Collision detected at - {self.cam_config["address"]}'
+                            clip = TrackingSystem.clips.trigger(self.channel_id) if TrackingSystem.clips else None
+                            if clip:
+                                event += f' - clip {clip}'
                             if self.influx_client:
                                 self.influx_client.collision_count[self.channel_id] = self.collision_count
                                 self.influx_client.total_collision_count = TrackingSystem.total_collision_count
-                                self.influx_client.collision_events.append(f'Collision detected at - {self.cam_config["address"]}')
+                                self.influx_client.collision_events.append(event)
                             self.collision_couples.append(couple)
                         if (not other_tracker.near_miss) and (self.n_obj1 != obj1 or self.n_obj2 != obj2):
                             self.near_miss += 1
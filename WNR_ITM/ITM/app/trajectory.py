@@ -0,0 +1,258 @@
+"""
+Copyright 2022 Intel Corporation
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import time
+import zlib
+import struct
+import logging
+from threading import Thread, Condition
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Segment header: magic, version, channel, number of tracks, number of points, base time (epoch seconds)
+HEADER = struct.Struct('<4sHHIId')
+MAGIC = b'ITMT'
+SEGMENT_VERSION = 2
+# Positions are stored in 1/POSITION_SCALE pixels, times in milliseconds
+POSITION_SCALE = 4
+# Track columns and point columns of a segment, in file order
+TRACK_COLUMNS = [('id', np.uint32), ('label', np.int16), ('points', np.uint32),
+                 ('start', np.uint32), ('x', np.int32), ('y', np.int32)]
+POINT_COLUMNS = [('dt', np.uint32), ('dx', np.int16), ('dy', np.int16)]
+# Point columns of version 1 segments, whose 16 bit dt clipped gaps over 65 s
+POINT_COLUMNS_V1 = [('dt', np.uint16), ('dx', np.int16), ('dy', np.int16)]
+
+
+def day_dir(path, timestamp):
+    """
+    Return directory of the segments of the UTC day of <timestamp> in archive <path>
+    """
+    return os.path.join(path, time.strftime('%Y%m%d', time.gmtime(timestamp)))
+
+
+def encode_segment(ch_id, tracks):
+    """
+    Return binary segment of channel <ch_id> holding <tracks>, a list of
+    (id, label, times, xs, ys) with epoch times in seconds and positions in pixels.
+    Columns hold the first sample of each track and the deltas of the following ones,
+    quantized to milliseconds and 1/POSITION_SCALE pixels, the body is zlib compressed.
+    """
+    base = min(track[2][0] for track in tracks)
+    columns = {name: [] for name, _ in TRACK_COLUMNS + POINT_COLUMNS}
+    for track_id, label, times, xs, ys in tracks:
+        t = np.round((np.asarray(times) - base)*1000).astype(np.int64)
+        x = np.round(np.asarray(xs)*POSITION_SCALE).astype(np.int64)
+        y = np.round(np.asarray(ys)*POSITION_SCALE).astype(np.int64)
+        columns['id'].append(track_id)
+        columns['label'].append(-1 if label is None else label)
+        columns['points'].append(len(t))
+        columns['start'].append(t[0])
+        columns['x'].append(x[0])
+        columns['y'].append(y[0])
+        # Deltas of the first sample are 0, so positions are the cumulative sum within a track
+        columns['dt'].append(np.clip(np.diff(t, prepend=t[0]), 0, np.iinfo(np.uint32).max))
+        columns['dx'].append(np.clip(np.diff(x, prepend=x[0]), -32768, 32767))
+        columns['dy'].append(np.clip(np.diff(y, prepend=y[0]), -32768, 32767))
+    body = b''.join(np.asarray(columns[name], dtype).tobytes() for name, dtype in TRACK_COLUMNS)
+    body += b''.join(np.concatenate(columns[name]).astype(dtype).tobytes() for name, dtype in POINT_COLUMNS)
+    header = HEADER.pack(MAGIC, SEGMENT_VERSION, ch_id, len(tracks), sum(columns['points']), base)
+    return header + zlib.compress(body, 1)
+
+
+def decode_segment(data):
+    """
+    Return (channel id, tracks) of binary segment <data>, tracks as dicts
+    with id, label and arrays of epoch times and pixel positions
+    """
+    magic, version, ch_id, num_tracks, num_points, base = HEADER.unpack_from(data)
+    if magic != MAGIC or version not in [1, SEGMENT_VERSION]:
+        raise ValueError('Not a trajectory segment of a supported version')
+    body = zlib.decompress(data[HEADER.size:])
+    point_columns = POINT_COLUMNS_V1 if version == 1 else POINT_COLUMNS
+    columns, offset = {}, 0
+    for column_list, count in [(TRACK_COLUMNS, num_tracks), (point_columns, num_points)]:
+        for name, dtype in column_list:
+            columns[name] = np.frombuffer(body, dtype, count, offset)
+            offset += count*np.dtype(dtype).itemsize
+    tracks, first = [], 0
+    for i in range(num_tracks):
+        last = first + int(columns['points'][i])
+        t = int(columns['start'][i]) + np.cumsum(columns['dt'][first:last], dtype=np.int64)
+        x = int(columns['x'][i]) + np.cumsum(columns['dx'][first:last], dtype=np.int64)
+        y = int(columns['y'][i]) + np.cumsum(columns['dy'][first:last], dtype=np.int64)
+        label = int(columns['label'][i])
+        tracks.append({'id': int(columns['id'][i]), 'label': None if label < 0 else label,
+                       'time': base + t/1000, 'x': x/POSITION_SCALE, 'y': y/POSITION_SCALE})
+        first = last
+    return ch_id, tracks
+
+
+def read_index(path, day):
+    """
+    Return index entries (channel id, start, end, number of tracks, segment file)
+    of UTC <day> (YYYYMMDD) in archive <path>
+    """
+    entries = []
+    try:
+        with open(os.path.join(path, day, 'index'), 'r') as index:
+            for line in index:
+                fields = line.split()
+                if len(fields) == 5:
+                    entries.append((int(fields[0]), float(fields[1]), float(fields[2]), int(fields[3]),
+                                    os.path.normpath(os.path.join(path, day, fields[4]))))
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def query(path, t_from, t_to, ch_id=None):
+    """
+    Return tracks of archive <path> overlapping epoch seconds <t_from> to <t_to>,
+    of channel <ch_id> or all channels if None, as (channel id, track) tuples.
+    Only segments selected by the daily indexes are read.
+    """
+    result, seen = [], set()
+    day = t_from - t_from % 86400
+    while day <= t_to:
+        for entry_ch, start, end, _, segment in read_index(path, time.strftime('%Y%m%d', time.gmtime(day))):
+            if (ch_id is not None and entry_ch != ch_id) or end < t_from or start > t_to or segment in seen:
+                continue
+            # Segments spanning several days are listed in the index of each of them
+            seen.add(segment)
+            with open(segment, 'rb') as f:
+                _, tracks = decode_segment(f.read())
+            result.extend((entry_ch, track) for track in tracks
+                          if track['time'][-1] >= t_from and track['time'][0] <= t_to)
+        day += 86400
+    return result
+
+
+class TrajectoryArchive:
+    """
+    On-disk archive of completed tracks. Tracks are collected when their tracker
+    is deleted and encoded and written in batches by a background thread,
+    one segment per channel and batch, listed in a daily index.
+    """
+    # Tracks collected before a batch is written
+    BATCH_TRACKS = 256
+    # Seconds before a partial batch is written
+    FLUSH_INTERVAL = 60
+    # Tracks shorter than this many samples are not archived
+    MIN_POINTS = 3
+    # Seconds between samples of the path of a tracker
+    SAMPLE_INTERVAL = 0.2
+
+    def __init__(self, path, summary=False):
+        """
+        :param path: Directory of the archive
+        :param summary: Optional. Write a summary of each track to InfluxDB
+        """
+        self.path = path
+        self.summary = summary
+        self._pending = []
+        self._cond = Condition()
+        self.running = False
+
+    def __getstate__(self):
+        """
+        Pickle configuration only, the condition and writer thread are per process
+        """
+        state = self.__dict__.copy()
+        for key in ['_cond', 'th']:
+            state.pop(key, None)
+        state['_pending'] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cond = Condition()
+
+    def add(self, ch_id, track_id, label, times, xs, ys):
+        """
+        Queue completed track <track_id> of channel <ch_id>, samples in epoch seconds and pixels
+        """
+        if len(times) < TrajectoryArchive.MIN_POINTS:
+            return False
+        with self._cond:
+            self._pending.append((ch_id, (track_id, label, times, xs, ys)))
+            if len(self._pending) >= TrajectoryArchive.BATCH_TRACKS:
+                self._cond.notify()
+        return True
+
+    def start(self):
+        """
+        Start Thread
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self.th = Thread(target=self.write, args=())
+        self.running = True
+        self.th.daemon = True
+        self.th.start()
+
+    def stop(self):
+        """
+        Stop Thread, pending tracks are written before returning
+        """
+        with self._cond:
+            self.running = False
+            self._cond.notify()
+        self.th.join()
+
+    def write_batch(self, batch):
+        """
+        Write one segment per channel of <batch> and add them to the index of each day they span
+        """
+        channels = {}
+        for ch_id, track in batch:
+            channels.setdefault(ch_id, []).append(track)
+        for ch_id, tracks in channels.items():
+            start = min(track[2][0] for track in tracks)
+            end = max(track[2][-1] for track in tracks)
+            directory = day_dir(self.path, start)
+            name = f'channel{ch_id}-{int(start*1000)}-{os.getpid()}.trj'
+            try:
+                os.makedirs(directory, exist_ok=True)
+                with open(os.path.join(directory, name), 'wb') as f:
+                    f.write(encode_segment(ch_id, tracks))
+                day = start - start % 86400
+                while day <= end:
+                    # Later days point to the segment in the directory of its first day
+                    other = day_dir(self.path, day)
+                    entry = name if other == directory else os.path.join('..', os.path.basename(directory), name)
+                    os.makedirs(other, exist_ok=True)
+                    # One short append per segment, workers share the index of a day
+                    with open(os.path.join(other, 'index'), 'a') as index:
+                        index.write(f'{ch_id} {start:.3f} {end:.3f} {len(tracks)} {entry}\n')
+                    day += 86400
+            except OSError as err:
+                log.error(f'Failed to write trajectories of channel {ch_id}: {err}')
+
+    def write(self):
+        """
+        Write collected tracks when a batch is full, FLUSH_INTERVAL has passed or on stop
+        """
+        while True:
+            with self._cond:
+                if self.running and len(self._pending) < TrajectoryArchive.BATCH_TRACKS:
+                    self._cond.wait(TrajectoryArchive.FLUSH_INTERVAL)
+                batch, self._pending = self._pending, []
+                running = self.running
+            if batch:
+                self.write_batch(batch)
+            if not running:
+                break
@@ -15,16 +15,57 @@ limitations under the License.
 """
 
 import os
+import re
 import sys
 import json
 import logging as log
 from argparse import ArgumentParser
 
 
+# Thread counts of the pipeline elements that can be set in the `threads` section of the config
+THREAD_KEYS = ['decode', 'convert', 'scale', 'inference', 'streams']
+# Lower transports of RTSP cameras, `rtsp_transport` of the camera
+RTSP_TRANSPORTS = ['udp', 'tcp', 'udp-mcast']
+
+
 class ConfigException(Exception):
     pass
 
 
+def model_instance_id(cam_detail):
+    """
+    Return id of the inference instance used by camera <cam_detail>.
+    By default all cameras on the same device share one instance.
+    """
+    if 'model_instance_id' in cam_detail:
+        return cam_detail['model_instance_id']
+    return 'detect_' + re.sub(r'\W', '_', cam_detail['device'])
+
+
+def check_roi(roi):
+    """
+    Check region of interest of a camera: list of polygons,
+    each a list of at least 3 [x, y] points relative to the frame (0 to 1)
+    """
+    def is_point(point):
+        return isinstance(point, list) and len(point) == 2 and \
+               all(isinstance(v, (int, float)) and not isinstance(v, bool) and 0 <= v <= 1 for v in point)
+    if not isinstance(roi, list) or not roi or \
+       not all(isinstance(polygon, list) and len(polygon) >= 3 and all(map(is_point, polygon)) for polygon in roi):
+        raise ConfigException(f'Invalid roi in config file - `{roi}`. Roi must be a list of polygons, '
+                              f'each a list of at least 3 [x, y] points with coordinates between 0 and 1.')
+
+
+def check_resolution(key, value):
+    """
+    Check resolution <value> of config key <key>: [width, height]
+    """
+    if not isinstance(value, list) or len(value) != 2 or \
+       not all(isinstance(v, int) and not isinstance(v, bool) and 32 <= v <= 4096 for v in value):
+        raise ConfigException(f'Invalid {key} in config file - `{value}`. '
+                              f'{key} must be [width, height], integers between 32 and 4096.')
+
+
 def read_model_proc(model_proc_path):
     """
     Read model proc file and sanitize it
@@ -59,12 +100,26 @@ def read_config(config_path):
             raise ConfigException(f'Invalid config file. Key `cameras` is missing')
     if num_ch == 0:
         raise ConfigException(f'Config file is empty')
+    threads = conf_data.get('threads', {})
+    if not isinstance(threads, dict):
+        raise ConfigException(f'Invalid threads in config file. Threads must be an object.')
+    for key, value in threads.items():
+        if key not in THREAD_KEYS:
+            raise ConfigException(f'Invalid key `{key}` in threads of config file. '
+                                  f'Possible keys are - {" ".join(THREAD_KEYS)}')
+        if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= 256:
+            raise ConfigException(f'Invalid threads value `{key}: {value}` in config file. '
+                                  f'Value must be an integer between 0 and 256, 0 keeps the element default.')
     compatible_devices = ['CPU', 'GPU', 'HDDL', 'MYRIAD']
     required_keys = ['address', 'latitude', 'longitude', 'analytics', 'device', 'path']
+    optional_keys = ['model_instance_id', 'batch_size', 'nireq', 'roi', 'inference_resolution', 'output_resolution',
+                     'priority', 'rtsp_transport', 'rtsp_latency', 'id']
     given_devices = []
+    instances = {}
+    camera_ids = set()
     for cam_detail in conf_data['cameras']:
         for key in cam_detail.keys():
-            if key not in required_keys:
+            if key not in required_keys + optional_keys:
                 raise ConfigException(f'Invalid key `{key}` in config file.')
         if not "".join(cam_detail['address'].split()).isalnum():
             raise ConfigException(f'Invalid address value in config file: `{cam_detail["address"]}`'
@@ -94,6 +149,41 @@ def read_config(config_path):
             elif "/dev/video" not in cam_detail['path'] and \
                cam_detail['path'].split('.')[-1] not in ['mp4', 'mov', 'avi', 'wmv', 'mkv', 'webm', 'flv']:
                 raise ConfigException(f'Source path `{cam_detail["path"]}` is not a valid video file. Check config file.')
+        if 'id' in cam_detail:
+            if not isinstance(cam_detail['id'], str) or not re.fullmatch(r'[\w-]+', cam_detail['id']):
+                raise ConfigException(f'Invalid id in config file - `{cam_detail["id"]}`. '
+                                      f'Id must be a non-empty string of letters, digits, `_` or `-`.')
+            if cam_detail['id'] in camera_ids:
+                raise ConfigException(f'Duplicate id in config file - `{cam_detail["id"]}`. Camera ids must be unique.')
+            camera_ids.add(cam_detail['id'])
+        if 'model_instance_id' in cam_detail and (not isinstance(cam_detail['model_instance_id'], str) or
+                                                  not re.fullmatch(r'[\w-]+', cam_detail['model_instance_id'])):
+            raise ConfigException(f'Invalid model_instance_id in config file - `{cam_detail["model_instance_id"]}`. '
+                                  f'Id must be a non-empty string of letters, digits, `_` or `-`.')
+        for key, max_value in [('batch_size', 64), ('nireq', 64), ('priority', 10)]:
+            value = cam_detail.get(key, 1)
+            if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= max_value:
+                raise ConfigException(f'Invalid {key} in config file - `{value}`. '
+                                      f'{key} must be an integer between 1 and {max_value}.')
+        if 'rtsp_transport' in cam_detail and cam_detail['rtsp_transport'] not in RTSP_TRANSPORTS:
+            raise ConfigException(f'Invalid rtsp_transport in config file - `{cam_detail["rtsp_transport"]}`. '
+                                  f'Possible values are - {" ".join(RTSP_TRANSPORTS)}')
+        value = cam_detail.get('rtsp_latency', 0)
+        if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= 10000:
+            raise ConfigException(f'Invalid rtsp_latency in config file - `{value}`. '
+                                  f'rtsp_latency must be an integer between 0 and 10000 milliseconds.')
+        if 'roi' in cam_detail:
+            check_roi(cam_detail['roi'])
+        for key in ['inference_resolution', 'output_resolution']:
+            if key in cam_detail:
+                check_resolution(key, cam_detail[key])
+        # Only the first element of a shared instance configures it
+        instance = model_instance_id(cam_detail)
+        settings = (cam_detail['device'], cam_detail.get('batch_size'), cam_detail.get('nireq'),
+                    cam_detail.get('inference_resolution'))
+        if instances.setdefault(instance, settings) != settings:
+            raise ConfigException(f'Cameras sharing model instance `{instance}` must have the same '
+                                  f'device, batch_size, nireq and inference_resolution.')
     return num_ch, conf_data, list(set(given_devices))
 
 